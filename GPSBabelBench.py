@@ -0,0 +1,473 @@
+"""
+Python-GPSBabel - Python wrapper for GPSBabel project
+Copyright (C) 2008, Michael J. Pedersen <m.pedersen@icelus.org>
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program; if not, write to the Free Software Foundation, Inc.,
+51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+
+"""
+Benchmarks for the gpsbabel module.
+
+Each benchmark runs against synthetic GPX of a chosen shape, and against a
+stub gpsbabel script which echoes its input back at a controlled speed, so
+no real gpsbabel is needed, and the results measure this module rather than
+gpsbabel. Each benchmark is run in a process of its own, so that the peak
+memory it reports is its own, and the GPX is generated once, by the parent,
+so that the children only read it. The results are written as JSON.
+
+Usage:
+    python GPSBabelBench.py [options]
+
+Run with --help for the options. For example, to compare the parsers on a
+single long track, and keep the results:
+    python GPSBabelBench.py --shape track --only parse-sax,parse-expat \\
+        --output results.json
+
+The shapes, and the number of each item they hold, are in SHAPES; the
+benchmarks are in BENCHMARKS. Every benchmark counts points per second,
+except buildCmd, which counts chains built per second.
+
+Each parse benchmark is run with both parsers, and the report's
+expatSpeedup gives how much faster expat was than sax for each set of
+options. See parserSpeedups.
+"""
+
+import datetime
+import optparse
+import os
+import os.path
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import gpsbabel
+
+SHAPES = {
+    'waypoints' : {'wpts' : 100000},
+    'track'     : {'trks' : 1, 'trksegs' : 1, 'trkpts' : 200000},
+    'tracks'    : {'trks' : 100, 'trksegs' : 4, 'trkpts' : 500},
+    'routes'    : {'rtes' : 1000, 'rtepts' : 100},
+    'mixed'     : {'wpts' : 20000, 'rtes' : 200, 'rtepts' : 100, 'trks' : 20, 'trksegs' : 2, 'trkpts' : 2500},
+}
+"""
+The shapes of GPX to generate. Each gives the arguments to makeGpx.
+"""
+
+STUB = r'''#!%(python)s
+# A stand-in for gpsbabel, written by GPSBabelBench.py. It answers -V, -h
+# and -l well enough for the gpsbabel module to load its capabilities, and
+# otherwise copies its -f input to its -F output, at no more than
+# GPSBABEL_STUB_RATE bytes per second (0 for no limit), after waiting
+# GPSBABEL_STUB_DELAY seconds.
+import os, sys, time
+args = sys.argv[1:]
+if args == ['-V']:
+    sys.stdout.write("\nGPSBabel Version 1.3.6\n")
+    sys.exit(0)
+if args == ['-h']:
+    sys.stdout.write("""Usage:
+\tgpsbabel [options] -i INTYPE -f INFILE -o OUTTYPE -F OUTFILE
+
+File Types (-i and -o options):
+\tgpx                      GPX XML
+\t  snlen                  Length of generated shortnames
+\t  gpxver                 Target GPX version for output
+\tkml                      Google Earth (Keyhole) Markup Language
+\t  lines                  Export linestrings for tracks and routes
+
+Supported data filters:
+\tsimplify                 Simplify routes
+\t  count                  Maximum number of points in route
+\t  error                  Maximum error
+\t  crosstrack             Use cross-track error (default)
+\ttrack                    Manipulate track lists
+\t  pack                   Pack all tracks into one
+\t  merge                  Merge multiple tracks for the same way
+\t  split                  Split by date or time interval (see README)
+""")
+    sys.exit(0)
+if args == ['-l']:
+    sys.stdout.write("* UTF-8\n\tutf8\n")
+    sys.exit(0)
+source = target = None
+i = 0
+while i < len(args):
+    if args[i] == '-f': source = args[i + 1]
+    if args[i] == '-F': target = args[i + 1]
+    i += 2 if args[i] in ('-f', '-F', '-p', '-i', '-o', '-x', '-c', '-D') else 1
+rate = float(os.environ.get('GPSBABEL_STUB_RATE', '0'))
+time.sleep(float(os.environ.get('GPSBABEL_STUB_DELAY', '0')))
+binary = lambda f: getattr(f, 'buffer', f)
+infile = binary(sys.stdin) if source in (None, '-') else open(source, 'rb')
+outfile = binary(sys.stdout) if target in (None, '-') else open(target, 'wb')
+start = time.time()
+done = 0
+while True:
+    data = infile.read(65536)
+    if not data:
+        break
+    outfile.write(data)
+    done += len(data)
+    if rate > 0:
+        wait = start + done / rate - time.time()
+        if wait > 0: time.sleep(wait)
+outfile.close()
+'''
+"""
+The stub gpsbabel script. See makeStub.
+"""
+
+def makeGpx(wpts=0, rtes=0, rtepts=0, trks=0, trksegs=1, trkpts=0, seed=0):
+    """
+    Generate a GPX file.
+
+    In:
+        wpts: The number of waypoints
+        rtes, rtepts: The number of routes, and of points in each
+        trks, trksegs, trkpts: The number of tracks, of segments in each,
+            and of points in each segment
+        seed: The seed for the random positions and elevations, so that
+            the same arguments always give the same GPX
+
+    Out:
+        The GPX, as a string
+    """
+    rand = random.Random(seed)
+    start = datetime.datetime(2008, 8, 17, 18, 0, 0)
+    output = ['<?xml version="1.0" encoding="UTF-8"?>\n<gpx version="1.0" creator="GPSBabelBench" '
+              'xmlns="http://www.topografix.com/GPX/1/0">\n']
+    for i in xrange(wpts):
+        output.append('<wpt lat="%.6f" lon="%.6f"><ele>%.1f</ele><time>%s</time><name>WPT%06d</name>'
+                      '<cmt>Waypoint %d &amp; more</cmt><sym>Waypoint</sym></wpt>\n' %
+                      (rand.uniform(-60, 60), rand.uniform(-180, 180), rand.uniform(0, 3000),
+                       (start + datetime.timedelta(seconds=i)).strftime('%Y-%m-%dT%H:%M:%SZ'), i, i))
+    for r in xrange(rtes):
+        lat, lon = rand.uniform(-60, 60), rand.uniform(-180, 180)
+        output.append('<rte><name>Route %d</name><number>%d</number>\n' % (r, r))
+        for i in xrange(rtepts):
+            lat += rand.uniform(-0.01, 0.01)
+            lon += rand.uniform(-0.01, 0.01)
+            output.append('<rtept lat="%.6f" lon="%.6f"><name>R%dP%d</name></rtept>\n' % (lat, lon, r, i))
+        output.append('</rte>\n')
+    for t in xrange(trks):
+        lat, lon, ele = rand.uniform(-60, 60), rand.uniform(-180, 180), rand.uniform(0, 3000)
+        when = start + datetime.timedelta(days=t)
+        output.append('<trk><name>Track %d</name><number>%d</number>\n' % (t, t))
+        for s in xrange(trksegs):
+            output.append('<trkseg>\n')
+            for i in xrange(trkpts):
+                lat += rand.uniform(-0.0001, 0.0001)
+                lon += rand.uniform(-0.0001, 0.0001)
+                ele += rand.uniform(-1, 1)
+                when += datetime.timedelta(seconds=1)
+                output.append('<trkpt lat="%.6f" lon="%.6f"><ele>%.1f</ele><time>%s</time></trkpt>\n' %
+                              (lat, lon, ele, when.strftime('%Y-%m-%dT%H:%M:%SZ')))
+            output.append('</trkseg>\n')
+        output.append('</trk>\n')
+    output.append('</gpx>\n')
+    return ''.join(output)
+
+def countPoints(shape):
+    """
+    Out:
+        The number of points in GPX made by makeGpx with the arguments in
+        shape
+    """
+    return shape.get('wpts', 0) + shape.get('rtes', 0) * shape.get('rtepts', 0) + \
+           shape.get('trks', 0) * shape.get('trksegs', 1) * shape.get('trkpts', 0)
+
+def makeStub(directory):
+    """
+    Write the stub gpsbabel script, and make the gpsbabel module use it.
+
+    In:
+        directory: The directory to write it to
+
+    Out:
+        The path of the stub
+    """
+    path = os.path.join(directory, 'gpsbabel')
+    f = open(path, 'w')
+    f.write(STUB % {'python' : sys.executable})
+    f.close()
+    os.chmod(path, 0755)
+    gpsbabel.cacheDir = None
+    gpsbabel.gps = gpsbabel.GPSBabel(path)
+    gpsbabel.refreshCapabilities()
+    return path
+
+class NullFile(object):
+    """
+    A file which throws away what is written to it, but counts the bytes.
+    """
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+
+#Each benchmark is a function which takes the GPX, the path of the stub,
+#and the number of points in the GPX. Anything which is not to be timed
+#is done there. It returns a function which runs the benchmark once, and
+#the number of items that run processes.
+
+def benchParse(parser, **kwargs):
+    def bench(data, stub, points):
+        return (lambda: gpsbabel.gpxParse(data, parser=parser, **kwargs)), points
+    return bench
+
+def benchToXml(data, stub, points):
+    gpx = gpsbabel.gpxParse(data, parser='expat')
+    return gpx.toXml, points
+
+def benchWriteTo(data, stub, points):
+    gpx = gpsbabel.gpxParse(data, parser='expat')
+    return (lambda: gpx.writeTo(NullFile())), points
+
+def benchRoundTrip(inMemory, filters={}, inProcess=False):
+    def bench(data, stub, points):
+        gpx = gpsbabel.gpxParse(data, parser='expat')
+        gps = gpsbabel.GPSBabel(stub)
+        gps.inProcess = inProcess
+        def run():
+            gps.setInGpx(gpx)
+            for name, opts in filters.items():
+                gps.addFilter(name, opts)
+            gps.captureStdOut(inMemory)
+            return gps.execCmd(parser='expat')
+        return run, points
+    return bench
+
+def benchBuildCmd(data, stub, points):
+    gps = gpsbabel.GPSBabel(stub)
+    count = 10000
+    def run():
+        for i in xrange(count):
+            gps.clearChainOpts()
+            gps.addInputFile('in%d.gpx' % i)
+            gps.addFilter('simplify', {'count' : '100'})
+            gps.addOutputFile('out%d.kml' % i, 'kml', 'UTF-8')
+            gps.buildCmd()
+    return run, count
+
+BENCHMARKS = [
+    ('parse-sax', benchParse('sax')),
+    ('parse-expat', benchParse('expat')),
+    ('parse-sax-lazy', benchParse('sax', lazy=True)),
+    ('parse-expat-lazy', benchParse('expat', lazy=True)),
+    ('parse-sax-columnar', benchParse('sax', columnar=True)),
+    ('parse-expat-columnar', benchParse('expat', columnar=True)),
+    ('toXml', benchToXml),
+    ('writeTo', benchWriteTo),
+    ('roundtrip-tempfile', benchRoundTrip(False)),
+    ('roundtrip-memory', benchRoundTrip(True)),
+    ('roundtrip-inprocess-simplify', benchRoundTrip(True, {'simplify' : {'count' : '100'}}, True)),
+    ('buildCmd', benchBuildCmd),
+]
+"""
+The benchmarks, by name, in the order they are run.
+"""
+
+RSS_NOTE = "peakRssKb is the high-water mark of the benchmark process, setup included; " \
+           "setupRssKb is that mark once setup was done, and runRssKb how far the runs raised it. " \
+           "gpsbabelPeakRssKb is the high-water mark of the largest gpsbabel process it ran, " \
+           "or null if the runs did not run gpsbabel."
+"""
+What the memory figures in the results mean, as written in the report.
+"""
+
+def parserSpeedups(results):
+    """
+    Out:
+        A dictionary of how many times more points per second the expat
+        parser read than the sax parser, with the same options, keyed by
+        the options (eager, lazy or columnar). Options for which either
+        benchmark was not run, or failed, are left out.
+
+    In:
+        results: The results of runAll
+    """
+    rates = dict([(result['name'], result.get('itemsPerSecond')) for result in results])
+    speedups = {}
+    for options, suffix in (('eager', ''), ('lazy', '-lazy'), ('columnar', '-columnar')):
+        sax = rates.get('parse-sax' + suffix)
+        expat = rates.get('parse-expat' + suffix)
+        if sax and expat: speedups[options] = expat / sax
+    return speedups
+
+def peakRss(who=None):
+    """
+    Out:
+        The most memory used so far, in kilobytes, or None if that cannot
+        be found
+
+    In:
+        who: resource.RUSAGE_SELF (the default) for this process, or
+            resource.RUSAGE_CHILDREN for the largest of the child processes
+            which have been waited for
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF if who is None else who).ru_maxrss
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+def childUsage():
+    """
+    Out:
+        The resource usage of the child processes which have been waited
+        for, or None if that cannot be found. It changes whenever another
+        one has been.
+    """
+    if resource is None:
+        return None
+    return tuple(resource.getrusage(resource.RUSAGE_CHILDREN))
+
+def runBenchmark(name, shape, stub, repeat=3, data=None):
+    """
+    Run one benchmark in this process.
+
+    In:
+        name: The name of the benchmark. See BENCHMARKS.
+        shape: The arguments to makeGpx
+        stub: The path of the stub gpsbabel. See makeStub.
+        repeat: How many times to run it. The best time is reported.
+        data: The GPX made by makeGpx for shape, if already made
+
+    Out:
+        A dictionary of the results. See RSS_NOTE for the memory figures.
+    """
+    if data is None: data = makeGpx(**shape)
+    bench = dict(BENCHMARKS)[name]
+    run, items = bench(data, stub, countPoints(shape))
+    before = peakRss()
+    children = childUsage()
+    times = []
+    for i in xrange(repeat):
+        start = time.time()
+        run()
+        times.append(time.time() - start)
+    best = min(times)
+    peak = peakRss()
+    return {'name' : name, 'items' : items, 'bytes' : len(data), 'repeat' : repeat,
+            'seconds' : best, 'meanSeconds' : sum(times) / len(times),
+            'itemsPerSecond' : items / best if best > 0 else None,
+            'setupRssKb' : before, 'peakRssKb' : peak,
+            'runRssKb' : peak - before if peak is not None else None,
+            'gpsbabelPeakRssKb' : peakRss(resource.RUSAGE_CHILDREN) if childUsage() != children else None}
+
+def runAll(names, shape, stub, repeat=3):
+    """
+    Run benchmarks, each in a process of its own.
+
+    In:
+        names: The names of the benchmarks to run
+        shape, stub, repeat: As for runBenchmark
+
+    Out:
+        A list of the results of each, as for runBenchmark. A benchmark
+        which fails has its error in place of its results.
+    """
+    results = []
+    dataname = os.path.join(os.path.dirname(stub), 'input.gpx')
+    f = open(dataname, 'wb')
+    f.write(makeGpx(**shape))
+    f.close()
+    for name in names:
+        cmd = [sys.executable, os.path.abspath(__file__), '--child', name, '--stub', stub, '--data', dataname,
+               '--repeat', str(repeat), '--shape-json', json.dumps(shape)]
+        child = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = child.communicate()
+        if child.returncode != 0:
+            results.append({'name' : name, 'error' : err.strip().splitlines()[-1:]})
+        else:
+            results.append(json.loads(out))
+        sys.stderr.write('%s: %s\n' % (name, results[-1].get('itemsPerSecond', results[-1].get('error'))))
+    return results
+
+def main(argv):
+    usage = 'usage: %prog [options]'
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option('--shape', default='mixed', help='the shape of GPX to generate: %s' % ', '.join(sorted(SHAPES)))
+    parser.add_option('--scale', type='float', default=1.0, help='multiply the number of every item by this')
+    for item in ('wpts', 'rtes', 'rtepts', 'trks', 'trksegs', 'trkpts'):
+        parser.add_option('--%s' % item, type='int', help='the number of %s, overriding the shape' % item)
+    parser.add_option('--only', help='a comma separated list of the benchmarks to run. Default: all of them')
+    parser.add_option('--repeat', type='int', default=3, help='how many times to run each benchmark')
+    parser.add_option('--rate', type='float', default=0, help='the bytes per second the stub gpsbabel copies, or 0 for no limit')
+    parser.add_option('--delay', type='float', default=0, help='the seconds the stub gpsbabel waits before starting')
+    parser.add_option('--output', help='the file to write the results to. Default: stdout')
+    parser.add_option('--child', help=optparse.SUPPRESS_HELP)
+    parser.add_option('--stub', help=optparse.SUPPRESS_HELP)
+    parser.add_option('--shape-json', help=optparse.SUPPRESS_HELP)
+    parser.add_option('--data', help=optparse.SUPPRESS_HELP)
+    options, args = parser.parse_args(argv)
+
+    if options.child:
+        gpsbabel.cacheDir = None
+        gpsbabel.gps = gpsbabel.GPSBabel(options.stub)
+        gpsbabel.refreshCapabilities()
+        f = open(options.data, 'rb')
+        data = f.read()
+        f.close()
+        json.dump(runBenchmark(options.child, json.loads(options.shape_json), options.stub, options.repeat, data), sys.stdout)
+        return 0
+
+    if options.shape not in SHAPES:
+        parser.error('unknown shape %s' % options.shape)
+    shape = dict([(key, int(value * options.scale)) for key, value in SHAPES[options.shape].items() if key != 'trksegs'])
+    shape['trksegs'] = SHAPES[options.shape].get('trksegs', 1)
+    for item in ('wpts', 'rtes', 'rtepts', 'trks', 'trksegs', 'trkpts'):
+        if getattr(options, item) is not None: shape[item] = getattr(options, item)
+    names = [name for name, bench in BENCHMARKS]
+    if options.only:
+        names = options.only.split(',')
+        unknown = [name for name in names if name not in dict(BENCHMARKS)]
+        if unknown: parser.error('unknown benchmark %s' % ', '.join(unknown))
+
+    os.environ['GPSBABEL_STUB_RATE'] = str(options.rate)
+    os.environ['GPSBABEL_STUB_DELAY'] = str(options.delay)
+    directory = tempfile.mkdtemp()
+    try:
+        stub = makeStub(directory)
+        results = runAll(names, shape, stub, options.repeat)
+    finally:
+        shutil.rmtree(directory)
+    report = {'created' : datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+              'python' : sys.version.split()[0], 'platform' : sys.platform,
+              'numpy' : gpsbabel.numpy.__version__ if gpsbabel.numpy is not None else None,
+              'shape' : shape, 'points' : countPoints(shape),
+              'stub' : {'rate' : options.rate, 'delay' : options.delay}, 'rss' : RSS_NOTE, 'results' : results,
+              'expatSpeedup' : parserSpeedups(results)}
+    output = open(options.output, 'w') if options.output else sys.stdout
+    json.dump(report, output, indent=2, sort_keys=True)
+    output.write('\n')
+    if options.output: output.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -20,11 +20,18 @@ with this program; if not, write to the Free Software Foundation, Inc.,
 import datetime
 import os
 import os.path
+import shutil
+import sys
+import tempfile
+import threading
+import time
 import unittest
+import xml.sax
 
 from decimal import Decimal
 
 import gpsbabel
+import GPSBabelBench
 
 class GPSBabelTest(unittest.TestCase):
     def setUp(self):
@@ -140,6 +147,240 @@ class GPSBabelTest(unittest.TestCase):
         except RuntimeError:
             pass
         
+    def testWaitCmd(self):
+        self.gps.setInGpx(gpsbabel.GPXData())
+        self.gps.captureStdOut()
+        self.failUnless(self.gps.execCmd(wait=False) is None)
+        ret, gpx = self.gps.waitCmd()
+        self.failUnless(ret == 0)
+        self.failUnless(len(gpx.wpts) == 0)
+        self.failUnless(self.gps.waitCmd() == (None, []))
+        
+    def testExecCmdLargeStdin(self):
+        gpx = gpsbabel.GPXData()
+        for i in xrange(5000):
+            gpx.wpts.append(gpsbabel.GPXWaypoint())
+            gpx.wpts[-1].lat = "45.%d" % i
+            gpx.wpts[-1].lon = "-70.%d" % i
+            gpx.wpts[-1].name = "WPT%d" % i
+        self.gps.setInGpx(gpx)
+        self.gps.captureStdOut()
+        ret, res = self.gps.execCmd()
+        self.failUnless(ret == 0)
+        self.failUnless(len(res.wpts) == 5000)
+        self.failUnless(res.wpts[-1].name == "WPT4999")
+        
+    def testCaptureStdOutInMemory(self):
+        gpx = '<gpx version="1.0">%s</gpx>' % "".join(['<wpt lat="45.0" lon="-70.%d"><name>WPT%d</name></wpt>\n' % (i, i) for i in xrange(5000)])
+        self.gps.setInGpx(gpx)
+        self.gps.captureStdOut(inMemory=True)
+        self.failUnless(self.gps.stdoutname is None)
+        self.failUnless(self.gps.buildCmd()[-2:] == ['-F', '-'])
+        ret, res = self.gps.execCmd()
+        self.failUnless(ret == 0)
+        self.failUnless(len(res.wpts) == 5000)
+        self.failUnless(res.wpts[-1].name == "WPT4999")
+        self.gps.setInGpx(gpx)
+        self.gps.captureStdOut(inMemory=True)
+        ret, res = self.gps.execCmd(parseOutput=False)
+        self.failUnless(isinstance(res, bytearray))
+        self.failUnless(res == gpx)
+        
+    def testExecCmdCallback(self):
+        gpx = '<gpx version="1.0"><wpt lat="45.0" lon="-70.0"><name>WPT1</name></wpt><rte><name>RTE1</name></rte><trk><name>TRK1</name></trk></gpx>'
+        for inMemory, parser in ((False, 'sax'), (True, 'sax'), (False, 'expat'), (True, 'expat')):
+            items = []
+            self.gps.setInGpx(gpx)
+            self.gps.captureStdOut(inMemory)
+            ret, res = self.gps.execCmd(callback=items.append, parser=parser)
+            self.failUnless([item.name for item in items] == ["WPT1", "RTE1", "TRK1"])
+            self.failUnless(items == [res.wpts[0], res.rtes[0], res.trks[0]])
+        
+    def testIterCmd(self):
+        self.gps.setInGpx('<gpx version="1.0">%s</gpx>' % "".join(['<wpt lat="45.0" lon="-70.0"><name>WPT%d</name></wpt>' % i for i in xrange(3000)]))
+        self.gps.captureStdOut(inMemory=True)
+        names = [item.name for item in self.gps.iterCmd()]
+        self.failUnless(names == ["WPT%d" % i for i in xrange(3000)])
+        
+    def testIterCmdStopEarly(self):
+        gpx = '<gpx version="1.0">%s</gpx>' % "".join(['<wpt lat="45.0" lon="-70.0"><name>WPT%d</name></wpt>' % i for i in xrange(20000)])
+        for inMemory in (True, False):
+            self.gps.setInGpx(gpx)
+            self.gps.captureStdOut(inMemory)
+            name = self.gps.stdoutname
+            items = self.gps.iterCmd()
+            self.failUnless(items.next().name == "WPT0")
+            items.close()
+            self.failUnless(self.gps.usage is not None and self.gps.waitCmd() == (None, []))
+            self.failUnless(name is None or not os.path.exists(name))
+        self.gps.setInGpx(gpx)
+        self.gps.captureStdOut(inMemory=True)
+        self.failUnless(len(self.gps.execCmd()[1].wpts) == 20000)
+        
+    def testIterBatchStopEarly(self):
+        gpx = '<gpx version="1.0">%s</gpx>' % "".join(['<wpt lat="45.0" lon="-70.0"><name>WPT%d</name></wpt>' % i for i in xrange(20000)])
+        processes = []
+        names = []
+        class Executor(gpsbabel.SubprocessExecutor):
+            def spawn(self, cmd):
+                processes.append(gpsbabel.SubprocessExecutor.spawn(self, cmd))
+                return processes[-1]
+        def spec(gps):
+            gps.setInGpx(gpx)
+            gps.captureStdOut()
+            names.append(gps.stdoutname)
+        pool = gpsbabel.GPSBabelPool(4, executor=Executor())
+        jobs = pool.iterBatch([[('addInputFile', '-', 'foobarbaz')]] + [spec] * 7)
+        self.failUnless(isinstance(jobs.next().error, gpsbabel.MissingFilefmtException))
+        self.failUnless(len(processes) == 4 and [p for p in processes if p.poll() is None])
+        jobs.close()
+        self.failUnless(len(processes) == 4 and [p for p in processes if p.poll() is None] == [])
+        self.failUnless(len(names) == 4 and [name for name in names if os.path.exists(name)] == [])
+        
+    def testExecCmdParseError(self):
+        self.gps.setInGpx('<gpx version="1.0"><wpt lat="45.0" lon="-70.0"></gpx>')
+        self.gps.captureStdOut(inMemory=True)
+        self.failUnlessRaises(xml.sax.SAXParseException, self.gps.execCmd)
+
+    def testMakePlan(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for i in xrange(3):
+                f = open(os.path.join(tmpdir, "in%d.gpx" % i), "w")
+                f.write('<gpx version="1.0"><wpt lat="45.0" lon="-70.0"><name>WPT%d</name></wpt></gpx>' % i)
+                f.close()
+            self.gps.addInputFile(os.path.join(tmpdir, "in$num.gpx"))
+            self.gps.addFilter('simplify', {'count' : '100'})
+            self.gps.captureStdOut()
+            plan = self.gps.makePlan()
+            self.failUnless(self.gps.chain == [])
+            self.failUnless(os.path.join(tmpdir, "in$num.gpx") in plan.cmd)
+            for i in xrange(3):
+                ret, gpx = plan.execCmd({'num' : i})
+                self.failUnless(ret == 0)
+                self.failUnless(gpx.wpts[0].name == "WPT%d" % i)
+            self.failUnlessRaises(KeyError, plan.execCmd, {})
+            self.gps.addInputFile(os.path.join(tmpdir, "in$num.gpx"))
+            self.gps.addOutputFile(os.path.join(tmpdir, "${num}.out"))
+            plan = self.gps.makePlan()
+            jobs = gpsbabel.GPSBabelPool(2).runBatch([(plan, {'num' : i}) for i in xrange(3)], parseOutput=False)
+            for i in xrange(3):
+                self.failUnless(jobs[i].error is None)
+                self.failUnless("WPT%d" % i in open(os.path.join(tmpdir, "%d.out" % i)).read())
+        finally:
+            shutil.rmtree(tmpdir)
+        
+    def testInProcessFilter(self):
+        self.failUnless(not self.gps.inProcess)
+        self.gps.inProcess = True
+        gpx = gpsbabel.GPXData()
+        gpx.rtes.append(gpsbabel.GPXRoute())
+        for lat, lon in ((45.0, -70.0), (45.001, -70.0), (45.002, -70.0), (45.003, -70.01), (45.004, -70.0)):
+            wpt = gpsbabel.GPXWaypoint()
+            wpt.lat, wpt.lon = Decimal(str(lat)), Decimal(str(lon))
+            gpx.rtes[0].rtepts.append(wpt)
+        self.gps.gpsbabel = 'gpsbabel-does-not-exist'
+        self.gps.setInGpx(gpx)
+        self.gps.addFilter('simplify', {'count' : 3})
+        self.gps.captureStdOut()
+        ret, output = self.gps.execCmd()
+        self.failUnless(ret == 0 and self.gps.chain == [])
+        self.failUnless([wpt.lat for wpt in output.rtes[0].rtepts] == [Decimal("45.0"), Decimal("45.003"), Decimal("45.004")])
+        self.failUnless(len(gpx.rtes[0].rtepts) == 5)
+        for extra in (lambda: self.gps.addCharset('ISO-8859-1'), lambda: self.gps.chain[-1][1].update({'suppresswhite' : None})):
+            self.gps.setInGpx(gpx)
+            self.gps.addFilter('simplify', {'count' : 3})
+            self.gps.captureStdOut()
+            extra()
+            self.failUnlessRaises(OSError, self.gps.execCmd)
+            os.unlink(self.gps.stdoutname)
+            self.gps.clearChainOpts()
+        self.gps.gpsbabel = 'gpsbabel'
+        self.gps.setInGpx(gpx)
+        self.gps.addFilter('simplify', {'error' : '0.1k'})
+        self.gps.addFilter('simplify', {'count' : 3, 'length' : None})
+        self.gps.captureStdOut(inMemory=True)
+        self.failUnless('simplify,count=3,length' in self.gps.buildCmd() or 'simplify,length,count=3' in self.gps.buildCmd())
+        expected = gpx.copy()
+        expected.simplify(error=100)
+        ret, output = self.gps.execCmd()
+        self.failUnless(len(expected.rtes[0].rtepts) == 4)
+        self.failUnless(output.toXml() == expected.toXml())
+        self.failUnless(gpsbabel.parseDistance("100ft") == 30.48)
+        self.failUnless(gpsbabel.parseDistance("2", 'km') == 2000)
+        self.failUnlessRaises(ValueError, gpsbabel.parseDistance, "2 parsecs")
+
+    def testTiming(self):
+        gpx = '<gpx version="1.0"><rte><rtept lat="45.0" lon="-70.0"/><rtept lat="45.1" lon="-70.0"/></rte>%s</gpx>' % "".join(['<wpt lat="45.0" lon="-70.%d"/>' % i for i in xrange(1000)])
+        self.gps.setInGpx(gpx)
+        self.gps.captureStdOut()
+        self.gps.execCmd()
+        self.failUnless(self.gps.timing is None)
+        timings = []
+        self.gps.observer = timings.append
+        for inMemory in (True, False):
+            self.gps.setInGpx(gpx)
+            self.gps.captureStdOut(inMemory)
+            self.gps.execCmd()
+            timing = self.gps.timing
+            self.failUnless(timings[-1] is timing and timing.error is None and timing.returncode == 0)
+            self.failUnless(timing.bytesIn == len(gpx) and timing.bytesOut == len(gpx))
+            self.failUnless((timing.wpts, timing.rtes, timing.trks, timing.points) == (1000, 1, 0, 2))
+            for stage in gpsbabel.GPSBabelTiming.stages[1:]:
+                self.failUnless(timing.duration(stage) >= 0)
+            self.failUnless(timing.marks['spawn'][1] <= timing.marks['parse'][0] <= timing.marks['finalize'][0])
+            self.failUnless(timing.total() >= timing.duration('gpsbabel'))
+        self.gps.setInGpx('<gpx version="1.0"><wpt lat="45.0" lon="-70.0"></gpx>')
+        self.gps.captureStdOut()
+        self.failUnlessRaises(xml.sax.SAXParseException, self.gps.execCmd)
+        self.failUnless(isinstance(timings[-1].error, xml.sax.SAXParseException))
+        self.gps.inProcess = True
+        self.gps.setInGpx(gpsbabel.gpxParse(gpx))
+        self.gps.addFilter('simplify', {'count' : 2})
+        self.gps.captureStdOut()
+        self.gps.execCmd()
+        self.failUnless(timings[-1].cached and timings[-1].cmd is None and timings[-1].wpts == 1000)
+        self.failUnless(timings[-1].duration('filter') >= 0 and 'filter' not in timings[0].marks)
+        self.gps.gpsbabel = 'gpsbabel-does-not-exist'
+        self.gps.setInGpx(gpx)
+        self.gps.captureStdOut(inMemory=True)
+        self.failUnlessRaises(OSError, self.gps.execCmd)
+        self.failUnless(isinstance(timings[-1].error, OSError) and self.gps.timing is timings[-1])
+        self.failUnless(timings[-1].duration('spawn') >= 0)
+        self.failUnless(len(timings) == 5)
+        self.failUnless(timings[0].asDict()['bytesIn'] == len(gpx) and 'parse' in timings[0].asDict())
+        
+    def testUsage(self):
+        self.gps.setInGpx(gpsbabel.GPXData())
+        self.gps.captureStdOut()
+        self.failUnless(self.gps.execCmd(wait=False) is None and self.gps.usage is None)
+        self.gps.waitCmd()
+        usage = self.gps.usage
+        self.failUnless(usage.runs == 1 and usage.wall > 0 and usage.maxrss > 0)
+        self.failUnless(usage.cpu() == usage.user + usage.system and usage.cpu() > 0)
+        total = gpsbabel.GPSBabelUsage(runs=0)
+        total.add(usage)
+        total.add(gpsbabel.GPSBabelUsage(1.0))
+        self.failUnless(total.runs == 2 and total.wall == usage.wall + 1.0)
+        self.failUnless(total.maxrss == usage.maxrss and total.cpu() is None)
+        
+    def testTimeout(self):
+        hang = [sys.executable, '-c', 'import signal, time; signal.signal(signal.SIGTERM, signal.SIG_IGN); time.sleep(30)']
+        started = time.time()
+        self.failUnlessRaises(gpsbabel.TimeoutException, self.gps.execCmd, hang, parseOutput=False, timeout=0.2)
+        self.gps.KILL_GRACE = 0.1
+        self.failUnlessRaises(gpsbabel.TimeoutException, self.gps.execCmd, hang, parseOutput=False,
+                              idleTimeout=0.2)
+        self.failUnless(time.time() - started < 10)
+        self.failUnless(self.gps.usage.wall >= 0.2)
+        self.gps.captureStdOut()
+        name = self.gps.stdoutname
+        self.gps.execCmd(hang, wait=False)
+        self.gps.cancel()
+        self.failUnlessRaises(gpsbabel.CancelledException, self.gps.waitCmd)
+        self.failUnless(not os.path.exists(name) and self.gps.stdoutname is None)
+        self.failUnless(self.gps.waitCmd() == (None, []))
+        
     def testGuessFormat(self):
         self.failUnless(self.gps.guessFormat("FILENAME.GPX") == "gpx")
         self.failUnless(self.gps.guessFormat("FILENAME.KML") == "kml")
@@ -242,6 +483,290 @@ class GPSBabelTest(unittest.TestCase):
         self.failUnless(len(gpx.rtes) == 0)
         self.failUnless(len(gpx.trks) == 0)
         
+class ConversionCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = gpsbabel.ConversionCache(2, self.tmpdir)
+        self.gps = gpsbabel.GPSBabel(cache=self.cache)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def convert(self, name, callback=None):
+        self.gps.setInGpx('<gpx version="1.0"><wpt lat="45.0" lon="-70.0"><name>%s</name></wpt></gpx>' % name)
+        self.gps.captureStdOut()
+        return self.gps.execCmd(callback=callback)
+
+    def testHitsAndMisses(self):
+        ret, gpx = self.convert("WPT1")
+        self.failUnless(self.cache.misses == 1 and self.cache.hits == 0)
+        items = []
+        ret, again = self.convert("WPT1", items.append)
+        self.failUnless(self.cache.hits == 1)
+        self.failUnless(ret == 0)
+        self.failUnless(again.wpts[0].name == "WPT1")
+        self.failIf(again is gpx)
+        self.failUnless(len(items) == 1)
+        self.convert("WPT2")
+        self.failUnless(self.cache.misses == 2)
+        self.failUnless(self.gps.chain == [])
+        self.failUnless(self.gps.stdoutname is None)
+
+    def testLeastRecentlyUsed(self):
+        self.gps.cache = cache = gpsbabel.ConversionCache(2)
+        for name in ["WPT1", "WPT2"] + ["WPT1"] * 50 + ["WPT3", "WPT1", "WPT2"]:
+            self.convert(name)
+        self.failUnless(cache.hits == 51 and cache.misses == 4)
+        self.convert("WPT1")
+        self.failUnless(cache.hits == 52)
+        self.convert("WPT3")
+        self.failUnless(cache.misses == 5)
+
+    def testDiskTier(self):
+        for name in ("WPT1", "WPT2", "WPT3"):
+            self.convert(name)
+        self.gps.cache = cache = gpsbabel.ConversionCache(2, self.tmpdir)
+        ret, gpx = self.convert("WPT1")
+        self.failUnless(cache.hits == 1 and cache.diskHits == 1)
+        self.failUnless(gpx.wpts[0].name == "WPT1")
+        cache.maxBytes = 1
+        self.convert("WPT4")
+        self.failUnless(len([i for i in os.listdir(self.tmpdir) if i.startswith("result-")]) == 0)
+        cache.clear()
+        self.convert("WPT1")
+        self.failUnless(cache.misses == 2)
+
+    def testUncacheable(self):
+        self.gps.setInGpx('<gpx version="1.0"></gpx>')
+        self.gps.addOutputFile(os.path.join(self.tmpdir, "out.gpx"))
+        self.failUnless(self.cache.makeKey(self.gps, self.gps.buildCmd()) is None)
+        self.gps.clear()
+        self.gps.addInputFile(self.tmpdir)
+        self.gps.captureStdOut()
+        self.failUnless(self.cache.makeKey(self.gps, self.gps.buildCmd()) is None)
+        os.unlink(self.gps.stdoutname)
+
+class GPSBabelLoopTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = gpsbabel.GPSBabelLoop()
+        
+    def testConcurrentReads(self):
+        runs = []
+        for i in xrange(5):
+            gps = gpsbabel.AsyncGPSBabel(loop=self.loop)
+            gps.stdindata = '<gpx version="1.0"><wpt lat="45.0" lon="-70.0"><name>WPT%d</name></wpt></gpx>' % i
+            runs.append(gps.aread('-', 'gpx', wpt=True))
+        self.failUnless(len(self.loop.runs) == 5)
+        self.loop.run()
+        self.failUnless(len(self.loop.runs) == 0)
+        for i in xrange(5):
+            self.failUnless(runs[i].done())
+            self.failUnless(runs[i].result().wpts[0].name == "WPT%d" % i)
+        
+    def testCallback(self):
+        gps = gpsbabel.AsyncGPSBabel(loop=self.loop)
+        gps.setInGpx(gpsbabel.GPXData())
+        finished = []
+        run = gps.awrite('-', 'gpx', parseOutput=True)
+        run.addCallback(finished.append)
+        self.failUnless(len(run.result().wpts) == 0)
+        self.failUnless(finished == [run])
+        
+    def testError(self):
+        gps = gpsbabel.AsyncGPSBabel(loop=self.loop)
+        run = gps.aexecCmd([gps.gpsbabel, '-foobarbaz'], parseOutput=False)
+        self.loop.run()
+        self.failUnless(isinstance(run.error, RuntimeError))
+        self.failUnlessRaises(RuntimeError, run.result)
+        
+    def testOneRunPerInstance(self):
+        gps = gpsbabel.AsyncGPSBabel(loop=self.loop)
+        gps.setInGpx(gpsbabel.GPXData())
+        gps.addOutputFile('-')
+        run = gps.aexecCmd(parseOutput=False)
+        self.failUnlessRaises(RuntimeError, gps.aexecCmd)
+        self.failUnless(run.result()[0] == 0)
+        
+    def testTimeout(self):
+        hang = [sys.executable, '-c', 'import time; time.sleep(30)']
+        slow = gpsbabel.AsyncGPSBabel(loop=self.loop).aexecCmd(hang, parseOutput=False, timeout=0.2)
+        cancelled = gpsbabel.AsyncGPSBabel(loop=self.loop).aexecCmd(hang, parseOutput=False)
+        gps = gpsbabel.AsyncGPSBabel(loop=self.loop)
+        gps.setInGpx(gpsbabel.GPXData())
+        fast = gps.awrite('-', 'gpx', parseOutput=True)
+        cancelled.cancel()
+        self.loop.run()
+        self.failUnless(isinstance(slow.error, gpsbabel.TimeoutException))
+        self.failUnless(isinstance(cancelled.error, gpsbabel.CancelledException))
+        self.failUnless(fast.error is None and len(fast.result().wpts) == 0)
+        
+    def testShortWaitSleeps(self):
+        started = gpsbabel.monotonic()
+        self.loop._GPSBabelLoop__wait([], [], 0.0005)
+        self.failUnless(gpsbabel.monotonic() - started >= 0.0005)
+        
+    def testKillDoesNotBlock(self):
+        stubborn = gpsbabel.AsyncGPSBabel(loop=self.loop)
+        stubborn.KILL_GRACE = 1.5
+        hang = [sys.executable, '-c', 'import signal, time; signal.signal(signal.SIGTERM, signal.SIG_IGN); time.sleep(30)']
+        slow = stubborn.aexecCmd(hang, parseOutput=False, timeout=0.2)
+        finished = []
+        fast = gpsbabel.AsyncGPSBabel(loop=self.loop).aexecCmd([sys.executable, '-c', 'import time; time.sleep(0.5)'],
+                                                                parseOutput=False)
+        started = time.time()
+        for run in (slow, fast):
+            run.addCallback(lambda run: finished.append((run, time.time() - started)))
+        self.loop.run()
+        self.failUnless([run for run, when in finished] == [fast, slow])
+        self.failUnless(finished[0][1] < 1.2 and finished[1][1] >= 1.5)
+        self.failUnless(isinstance(slow.error, gpsbabel.TimeoutException) and fast.error is None)
+        
+class GPSBabelPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.specs = []
+        for i in xrange(4):
+            gpx = '<gpx version="1.0"><wpt lat="45.0" lon="-70.0"><name>WPT%d</name></wpt></gpx>' % i
+            self.specs.append([('setInGpx', gpx), ('captureStdOut', )])
+        
+    def testRunBatch(self):
+        pool = gpsbabel.GPSBabelPool(2)
+        self.specs.insert(1, [('addInputFile', '-', 'foobarbaz')])
+        self.specs.insert(2, [('execCmd', )])
+        self.specs.append(lambda gps: gps.setInGpx(gpsbabel.GPXData()) or gps.addOutputFile('-'))
+        jobs = pool.runBatch(self.specs)
+        self.failUnless([job.index for job in jobs] == range(7))
+        self.failUnless(isinstance(jobs[1].error, gpsbabel.MissingFilefmtException))
+        self.failUnless(isinstance(jobs[2].error, gpsbabel.UnknownActionException))
+        for job in [jobs[0], jobs[3], jobs[4], jobs[5], jobs[6]]:
+            self.failUnless(job.error is None)
+            self.failUnless(job.returncode == 0)
+        self.failUnless(jobs[5].output.wpts[0].name == "WPT3")
+        self.failUnless(len(jobs[6].output.wpts) == 0)
+        self.failUnless(jobs[1].usage is None and jobs[0].usage.maxrss > 0)
+        self.failUnless(pool.usage.runs == 5 and pool.usage.user >= jobs[0].usage.user)
+        
+    def testIterBatchUnordered(self):
+        pool = gpsbabel.GPSBabelPool(3)
+        jobs = list(pool.iterBatch(iter(self.specs), parseOutput=False))
+        self.failUnless(sorted([job.index for job in jobs]) == range(4))
+        for job in jobs:
+            self.failUnless(job.error is None)
+            self.failUnless("WPT%d" % job.index in "".join(job.output))
+        
+    def testParseInWorkers(self):
+        pool = gpsbabel.GPSBabelPool(2, parsers=2)
+        try:
+            jobs = pool.runBatch(self.specs)
+        finally:
+            pool.close()
+        for i in xrange(4):
+            self.failUnless(jobs[i].error is None)
+            self.failUnless(jobs[i].output.wpts[0].name == "WPT%d" % i)
+        
+class GPSBabelExecutorTest(unittest.TestCase):
+    def setUp(self):
+        self.executor = gpsbabel.FakeExecutor()
+        self.gpx = '<gpx version="1.0">%s</gpx>' % "".join(['<wpt lat="45.0" lon="-70.%d"><name>WPT%d</name></wpt>' % (i, i) for i in xrange(3000)])
+        
+    def testFakeExecutor(self):
+        gps = gpsbabel.GPSBabel('gpsbabel-does-not-exist', executor=self.executor)
+        for inMemory in (True, False):
+            gps.setInGpx(self.gpx)
+            gps.captureStdOut(inMemory)
+            ret, res = gps.execCmd()
+            self.failUnless(ret == 0)
+            self.failUnless(res.wpts[-1].name == "WPT2999")
+        self.failUnless(len(self.executor.processes) == 2)
+        self.failUnless(self.executor.processes[0].cmd[0] == 'gpsbabel-does-not-exist')
+        self.failUnless(self.executor.processes[1].input == self.gpx)
+        gps.executor = gpsbabel.FakeExecutor(lambda cmd, data: (1, '', 'no such format'))
+        self.failUnlessRaises(RuntimeError, gps.execCmd, ['gpsbabel', '-i', 'foobarbaz'])
+        
+    def testDefaultExecutor(self):
+        saved = gpsbabel.defaultExecutor
+        try:
+            gpsbabel.defaultExecutor = self.executor
+            gps = gpsbabel.GPSBabel()
+            gps.setInGpx(self.gpx)
+            gps.addOutputFile('-')
+            self.failUnless(gps.execCmd(parseOutput=False, wait=False) is None)
+            ret, res = gps.waitCmd()
+            self.failUnless(ret == 0 and "".join(res) == self.gpx)
+            process = self.executor.spawn(['gpsbabel', '-V'])
+            process.terminate()
+            self.failUnless(process.poll() == -15 and process.stdout is None)
+        finally:
+            gpsbabel.defaultExecutor = saved
+        
+    def testLoopAndPool(self):
+        loop = gpsbabel.GPSBabelLoop()
+        gps = gpsbabel.AsyncGPSBabel(loop=loop, executor=self.executor)
+        gps.stdindata = self.gpx
+        run = gps.aread('-', 'gpx', wpt=True)
+        self.failUnless(len(run.result().wpts) == 3000)
+        pool = gpsbabel.GPSBabelPool(2, executor=self.executor)
+        jobs = pool.runBatch([[('setInGpx', self.gpx), ('captureStdOut', )]] * 3)
+        for job in jobs:
+            self.failUnless(job.error is None and job.output.wpts[0].name == "WPT0")
+            self.failUnless(job.timing is None)
+        self.failUnless(len(self.executor.processes) == 4)
+        timings = []
+        pool = gpsbabel.GPSBabelPool(2, executor=self.executor, observer=timings.append)
+        jobs = pool.runBatch([[('setInGpx', self.gpx), ('captureStdOut', True)]] * 3)
+        self.failUnless(sorted(timings) == sorted([job.timing for job in jobs]))
+        self.failUnless(jobs[0].timing.wpts == 3000 and jobs[0].timing.bytesOut == len(self.gpx))
+        
+class BrokenGPSBabel(gpsbabel.GPSBabel):
+    def execCmd(self, *args, **kwargs):
+        raise RuntimeError("gpsbabel should not have been run")
+        
+class CapabilityTest(unittest.TestCase):
+    def setUp(self):
+        self.cacheDir = gpsbabel.cacheDir
+        gpsbabel.cacheDir = tempfile.mkdtemp()
+        
+    def tearDown(self):
+        shutil.rmtree(gpsbabel.cacheDir)
+        gpsbabel.cacheDir = self.cacheDir
+        gpsbabel.refreshCapabilities()
+        
+    def testRefreshWritesCache(self):
+        gpsbabel.refreshCapabilities()
+        self.failUnless(gpsbabel.getVersion() is not None)
+        self.failUnless(os.path.exists(gpsbabel.capabilityCacheFile(gpsbabel.gps.gpsbabel)))
+        
+    def testLoadFromCache(self):
+        gpsbabel.refreshCapabilities()
+        version = gpsbabel.version
+        gpsbabel.loadCapabilities(BrokenGPSBabel(gpsbabel.gps.gpsbabel))
+        self.failUnless(gpsbabel.version == version)
+        self.failUnless("simplify" in gpsbabel.filters)
+        self.failUnless(gpsbabel.ftypes.has_key("gpx"))
+        self.failUnless("Latin-1" in gpsbabel.charsets["ISO-8859-1"])
+        
+    def testLoadFailure(self):
+        self.failUnlessRaises(RuntimeError, gpsbabel.loadCapabilities, BrokenGPSBabel(gpsbabel.gps.gpsbabel))
+        self.failIf(gpsbabel.ftypes.loaded)
+        self.failUnless("gpx" in gpsbabel.ftypes)
+        
+    def testThreads(self):
+        for d in (gpsbabel.ftypes, gpsbabel.filters, gpsbabel.charsets):
+            d.loaded = False
+            dict.clear(d)
+        errors = []
+        def read():
+            try:
+                self.failUnless("gpx" in gpsbabel.ftypes and "count" in gpsbabel.filters["simplify"])
+                self.failUnless(len(gpsbabel.charsets["ISO-8859-1"]) > 0)
+            except Exception, why:
+                errors.append(why)
+        threads = [threading.Thread(target=read) for i in xrange(8)]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+        self.failUnless(errors == [])
+        found = gpsbabel.readOpts(gpsbabel.gps, ({}, {}, {}))
+        self.failUnless(found[0] == dict(gpsbabel.ftypes) and found[2] == dict(gpsbabel.charsets))
+        
 class GPXWaypointTest(unittest.TestCase):
     def setUp(self):
         self.wpt = gpsbabel.GPXWaypoint()
@@ -252,6 +777,13 @@ class GPXWaypointTest(unittest.TestCase):
     def testToXml(self):
         self.wpt.name = "Test Wpt"
         self.failUnless(self.wpt.toXml('wpt') == '<wpt lat="None" lon="None"><name>Test Wpt</name></wpt>')
+
+    def testToXmlEscaping(self):
+        self.wpt.lat = Decimal("45.5")
+        self.wpt.lon = '"-70"'
+        self.wpt.time = datetime.datetime(2008, 8, 17, 18, 39, 0, 250000)
+        self.wpt.name = u"A & <B>"
+        self.failUnless(self.wpt.toXml('wpt') == u'<wpt lat="45.5" lon="&quot;-70&quot;"><time>2008-08-17T18:39:00.25Z</time><name>A &amp; &lt;B&gt;</name></wpt>')
         
 class GPXRouteTest(unittest.TestCase):
     def setUp(self):
@@ -276,6 +808,62 @@ class GPXTrackSegTest(unittest.TestCase):
         self.trkseg.trkpts.append(gpsbabel.GPXWaypoint())
         self.failUnless(self.trkseg.toXml() == '<trkseg><trkpt lat="None" lon="None"></trkpt></trkseg>')
 
+    def testMetrics(self):
+        for lat, lon, ele, secs in ((48.8566, 2.3522, 35, 0), (51.5074, -0.1278, 11, 3600), (51.5074, -0.1278, 20, 3600)):
+            wpt = gpsbabel.GPXWaypoint()
+            wpt.lat, wpt.lon, wpt.ele = Decimal(str(lat)), Decimal(str(lon)), Decimal(ele)
+            wpt.time = datetime.datetime(2008, 8, 17, 18, 0, 0) + datetime.timedelta(seconds=secs)
+            self.trkseg.trkpts.append(wpt)
+        numpy = gpsbabel.numpy
+        try:
+            for gpsbabel.numpy in set([numpy, None]):
+                for trkseg in (self.trkseg, gpsbabel.GPXTrackSeg()):
+                    if trkseg is not self.trkseg:
+                        trkseg.trkpts = gpsbabel.GPXColumns(self.trkseg.trkpts)
+                    lengths = trkseg.segmentLengths()
+                    self.failUnless(len(lengths) == 2)
+                    self.failUnless(abs(lengths[0] - 343556.5) < 1 and lengths[1] == 0)
+                    self.failUnless(abs(trkseg.segmentLengths('vincenty')[0] - 343923.1) < 1)
+                    self.failUnless(abs(trkseg.distance() - 343556.5) < 1)
+                    self.failUnless(list(trkseg.cumulativeDistance())[0] == 0)
+                    self.failUnless(abs(trkseg.speeds()[0] - 343556.5 / 3600) < 0.01)
+                    self.failUnless(trkseg.speeds()[1] != trkseg.speeds()[1])
+                    self.failUnless(abs(trkseg.bearings()[0] - 330.02) < 0.01)
+                    self.failUnless(trkseg.boundingBox() == (48.8566, -0.1278, 51.5074, 2.3522))
+                    self.failUnless(trkseg.elevationChange() == (9.0, 24.0))
+                    self.failUnless(trkseg.duration() == 3600)
+                self.failUnless(gpsbabel.GPXTrackSeg().boundingBox() is None)
+                self.failUnless(len(gpsbabel.GPXTrackSeg().cumulativeDistance()) == 0)
+                self.failUnlessRaises(gpsbabel.UnknownMethodException, self.trkseg.distance, 'foobarbaz')
+        finally:
+            gpsbabel.numpy = numpy
+
+    def testSimplify(self):
+        for lat, lon in ((45.0, -70.0), (45.001, -70.0), (45.002, -70.0001), (45.003, -70.01), (45.004, -70.0), (45.005, -70.0)):
+            wpt = gpsbabel.GPXWaypoint()
+            wpt.lat, wpt.lon = Decimal(str(lat)), Decimal(str(lon))
+            self.trkseg.trkpts.append(wpt)
+        self.trkseg.trkpts.insert(2, gpsbabel.GPXWaypoint())
+        numpy = gpsbabel.numpy
+        try:
+            for gpsbabel.numpy in set([numpy, None]):
+                for columnar in (False, True):
+                    trkseg = gpsbabel.GPXTrackSeg()
+                    trkseg.trkpts = self.trkseg.trkpts
+                    if columnar: trkseg.makeColumnar()
+                    self.failUnless(trkseg.simplify(count=3) == 4)
+                    self.failUnless([wpt.lat for wpt in trkseg.trkpts] == [Decimal("45.0"), Decimal("45.003"), Decimal("45.005")])
+                    trkseg.trkpts = self.trkseg.trkpts
+                    if columnar: trkseg.makeColumnar()
+                    trkseg.simplify(error=5)
+                    self.failUnless([wpt.lat for wpt in trkseg.trkpts] == [Decimal("45.0"), Decimal("45.002"), Decimal("45.003"),
+                                                                           Decimal("45.004"), Decimal("45.005")])
+                    self.failUnless(trkseg.simplify(count=10) == 0)
+            self.failUnless(len(self.trkseg.trkpts) == 7)
+            self.failUnlessRaises(ValueError, self.trkseg.simplify)
+        finally:
+            gpsbabel.numpy = numpy
+
 class GPXTrackTest(unittest.TestCase):
     def setUp(self):
         self.trk = gpsbabel.GPXTrack()
@@ -288,6 +876,45 @@ class GPXTrackTest(unittest.TestCase):
         self.trk.trksegs.append(gpsbabel.GPXTrackSeg())
         self.failUnless(self.trk.toXml('trk') == '<trk><name>Test Track</name><trkseg></trkseg></trk>')
        
+    def makeTrack(self, name, times, breaks=[]):
+        trk = gpsbabel.GPXTrack()
+        trk.name = name
+        for i in xrange(len(times)):
+            if i == 0 or i in breaks:
+                trk.trksegs.append(gpsbabel.GPXTrackSeg())
+            wpt = gpsbabel.GPXWaypoint()
+            wpt.lat, wpt.lon = Decimal(45), Decimal(-70)
+            wpt.time = datetime.datetime(2008, 8, 17, 23, 0, 0) + datetime.timedelta(seconds=times[i])
+            trk.trksegs[-1].trkpts.append(wpt)
+        return trk
+
+    def testTrackFilter(self):
+        numpy = gpsbabel.numpy
+        try:
+            for gpsbabel.numpy in set([numpy, None]):
+                for columnar in (False, True):
+                    gpx = gpsbabel.GPXData()
+                    gpx.trks = [self.makeTrack('A', [0, 60, 120, 1000, 1060], [3]), self.makeTrack('B', [30, 90, 90, 5000])]
+                    if columnar: gpx.makeColumnar()
+                    trk = gpsbabel.mergeTracks(gpx.trks, 'M')
+                    self.failUnless(trk.name == 'M' and len(trk.trksegs) == 1)
+                    self.failUnless([t - trk.times()[0] for t in trk.times()] == [0, 30, 60, 90, 120, 1000, 1060, 5000])
+                    self.failUnlessRaises(gpsbabel.TrackFilterException, gpsbabel.packTracks, gpx.trks)
+                    self.failUnless([[len(s.trkpts) for s in t.trksegs] for t in gpx.trks[0].split(300)] == [[3], [2]])
+                    self.failUnless([[len(s.trkpts) for s in t.trksegs] for t in gpx.trks[1].split()] == [[3], [1]])
+                    output = gpsbabel.trackFilter(gpx, {'move' : '+1h', 'start' : '200808180010', 'pack' : None})
+                    self.failUnless(len(output.trks) == 1 and output.trks[0].name == 'A')
+                    self.failUnless([len(s.trkpts) for s in output.trks[0].trksegs] == [2, 1])
+                    self.failUnless(output.trks[0].trksegs[0].trkpts[0].time == datetime.datetime(2008, 8, 18, 0, 16, 40))
+                    self.failUnless(gpx.trks[0].trksegs[0].trkpts[0].time == datetime.datetime(2008, 8, 17, 23, 0, 0))
+                    self.failUnless(gpsbabel.trackFilter(gpx, {'fix' : 'PPS'}) is None)
+                    self.failUnless(gpsbabel.trackFilter(gpx, {'split' : '5m'}) is None)
+        finally:
+            gpsbabel.numpy = numpy
+        self.failUnless(gpsbabel.parseTimeDelta('-1h30m') == -5400)
+        self.failUnless(gpsbabel.parseTimeLimit('200812', True) == 1230768000)
+        self.failUnlessRaises(ValueError, gpsbabel.parseTimeLimit, '08')
+
 class GPXDataTest(unittest.TestCase):
     def setUp(self):
         self.gpx = gpsbabel.GPXData()
@@ -300,7 +927,111 @@ class GPXDataTest(unittest.TestCase):
         self.gpx.wpts.append(gpsbabel.GPXWaypoint())
         self.gpx.trks.append(gpsbabel.GPXTrack())
         self.failUnless(self.gpx.toXml() == '<gpx version="1.1" creator="Python GPSBabel"><wpt lat="None" lon="None"></wpt><rte></rte><trk></trk></gpx>')
+
+    def testWriteTo(self):
+        for i in xrange(5000):
+            wpt = gpsbabel.GPXWaypoint()
+            wpt.lat = Decimal("45.0")
+            wpt.lon = Decimal("-70.0")
+            wpt.time = datetime.datetime(2008, 8, 17, 18, 39, i % 60)
+            wpt.name = u"\u00e9t\u00e9 %d" % i
+            self.gpx.wpts.append(wpt)
+        (fd, name) = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            f = open(name, 'wb')
+            self.gpx.writeTo(f)
+            f.close()
+            data = open(name, 'rb').read()
+        finally:
+            os.unlink(name)
+        self.failUnless(data == self.gpx.toXml().encode('utf-8'))
+        gd = gpsbabel.gpxParse(data)
+        self.failUnless(len(gd.wpts) == 5000)
+        self.failUnless(gd.wpts[-1].name == u"\u00e9t\u00e9 4999")
+        self.failUnless(gd.wpts[-1].time == datetime.datetime(2008, 8, 17, 18, 39, 19))
     
+    def testDuplicateRadius(self):
+        for name, lat, lon in (('A', 45.0, -70.0), ('B', 45.00001, -70.0), ('A', 45.01, -70.0), ('C', 46.0, -70.0), (None, 45.0, -70.00002)):
+            wpt = gpsbabel.GPXWaypoint()
+            wpt.name, wpt.lat, wpt.lon = name, Decimal(str(lat)), Decimal(str(lon))
+            self.gpx.wpts.append(wpt)
+        wpts = self.gpx.wpts
+        numpy = gpsbabel.numpy
+        try:
+            for gpsbabel.numpy in set([numpy, None]):
+                self.failUnless(gpsbabel.removeDuplicates(wpts, shortname=True) == [wpts[0], wpts[1], wpts[3], wpts[4]])
+                self.failUnless(gpsbabel.removeDuplicates(wpts, location=True) == wpts[0:1] + wpts[2:4])
+                self.failUnless(gpsbabel.removeDuplicates(wpts, location=True, all=True) == wpts[2:4])
+                self.failUnless(gpsbabel.removeDuplicates(wpts, shortname=True, location=True) == wpts)
+                output = gpsbabel.duplicateFilter(self.gpx, {'shortname' : None, 'correct' : None})
+                self.failUnless(output.wpts[0].lat == Decimal("45.01") and wpts[0].lat == Decimal("45.0"))
+                self.failUnless(gpsbabel.pointsWithin(wpts, 45.0, -70.0, 1200) == [wpts[0], wpts[1], wpts[4], wpts[2]])
+                self.failUnless(gpsbabel.pointsWithin(wpts, 45.0, -70.0, 1200, sort=False, maxcount=2) == wpts[0:2])
+                self.failUnless(gpsbabel.pointsWithin(wpts, 45.0, -70.0, 1200, exclude=True) == wpts[3:4])
+                output = gpsbabel.radiusFilter(self.gpx, {'lat' : '46', 'lon' : '-70', 'distance' : '1k', 'asroute' : 'Near'})
+                self.failUnless(output.wpts == [] and output.rtes[0].name == 'Near' and output.rtes[0].rtepts == wpts[3:4])
+                self.failUnless(gpsbabel.radiusFilter(self.gpx, {'lat' : '46'}) is None)
+                self.failUnless(gpsbabel.radiusFilter(self.gpx, {'lat' : '46', 'distance' : '1k'}) is None)
+                self.failUnless(gpsbabel.radiusFilter(self.gpx, {'lon' : '-70', 'distance' : '1k'}) is None)
+        finally:
+            gpsbabel.numpy = numpy
+
+class GPXIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.gpx = gpsbabel.GPXData()
+        for lat, lon in ((45.0, -70.0), (45.01, -70.0), (45.5, -70.5), (-33.9, 151.2), (10.0, 179.95), (10.0, -179.95)):
+            wpt = gpsbabel.GPXWaypoint()
+            wpt.lat, wpt.lon = Decimal(str(lat)), Decimal(str(lon))
+            self.gpx.wpts.append(wpt)
+        self.gpx.wpts.append(gpsbabel.GPXWaypoint())
+        self.index = gpsbabel.GPXIndex()
+        self.index.addGpx(self.gpx)
+
+    def testQueries(self):
+        wpts = self.gpx.wpts
+        self.failUnless(len(self.index) == 6)
+        self.failUnless(self.index.boundingBox(44.9, -70.1, 45.1, -69.9) == wpts[0:2])
+        self.failUnless(set(self.index.boundingBox(9, 179, 11, -179)) == set(wpts[4:6]))
+        found = self.index.radius(45.0, -70.0, 2000)
+        self.failUnless([item for d, item in found] == wpts[0:2])
+        self.failUnless(found[0][0] == 0 and abs(found[1][0] - 1111.95) < 0.01)
+        self.failUnless(self.index.radius(10.0, 179.99, 5000)[0][1] is wpts[4])
+        self.failUnless(len(self.index.radius(10.0, 179.99, 10000)) == 2)
+        self.failUnless([item for d, item in self.index.nearest(45.4, -70.4, 3)] == [wpts[2], wpts[1], wpts[0]])
+        self.failUnless(self.index.nearest(-30, 150)[0][1] is wpts[3])
+        self.failUnless(len(self.index.nearest(0, 0, 10)) == 6)
+
+    def testInsertRemove(self):
+        self.index.remove(self.gpx.wpts[0])
+        self.failUnless(self.index.boundingBox(44.9, -70.1, 45.1, -69.9) == self.gpx.wpts[1:2])
+        self.failUnlessRaises(ValueError, self.index.remove, self.gpx.wpts[0])
+        self.index.insert('home', 45.0, -70.0)
+        self.failUnless(self.index.nearest(45.0, -70.0)[0][1] == 'home')
+        self.failUnless(len(self.index) == 6)
+
+    def testSaveLoad(self):
+        trkseg = gpsbabel.GPXTrackSeg()
+        trkseg.trkpts = gpsbabel.GPXColumns(self.gpx.wpts[:3])
+        self.gpx.trks.append(gpsbabel.GPXTrack())
+        self.gpx.trks[0].trksegs.append(trkseg)
+        self.index.addGpx(self.gpx, wpts=False, trkpts=True)
+        self.failUnless(len(self.index) == 9)
+        (fd, name) = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            f = open(name, 'wb')
+            self.index.save(f, self.gpx)
+            f.close()
+            index = gpsbabel.loadIndex(open(name, 'rb'), self.gpx)
+        finally:
+            os.unlink(name)
+        self.failUnless(len(index) == 9)
+        found = [item for d, item in index.radius(45.5, -70.5, 10)]
+        self.failUnless(len(found) == 2)
+        self.failUnless(self.gpx.wpts[2] in found and (trkseg.trkpts, 2) in found)
+        self.failUnlessRaises(ValueError, index.save, open(os.devnull, 'wb'), gpsbabel.GPXData())
+
 class GPXParserTest(unittest.TestCase):
     def testParseWaypoint(self):
         gd = gpsbabel.gpxParse(
@@ -408,4 +1139,143 @@ class GPXParserTest(unittest.TestCase):
         self.failUnless(wpt.lat == Decimal("40.727884769"))
         self.failUnless(wpt.lon == Decimal("-75.115907192"))
         self.failUnless(wpt.ele == Decimal("310.162476"))
-        self.failUnless(wpt.time == datetime.datetime(2008, 8, 17, 18, 39, 00))
\ No newline at end of file
+        self.failUnless(wpt.time == datetime.datetime(2008, 8, 17, 18, 39, 00))
+
+    def testIterGpx(self):
+        gpx = """<gpx version="1.0"><wpt lat="45.0" lon="-70.0"><name>WPT1</name></wpt>
+<trk><name>TRK1</name><number>1</number><trkseg><trkpt lat="45.0" lon="-70.0"/><trkpt lat="45.1" lon="-70.1"/></trkseg>
+<trkseg><trkpt lat="45.2" lon="-70.2"/></trkseg></trk></gpx>"""
+        (fd, name) = tempfile.mkstemp()
+        os.write(fd, gpx)
+        os.close(fd)
+        try:
+            for source in (name, open(name), [gpx[i:i + 10] for i in xrange(0, len(gpx), 10)]):
+                items = list(gpsbabel.iterGpx(source))
+                self.failUnless(len(items) == 2)
+                self.failUnless(items[0].name == "WPT1")
+                self.failUnless(items[1].name == "TRK1")
+                self.failUnless(items[1].number == 1)
+                self.failUnless(len(items[1].trksegs[1].trkpts) == 1)
+        finally:
+            os.unlink(name)
+    
+    def testIterGpxPoints(self):
+        gpx = """<gpx version="1.0"><trk><name>TRK1</name><trkseg><trkpt lat="45.0" lon="-70.0"/><trkpt lat="45.1" lon="-70.1"/></trkseg>
+<trkseg><trkpt lat="45.2" lon="-70.2"/></trkseg></trk></gpx>"""
+        items = list(gpsbabel.iterGpx([gpx], points=True))
+        self.failUnless(len(items) == 3)
+        self.failUnless([pt.lat for trk, seg, pt in items] == [Decimal("45.0"), Decimal("45.1"), Decimal("45.2")])
+        self.failUnless(items[0][0].name == "TRK1")
+        self.failUnless(items[0][1] is items[1][1])
+        self.failIf(items[1][1] is items[2][1])
+        self.failUnless(len(items[0][1].trkpts) == 0)
+
+    def testExpatParser(self):
+        gpx = """<?xml version="1.0" encoding="UTF-8"?>
+<gpx version="1.0" creator="GPSBabel - http://www.gpsbabel.org" xmlns="http://www.topografix.com/GPX/1/0">
+<time>2008-10-22T18:21:23Z</time>
+<bounds minlat="40.515346527" minlon="-75.142643452" maxlat="40.826461315" maxlon="-74.611737728"/>
+<wpt lat="40.735149952" lon="-75.088833310"><ele>-0.114380</ele><NAME>GC187W</NAME><cmt>A &amp; B</cmt><sat>4</sat><url>http://example.com/</url></wpt>
+<rte><name>RTE1</name><number>2</number><rtept lon="-75.1" lat="40.1"><name>RP1</name></rtept><rtept lat="40.2" lon="-75.2"/></rte>
+<trk><name>ACTIVE LOG #2</name><number>1</number><trkseg>
+<trkpt lat="40.727884769" lon="-75.115907192"><ele>310.162476</ele><time>2008-08-17T18:39:00Z</time></trkpt>
+<trkpt lat="40.727884770" lon="-75.115907193"><ele>310</ele><time>2008-08-17T18:39:05Z</time></trkpt>
+</trkseg></trk>
+</gpx>
+"""
+        gd = gpsbabel.gpxParse(gpx, parser='expat')
+        self.failUnless(gd.wpts[0].name == "GC187W")
+        self.failUnless(gd.wpts[0].cmt == "A & B")
+        self.failUnless(gd.wpts[0].sat == 4)
+        self.failUnless(gd.rtes[0].number == 2)
+        self.failUnless(gd.rtes[0].rtepts[0].lat == Decimal("40.1"))
+        self.failUnless(gd.trks[0].trksegs[0].trkpts[1].time == datetime.datetime(2008, 8, 17, 18, 39, 5))
+        gpx = gpx.replace("<url>http://example.com/</url>", "")
+        self.failUnless(gd.toXml() == gpsbabel.gpxParse(gpx).toXml())
+        self.failUnless(gd.toXml() == gpsbabel.gpxParse(bytearray(gpx), parser='expat').toXml())
+        items = list(gpsbabel.iterGpx([gpx[i:i + 7] for i in xrange(0, len(gpx), 7)], True, 'expat'))
+        self.failUnless(len(items) == 4)
+        self.failUnless(items[-1][2].ele == Decimal("310"))
+
+    def testUnknownParser(self):
+        self.failUnlessRaises(gpsbabel.UnknownParserException, gpsbabel.gpxParse, "<gpx/>", parser='foobarbaz')
+
+    def testColumnar(self):
+        gpx = """<gpx version="1.0"><rte><name>RTE1</name><rtept lat="40.1" lon="-75.1"><name>RP1</name></rtept><rtept lat="40.2" lon="-75.2"/></rte>
+<trk><name>TRK1</name><trkseg><trkpt lat="45.5" lon="-70.25"><ele>310.5</ele><time>2008-08-17T18:39:00Z</time><sat>4</sat></trkpt>
+<trkpt lat="45.75" lon="-70.5"><time>2008-08-17T18:39:05Z</time></trkpt></trkseg></trk></gpx>"""
+        for parser in gpsbabel.gpxParsers:
+            gd = gpsbabel.gpxParse(gpx, parser=parser, columnar=True)
+            trkpts = gd.trks[0].trksegs[0].trkpts
+            self.failUnless(isinstance(trkpts, gpsbabel.GPXColumns))
+            self.failUnless(len(trkpts) == 2)
+            self.failUnless(list(trkpts.column('lat')) == [45.5, 45.75])
+            self.failUnless(trkpts[0].ele == Decimal("310.5"))
+            self.failUnless(trkpts[0].sat == 4)
+            self.failUnless(trkpts[-1].time == datetime.datetime(2008, 8, 17, 18, 39, 5))
+            self.failUnless(trkpts[1].ele is None)
+            self.failUnless([pt.lon for pt in trkpts] == [Decimal("-70.25"), Decimal("-70.5")])
+            rtepts = gd.rtes[0].rtepts
+            self.failUnless(rtepts[0].name == "RP1")
+            self.failUnless(rtepts[1].name is None)
+            self.failUnless(rtepts[0].xmltag == 'rtept')
+            other = gpsbabel.gpxParse(gpx, parser=parser)
+            self.failUnless(gd.toXml() == other.toXml())
+            other.makeColumnar()
+            self.failUnless(gd.toXml() == other.toXml())
+        self.failUnlessRaises(IndexError, trkpts.__getitem__, 2)
+        gpx = gpx.replace('<sat>4</sat>', '<SAT>4</SAT><cmt>A &amp; B</cmt>')
+        parsed = [gpsbabel.gpxParse(gpx, parser=parser, columnar=True) for parser in ('sax', 'expat')]
+        for gd in parsed:
+            self.failUnless(gd.trks[0].trksegs[0].trkpts[0].sat == 4 and gd.trks[0].trksegs[0].trkpts[0].cmt == "A & B")
+        for sax, expat in ((parsed[0].rtes[0].rtepts, parsed[1].rtes[0].rtepts),
+                           (parsed[0].trks[0].trksegs[0].trkpts, parsed[1].trks[0].trksegs[0].trkpts)):
+            self.failUnless(sax.extras == expat.extras and repr(sax.arrays) == repr(expat.arrays))
+
+    def testLazy(self):
+        gpx = """<gpx version="1.0"><wpt lat="45.0" lon="-70.0"><time>2008-08-17T18:39:00Z</time><sat>4</sat><hdop>1.5</hdop></wpt>
+<rte><number>2</number><rtept lat="40.1" lon="-75.1"/></rte><trk><number>1</number><trkseg><trkpt lat="45.5" lon="-70.25"/></trkseg></trk></gpx>"""
+        for parser in gpsbabel.gpxParsers:
+            gd = gpsbabel.gpxParse(gpx, parser=parser, lazy=True)
+            wpt = gd.wpts[0]
+            self.failUnless(isinstance(wpt, gpsbabel.GPXLazyWaypoint))
+            self.failUnless(wpt.lat == Decimal("45.0"))
+            self.failUnless(wpt.lat is wpt.lat)
+            self.failUnless(wpt.time == datetime.datetime(2008, 8, 17, 18, 39, 0))
+            self.failUnless(wpt.sat == 4)
+            self.failUnless(wpt.ele is None)
+            self.failUnless(gd.rtes[0].number == 2)
+            self.failUnless(gd.rtes[0].rtepts[0].lon == Decimal("-75.1"))
+            self.failUnless(gd.trks[0].number == 1)
+            self.failUnless(gd.trks[0].trksegs[0].trkpts[0].lat == Decimal("45.5"))
+            self.failUnless(gd.toXml() == gpsbabel.gpxParse(gpx, parser=parser).toXml())
+            wpt.hdop = "2.5"
+            self.failUnless(wpt.hdop == Decimal("2.5"))
+
+    def testParseTime(self):
+        utc = datetime.datetime(2008, 8, 17, 18, 39, 0)
+        for value in ("2008-08-17T18:39:00Z", "2008-08-17T14:39:00-04:00", "2008-08-17T20:09:00+0130", " 2008-08-17T18:39:00 "):
+            self.failUnless(gpsbabel.parseTime(value) == utc)
+            self.failUnless(gpsbabel.parseEpoch(value) == 1218998340)
+        self.failUnless(gpsbabel.parseTime("2008-08-17T18:39:00.25Z") == datetime.datetime(2008, 8, 17, 18, 39, 0, 250000))
+        self.failUnless(gpsbabel.parseEpoch("2008-08-17T18:39:00.25Z") == 1218998340.25)
+        self.failUnless(gpsbabel.parseTime("2008-08-17T18:39:07Z") == datetime.datetime(2008, 8, 17, 18, 39, 7))
+        for value in ("2008-08-17", "2008-08-17T18:39:00X", "2008-13-17T18:39:00Z"):
+            self.failUnlessRaises(ValueError, gpsbabel.parseTime, value)
+
+class GPSBabelBenchTest(unittest.TestCase):
+    def testMakeGpx(self):
+        shape = {'wpts' : 3, 'rtes' : 2, 'rtepts' : 4, 'trks' : 2, 'trksegs' : 3, 'trkpts' : 5}
+        data = GPSBabelBench.makeGpx(**shape)
+        self.failUnless(data == GPSBabelBench.makeGpx(**shape))
+        gpx = gpsbabel.gpxParse(data)
+        self.failUnless(len(gpx.wpts) == 3 and len(gpx.rtes) == 2 and len(gpx.trks) == 2)
+        self.failUnless(len(gpx.rtes[1].rtepts) == 4 and len(gpx.trks[1].trksegs) == 3)
+        self.failUnless(len(gpx.trks[1].trksegs[2].trkpts) == 5)
+        self.failUnless(GPSBabelBench.countPoints(shape) == 41)
+
+    def testParserSpeedups(self):
+        results = [{'name' : 'parse-sax', 'itemsPerSecond' : 100.0}, {'name' : 'parse-expat', 'itemsPerSecond' : 150.0},
+                   {'name' : 'parse-sax-columnar', 'itemsPerSecond' : 100.0}, {'name' : 'parse-expat-columnar', 'error' : []},
+                   {'name' : 'parse-expat-lazy', 'itemsPerSecond' : 300.0}]
+        self.failUnless(GPSBabelBench.parserSpeedups(results) == {'eager' : 1.5})
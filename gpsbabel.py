@@ -18,21 +18,72 @@ The module properties are as follows:
     * banner:     The full GPSBabel version string
     * version:    The portion of the version string which just is the
                   version (e.g.: 1.3.5), or None if it could not found.
+    * cacheDir:   The directory the above are cached in between runs, or
+                  None to disable the cache.
     * gps:        An instance of the GPSBabel object, pre-made and ready
                   for use.
+    * defaultLoop: The GPSBabelLoop used by AsyncGPSBabel instances which
+                  are not given one.
+    * defaultExecutor: The GPSBabelExecutor used by GPSBabel instances
+                  which are not given one. Replace it to change how every
+                  such instance starts gpsbabel.
+    * monotonic:  A function returning the time in seconds on a clock
+                  which never goes backwards. GPSBabelTiming reads it.
+    * inProcessFilters: The filters which can be run in-process on a
+                  GPXData, rather than by gpsbabel. See GPSBabel.execCmd.
+
+Importing the module does not run gpsbabel. ftypes, filters and charsets
+are filled in the first time one of them is read, from the cache in
+cacheDir if gpsbabel has not changed since it was written, and by running
+gpsbabel otherwise. banner and version are filled in at the same time; use
+getVersion() to read the version, loadCapabilities() to load everything up
+front, or refreshCapabilities() to ignore the cache.
 
 The classes in this module are grouped as follows:
     * GPSBabel: The wrapper around the gpsbabel command line
+    * ConversionPlan: A chain built and checked once, then run many times
+      with different file names, from any number of threads.
+    * ConversionCache: Remembers results, in memory and on disk, so that
+      repeating a conversion of the same input does not run gpsbabel.
+    * AsyncGPSBabel, GPSBabelLoop, GPSBabelRun: Run many gpsbabel commands
+      concurrently from a single thread, without blocking on any of them.
+    * GPSBabelPool, GPSBabelJob: Run batches of conversion chains with a
+      bounded number of gpsbabel processes at once.
+    * GPSBabelTiming: Where the time of a run went, stage by stage, and
+      how much data it moved. Set GPSBabel.timed or GPSBabel.observer to
+      record it.
+    * GPSBabelUsage: The CPU time, peak memory and wall time of gpsbabel,
+      for one run or added up over many.
+    * GPSBabelExecutor, SubprocessExecutor, FakeExecutor, FakeProcess,
+      AccountedPopen: Start the processes gpsbabel runs in. Subclass GPSBabelExecutor to
+      run it some other way, or use FakeExecutor to test without it.
     * GPXData, GPXWaypoint, GPXRoute, GPXTrackSeg, GPXTreck: These classes
       represent the various components of a GPX file that can/will be
       captured/used by other tools. View the help from GPXData to see the
       expected hierarchy of objects and values.
+    * GPXColumns: Compact storage for the points of a large track segment
+      or route, one array per field rather than one object per point.
+      Pass columnar=True when parsing to use it.
+    * GPXLazyWaypoint, GPXLazyRoute, GPXLazyTrack: Versions of the classes
+      above which convert each field from text only when it is first read.
+      Pass lazy=True when parsing to use them.
+    * GPXPointMetrics: Distance, speed, bearing, bounding box and
+      elevation of the points of a GPXRoute or GPXTrackSeg, computed over
+      whole columns at once, with NumPy if it is installed. Also
+      simplifies them, as gpsbabel's simplify filter does, and shifts
+      and cuts them by time, as its track filter does.
+    * GPXIndex: A grid of the points of a GPXData, for finding those within
+      a bounding box or distance, or nearest to a position, without
+      looking at every point. Use loadIndex to read back a saved one.
     * *Exception: Custom exception classes that can be raised for specific
       error conditions when trying to run GPSBabel.
-    * GPXParser: The class that parses GPX files.
+    * GPXParser, GPXExpatParser: The classes that parse GPX files. The
+      first uses xml.sax, and the second pyexpat directly, which is faster.
 
 There is also the utility method "gpxParse" which is used to actually parse
 a gpx string into the GPX classes above, and which uses the GPXParser class.
+For GPX too large to hold in memory at once, "iterGpx" parses a file or
+stream a piece at a time, generating each item as it is read.
 
 Examples of usage:
 * Store waypoints, routes, and tracks in file 'mydata.gpx' on a Garmin GPS
@@ -82,6 +133,25 @@ Examples of usage:
     while gps.checkCmd() == None: pass
     (retcode, gpxd) = gps.endCmd()
 
+  Once the GUI has nothing else to do, it can block on the remainder of the
+  run without spinning:
+    (retcode, gpxd) = gps.waitCmd()
+
+* Read several kml files at once, from a single thread
+    loop = GPSBabelLoop()
+    runs = []
+    for fname in ['one.kml', 'two.kml', 'three.kml']:
+        runs.append(AsyncGPSBabel(loop=loop).aread(fname, 'kml', wpt=True))
+    loop.run()
+    gpxds = [run.result() for run in runs]
+
+* Convert a batch of kml files to gpx, four at a time
+    pool = GPSBabelPool(4)
+    specs = [[('addInputFile', fname, 'kml'), ('captureStdOut',)]
+             for fname in ['one.kml', 'two.kml', 'three.kml']]
+    for job in pool.iterBatch(specs):
+        if job.error is None: print job.index, len(job.output.wpts)
+
 """
 """
 Python-GPSBabel - Python wrapper for GPSBabel project
@@ -101,18 +171,52 @@ You should have received a copy of the GNU General Public License along
 with this program; if not, write to the Free Software Foundation, Inc.,
 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 """
+import array
+import bisect
+import calendar
+import copy
 import datetime
+import fnmatch
+import heapq
+import itertools
+import math
 import os
 import os.path
+import re
 import select
+import string
 import subprocess
 import tempfile
+import threading
 import time
+import xml.parsers.expat
 import xml.sax
 import xml.sax.handler
+import xml.sax.saxutils
 
 from decimal import Decimal
 
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    from hashlib import md5, sha256 as sha
+except ImportError:
+    from md5 import new as md5
+    from sha import new as sha
+
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 # Following code shamelessly copied from http://code.activestate.com/recipes/440554/ as of Thu, Dec 11, 2008.
 import os
@@ -153,7 +257,12 @@ class Popen(subprocess.Popen):
             getattr(self, which).close()
             setattr(self, which, None)
 
+    _nonblocking = False
+
     if subprocess.mswindows:
+        def set_nonblocking(self):
+            pass
+
         def send(self, input):
             if not self.stdin:
                 return None
@@ -194,6 +303,13 @@ class Popen(subprocess.Popen):
             return read
 
     else:
+        def set_nonblocking(self):
+            for conn in (self.stdin, self.stdout, self.stderr):
+                if conn is not None and not conn.closed:
+                    flags = fcntl.fcntl(conn, fcntl.F_GETFL)
+                    fcntl.fcntl(conn, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+            self._nonblocking = True
+
         def send(self, input):
             if not self.stdin:
                 return None
@@ -206,6 +322,8 @@ class Popen(subprocess.Popen):
             except OSError, why:
                 if why[0] == errno.EPIPE: #broken pipe
                     return self._close('stdin')
+                if why[0] == errno.EAGAIN: #pipe full, and non-blocking
+                    return 0
                 raise
 
             return written
@@ -215,9 +333,12 @@ class Popen(subprocess.Popen):
             if conn is None:
                 return None
 
-            flags = fcntl.fcntl(conn, fcntl.F_GETFL)
-            if not conn.closed:
-                fcntl.fcntl(conn, fcntl.F_SETFL, flags| os.O_NONBLOCK)
+            if self._nonblocking:
+                flags = None
+            else:
+                flags = fcntl.fcntl(conn, fcntl.F_GETFL)
+                if not conn.closed:
+                    fcntl.fcntl(conn, fcntl.F_SETFL, flags| os.O_NONBLOCK)
 
             try:
                 if not select.select([conn], [], [], 0)[0]:
@@ -231,7 +352,7 @@ class Popen(subprocess.Popen):
                     r = self._translate_newlines(r)
                 return r
             finally:
-                if not conn.closed:
+                if flags is not None and not conn.closed:
                     fcntl.fcntl(conn, fcntl.F_SETFL, flags)
 
 message = "Other end disconnected!"
@@ -255,6 +376,441 @@ def which(cmd):
                 return f
     return None
 
+class GPSBabelExecutor(object):
+    """
+    Starts the processes which GPSBabel runs its commands in. GPSBabel
+    hands every command line to an executor rather than starting gpsbabel
+    itself, so that gpsbabel can be run some other way (on another
+    machine, in a sandbox, or not at all, in tests) by passing GPSBabel a
+    different executor.
+
+    An executor only needs to provide spawn. The process it returns must
+    behave like the Popen class above:
+        * stdin, stdout, stderr: Not None while the pipe is open. If
+          selectable is True, they are files which can be passed to select
+          and os.read.
+        * selectable: If False, the pipes are never selected on, and the
+          process is instead polled, using send, recv and recv_err.
+        * returncode, poll(), wait(): As for subprocess.Popen
+        * send(data): Write what can be written of data to stdin without
+          blocking, and return how much was written, or None if stdin is
+          closed.
+        * recv(maxsize), recv_err(maxsize): Read what is available of
+          stdout or stderr without blocking, or None if it is closed.
+        * _close(which): Close 'stdin', 'stdout' or 'stderr'. Closing
+          stdin tells the process all of its input has been sent.
+        * terminate(), kill(): Stop the process.
+        * usage: Optional. Once the process has been reaped, a
+          resource.struct_rusage of what it used, or None if that is not
+          known. See GPSBabelUsage.
+    """
+
+    def spawn(self, cmd):
+        """
+        Start a command.
+
+        In:
+            cmd: The command line, as a list
+
+        Out:
+            The process running it
+        """
+        raise NotImplementedError
+
+class AccountedPopen(Popen):
+    """
+    A Popen which is reaped with os.wait4, where there is one, so that the
+    CPU time and memory the process used are kept in usage.
+    """
+
+    usage = None
+
+    def poll(self):
+        return self.__reap(os.WNOHANG) if hasattr(os, 'wait4') else Popen.poll(self)
+
+    def wait(self):
+        return self.__reap(0) if hasattr(os, 'wait4') else Popen.wait(self)
+
+    def __reap(self, options):
+        if self.returncode is not None:
+            return self.returncode
+        while True:
+            try:
+                pid, status, usage = os.wait4(self.pid, options)
+                break
+            except OSError, why:
+                if why[0] == errno.EINTR:
+                    continue
+                if why[0] != errno.ECHILD:
+                    raise
+                #The process has already been reaped by someone else, so
+                #its exit code is lost, as subprocess assumes.
+                self.returncode = 0
+                return self.returncode
+        if pid == 0:
+            return None
+        self.usage = usage
+        self._handle_exitstatus(status)
+        return self.returncode
+
+class SubprocessExecutor(GPSBabelExecutor):
+    """
+    Runs commands as local processes, with non-blocking pipes. This is the
+    executor GPSBabel uses unless it is given another.
+    """
+
+    def spawn(self, cmd):
+        gps = AccountedPopen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             close_fds=not subprocess.mswindows)
+        gps.universal_newlines = True
+        gps.selectable = not subprocess.mswindows
+        gps.set_nonblocking()
+        return gps
+
+class FakeExecutor(GPSBabelExecutor):
+    """
+    Runs commands in memory, without starting any process, for testing code
+    which uses GPSBabel where gpsbabel is not installed.
+
+    Each command is handled once all of its stdin has been sent, by calling
+    handler(cmd, data), where data is everything that was sent on stdin.
+    It returns (returncode, stdout, stderr). The default handler copies the
+    -f input file (or stdin, if that is '-') to the -F output file (or
+    stdout, if that is '-'), as gpsbabel does when converting GPX to GPX.
+
+    Instance variables:
+        * handler:   The function which handles each command
+        * processes: The FakeProcess of every command spawned, in order.
+                     Each has the cmd it was spawned with, and the input
+                     sent to it on stdin once that has been closed.
+    """
+
+    def __init__(self, handler=None):
+        """
+        Constructor.
+
+        In:
+            handler: See the instance variables. Default: copy the input
+                to the output
+        """
+        self.handler = handler if handler is not None else self.copy
+        self.processes = []
+
+    def spawn(self, cmd):
+        gps = FakeProcess(cmd, self.handler)
+        self.processes.append(gps)
+        return gps
+
+    def copy(self, cmd, data):
+        infile = outfile = '-'
+        for i in xrange(len(cmd) - 1):
+            if cmd[i] == '-f': infile = cmd[i + 1]
+            elif cmd[i] == '-F': outfile = cmd[i + 1]
+        if infile != '-':
+            data = open(infile, 'rb').read()
+        if outfile == '-':
+            return (0, data, '')
+        f = open(outfile, 'wb')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        return (0, '', '')
+
+class FakeProcess(object):
+    """
+    A command run by a FakeExecutor. See GPSBabelExecutor for what each
+    method does.
+    """
+
+    selectable = False
+    universal_newlines = False
+    pid = None
+
+    def __init__(self, cmd, handler):
+        self.cmd = cmd
+        self.input = None
+        self.returncode = None
+        self.stdin = []
+        self.stdout = self.stderr = ''
+        self.__handler = handler
+        self.__offsets = {'stdout' : 0, 'stderr' : 0}
+
+    def send(self, input):
+        if self.stdin is None:
+            return None
+        self.stdin.append(input)
+        return len(input)
+
+    def recv(self, maxsize=None):
+        return self.__recv('stdout', maxsize)
+
+    def recv_err(self, maxsize=None):
+        return self.__recv('stderr', maxsize)
+
+    def __recv(self, which, maxsize):
+        data = getattr(self, which)
+        if data is None:
+            return None
+        if self.returncode is None:
+            return ''
+        start = self.__offsets[which]
+        end = start + (maxsize or 1024)
+        self.__offsets[which] = end
+        if start >= len(data):
+            setattr(self, which, None)
+        return data[start:end]
+
+    def _close(self, which):
+        if which == 'stdin' and self.stdin is not None:
+            self.input = ''.join(self.stdin)
+            self.stdin = None
+            self.returncode, self.stdout, self.stderr = self.__handler(self.cmd, self.input)
+        else:
+            setattr(self, which, None)
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self):
+        self._close('stdin')
+        return self.returncode
+
+    def terminate(self):
+        self.__stop(-15)
+
+    def kill(self):
+        self.__stop(-9)
+
+    def __stop(self, returncode):
+        #Like a process killed by a signal, exit with minus the signal
+        #number, without having handled the command.
+        if self.returncode is None:
+            self.returncode = returncode
+        self.stdin = self.stdout = self.stderr = None
+
+def _monotonicClock():
+    """
+    Out:
+        A function returning the seconds on a clock which never goes
+        backwards, for timing runs. Python 2 has no time.monotonic, so
+        clock_gettime is used through ctypes where it can be, and
+        time.time otherwise.
+    """
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    if not sys.platform.startswith('linux'):
+        return time.time
+    try:
+        import ctypes
+        import ctypes.util
+        clock_gettime = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c')).clock_gettime
+    except (ImportError, OSError, AttributeError):
+        return time.time
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+    CLOCK_MONOTONIC = 1
+    def monotonic():
+        t = timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+            return time.time()
+        return t.tv_sec + t.tv_nsec * 1e-9
+    return monotonic
+
+monotonic = _monotonicClock()
+
+class GPSBabelUsage(object):
+    """
+    The resources used by one or more runs of gpsbabel. See GPSBabel.usage
+    and GPSBabelPool.usage.
+
+    Instance variables:
+        * wall:   Seconds from starting gpsbabel until it was seen to have
+                  exited, added up over the runs
+        * user:   Seconds of CPU time spent by gpsbabel itself, added up
+                  over the runs, or None if it is not known for every run
+        * system: Seconds of CPU time spent by the kernel on behalf of
+                  gpsbabel, as for user
+        * maxrss: The largest peak resident set size of any of the runs,
+                  in bytes, or None if it is not known for any run
+        * runs:   The number of runs
+    """
+
+    def __init__(self, wall=0.0, rusage=None, runs=1):
+        """
+        Constructor.
+
+        In:
+            wall: See the instance variables
+            rusage: The resource.struct_rusage of the run, as returned by
+                os.wait4, or None if it is not known
+            runs: See the instance variables. Pass 0 to start a total
+                which runs are added to.
+        """
+        self.wall   = wall
+        self.user   = None
+        self.system = None
+        self.maxrss = None
+        self.runs   = runs
+        if rusage is not None:
+            self.user   = rusage.ru_utime
+            self.system = rusage.ru_stime
+            #Linux reports kilobytes, and Mac OS X bytes
+            self.maxrss = rusage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+        elif runs == 0:
+            self.user = self.system = 0.0
+
+    def cpu(self):
+        """
+        Out:
+            user plus system, or None if either is not known
+        """
+        if self.user is None or self.system is None:
+            return None
+        return self.user + self.system
+
+    def add(self, other):
+        """
+        Add the runs of another GPSBabelUsage to this one.
+        """
+        self.wall += other.wall
+        if self.user is not None and other.user is not None:
+            self.user += other.user
+            self.system += other.system
+        else:
+            self.user = self.system = None
+        if self.maxrss is None or (other.maxrss is not None and other.maxrss > self.maxrss):
+            self.maxrss = other.maxrss
+        self.runs += other.runs
+
+class GPSBabelTiming(object):
+    """
+    Where the time of one run of GPSBabel.execCmd went, and how much it
+    moved. See GPSBabel.timed.
+
+    The stages of a run are:
+        * filter:   Running filters in-process, before gpsbabel. See
+                    GPSBabel.inProcess.
+        * spawn:    Starting gpsbabel
+        * stdin:    Sending stdindata, until stdin is closed
+        * gpsbabel: From gpsbabel starting until it is seen to have exited
+        * read:     Reading the output. When it is captured through a
+                    pipe, this is from gpsbabel starting until the pipe is
+                    drained; when it is captured in a file, it is the time
+                    to read the file.
+        * parse:    Parsing the output. When it is parsed as it is read,
+                    this is from the first piece parsed to the last.
+        * finalize: Finishing the parsed GPXData
+
+    Stages can overlap, since gpsbabel is fed, read and parsed at the same
+    time. A stage which did not happen (such as parse, when parseOutput is
+    False) has no mark.
+
+    Instance variables:
+        * cmd:        The command line run, or None if gpsbabel was not run
+        * marks:      A dictionary of stage to [start, end], both read from
+                      monotonic()
+        * bytesIn:    The number of bytes sent on stdin
+        * bytesOut:   The number of bytes of output read
+        * wpts, rtes, trks, points: How many waypoints, routes, tracks,
+                      and route and track points were in the parsed
+                      output, or None if it was not parsed
+        * cached:     True if the result came from the cache, or from
+                      running the filters in-process, and not gpsbabel
+        * returncode: The exit code of gpsbabel
+        * error:      The exception the run raised, or None
+        * usage:      The GPSBabelUsage of gpsbabel, or None if it was not
+                      run
+    """
+
+    stages = ['filter', 'spawn', 'stdin', 'gpsbabel', 'read', 'parse', 'finalize']
+    """
+    The stages of a run, in the order they start.
+    """
+
+    def __init__(self, cmd=None):
+        """
+        Constructor.
+        """
+        self.cmd        = cmd
+        self.marks      = {}
+        self.bytesIn    = 0
+        self.bytesOut   = 0
+        self.wpts       = None
+        self.rtes       = None
+        self.trks       = None
+        self.points     = None
+        self.cached     = False
+        self.returncode = None
+        self.error      = None
+        self.usage      = None
+
+    def start(self, stage, now=None):
+        """
+        Mark the start of a stage, unless it has already started.
+        """
+        if stage not in self.marks:
+            self.marks[stage] = [now if now is not None else monotonic(), None]
+
+    def stop(self, stage, now=None):
+        """
+        Mark the end of a stage, unless it has not started or has already
+        ended.
+        """
+        mark = self.marks.get(stage)
+        if mark is not None and mark[1] is None:
+            mark[1] = now if now is not None else monotonic()
+
+    def duration(self, stage):
+        """
+        Out:
+            The seconds stage took, or None if it has not both started and
+            ended
+        """
+        mark = self.marks.get(stage)
+        if mark is None or mark[1] is None:
+            return None
+        return mark[1] - mark[0]
+
+    def total(self):
+        """
+        Out:
+            The seconds from the start of the first stage to the end of the
+            last, or None if no stage has ended
+        """
+        ends = [mark[1] for mark in self.marks.itervalues() if mark[1] is not None]
+        if len(ends) == 0:
+            return None
+        return max(ends) - min([mark[0] for mark in self.marks.itervalues()])
+
+    def count(self, gpx):
+        """
+        Record the number of elements in gpx, the parsed output.
+        """
+        self.wpts = len(gpx.wpts)
+        self.rtes = len(gpx.rtes)
+        self.trks = len(gpx.trks)
+        self.points = sum([len(rte.rtepts) for rte in gpx.rtes]) + \
+                      sum([len(seg.trkpts) for trk in gpx.trks for seg in trk.trksegs])
+
+    def asDict(self):
+        """
+        Out:
+            The timing as a dictionary, with the duration of each stage
+            which happened, for handing on to metrics and logging.
+        """
+        output = {'cmd' : self.cmd, 'bytesIn' : self.bytesIn, 'bytesOut' : self.bytesOut,
+                  'wpts' : self.wpts, 'rtes' : self.rtes, 'trks' : self.trks, 'points' : self.points,
+                  'cached' : self.cached, 'returncode' : self.returncode, 'total' : self.total(),
+                  'error' : str(self.error) if self.error is not None else None}
+        for stage in self.stages:
+            if stage in self.marks:
+                output[stage] = self.duration(stage)
+        if self.usage is not None:
+            output.update({'wall' : self.usage.wall, 'user' : self.usage.user, 'system' : self.usage.system,
+                           'maxrss' : self.usage.maxrss})
+        return output
+
 class GPSBabel(object):
     """
     gpsbabel ( http://www.gpsbabel.org/ ) operates on the concept of a
@@ -284,31 +840,67 @@ class GPSBabel(object):
         * procTrack:  Boolean. Equal to -t flag. Default: False
         * procWpts:   Boolean. Equal to -w flag. Default: False
         * smartIcons: Boolean. Equal to -N flag. Default: True
-        * stdindata:  String. Contains the data to send on stdin to
-                      gpsbabel. Default: Empty
+        * stdindata:  String, or an iterable producing strings (such as
+                      GPXData). Contains the data to send on stdin to
+                      gpsbabel, which is streamed to it in chunks while it
+                      runs. Default: Empty
+        * stdoutbuf:  Boolean. Set by captureStdOut when stdout is to be
+                      captured in memory. Default: False
         * chain:      Array. The list of actions to perform for this run of
                       gpsbabel. Default: Empty
         * autoClear:  Boolean. Determines whether to reset all options
                       after running gpsbabel to defaults. Default: True
+        * cache:      A ConversionCache, or None. Default: None
+        * inProcess:  Boolean. When stdindata is a GPXData, run the filters
+                      at the start of the chain which are in
+                      inProcessFilters in-process, rather than in
+                      gpsbabel. Their results can differ slightly from
+                      gpsbabel's; see simplifyFilter. Default: False
+        * executor:   The GPSBabelExecutor which starts gpsbabel, or None
+                      to use the module's defaultExecutor. Default: None
+        * timed:      Boolean. Record a GPSBabelTiming for each run.
+                      Default: False
+        * observer:   A function which is called with the GPSBabelTiming
+                      of each run once it has finished, whether or not it
+                      succeeded. Setting it also records the timings.
+                      Default: None
+        * timing:     The GPSBabelTiming of the last run, once it has
+                      finished, if it was timed. Default: None
+        * usage:      The GPSBabelUsage of the last run, once gpsbabel has
+                      exited, or None if gpsbabel was not run. Default:
+                      None
     """
 
     # Most commonly used methods here
 
-    def __init__(self, loc="gpsbabel"):
+    def __init__(self, loc="gpsbabel", cache=None, executor=None):
         """
         Constructor.
 
         In:
             loc: String containing location of gpsbabel command. Can be
                  left blank if gpsbabel is in the user's PATH.
+            cache: A ConversionCache to look up results in before running
+                 gpsbabel, and to store them in after. Default: None
+            executor: The GPSBabelExecutor to start gpsbabel with.
+                 Default: the module's defaultExecutor
 
         Sets instance defaults.
         """
         self.__gps = None
+        self.__timing = None
         self.gpsbabel = loc
+        self.cache = cache
+        self.inProcess = False
+        self.executor = executor
+        self.timed = False
+        self.observer = None
+        self.timing = None
+        self.usage = None
         self.clearChainOpts()
 
-    def execCmd(self, cmd=None, parseOutput=True, wait=True, debug=False):
+    def execCmd(self, cmd=None, parseOutput=True, wait=True, debug=False, callback=None, parser='sax',
+                columnar=False, lazy=False, timeout=None, idleTimeout=None):
         """
         Used to run the command that has been built.
 
@@ -326,40 +918,126 @@ class GPSBabel(object):
                 to perform any cleanup.
             debug: If True, and cmd is None, set the debug level to 10
                 while running gpsbabel
+            callback: If given, and parseOutput is True, a function which
+                is called with each GPXWaypoint, GPXRoute and GPXTrack as
+                soon as it has been parsed. When stdout is captured in
+                memory, the output is parsed as gpsbabel produces it, so
+                the callback runs while gpsbabel is still working.
+            parser: The GPX parser to use when parseOutput is True. See
+                gpxParsers.
+            columnar: If True, the points of each track segment and route
+                are stored in a GPXColumns, rather than a list. See
+                GPXColumns.
+            lazy: If True, the fields of each GPXWaypoint, GPXRoute and
+                GPXTrack are only converted from text when they are first
+                read. See GPXLazyWaypoint.
+            timeout: If given, the most seconds gpsbabel may run for
+            idleTimeout: If given, the most seconds gpsbabel may go without
+                taking any stdin, or writing any output
+
+        If gpsbabel runs out of time, it is stopped, as cancel does, and
+        TimeoutException is raised once the run is finished. The timeouts
+        are checked while waiting for gpsbabel, so when wait is False they
+        only apply while the caller is in checkCmd, waitCmd or endCmd, or
+        running a GPSBabelLoop.
+
+        If cache is set, and wait is True, the result is looked up in the
+        cache first, and gpsbabel is only run if it is not there. See
+        ConversionCache.
+
+        If timed or observer is set, the run is timed; see GPSBabelTiming.
+
+        If inProcess is set, and cmd is None, filters are run in-process
+        where they can be; see inProcessFilters. They are then taken off
+        the chain, and stdindata is replaced by their output. If nothing is
+        left for gpsbabel to do but pass that output back, and wait and
+        parseOutput are True, gpsbabel is not run at all, and the output
+        shares its points with the original stdindata.
 
         Out:
             (returncode, output): returncode is the result code from
             running the command (should always be 0 in case of success).
             output is either an array of lines which are the raw output (in
             cases where parseOutput is False), or a set of GPXData/etc
-            objects (where parseOutput is True)
+            objects (where parseOutput is True). When stdout is captured
+            in memory, the raw output is a bytearray instead of lines.
 
         Exceptions:
             If gpsbabel prints any data on stderr, a RuntimeError will be 
-            raised with the contents of stderr
+            raised with the contents of stderr. TimeoutException if it ran
+            out of time, or CancelledException if it was cancelled.
         """
 
         #This method calls buildCmd when cmd is None, then runs the command
         #specified by the list that is now cmd. If wait is true, it manages
         #the calling of checkCmd and encCmd for the caller.
-        if cmd is None: cmd = self.buildCmd(debug)
+        timing = self.timing = self.usage = None
+        if self.timed or self.observer is not None:
+            timing = GPSBabelTiming()
+        if cmd is None:
+            started = monotonic() if timing is not None else None
+            if self.inProcess and isinstance(self.stdindata, GPXData) and self.__filterInProcess():
+                if timing is not None:
+                    timing.start('filter', started)
+                    timing.stop('filter')
+                if wait and parseOutput and self.__passThrough():
+                    if columnar: self.stdindata.makeColumnar()
+                    return self.__cached((0, self.stdindata), parseOutput, callback, timing)
+            cmd = self.buildCmd(debug)
+        key = None
+        if self.cache is not None and wait:
+            key = self.cache.makeKey(self, cmd, (parseOutput, parser, columnar, lazy))
+            if key is not None:
+                result = self.cache.get(key)
+                if result is not None:
+                    if timing is not None: timing.cmd = cmd
+                    return self.__cached(result, parseOutput, callback, timing)
         self.__parseOutput = parseOutput
-        self.__gps = Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        self.__gps.universal_newlines = True
+        self.__timing = timing
+        if timing is not None:
+            timing.cmd = cmd
+            timing.start('spawn')
+        self.__started = monotonic()
+        self.__usage = None
+        try:
+            self.__gps = (self.executor or defaultExecutor).spawn(cmd)
+        except Exception, why:
+            if timing is not None:
+                timing.stop('spawn')
+                timing.error = why
+                self.__notify(timing)
+            raise
+        if timing is not None:
+            now = monotonic()
+            timing.stop('spawn', now)
+            timing.start('stdin', now)
+            timing.start('gpsbabel', now)
+            if self.stdoutname is None: timing.start('read', now)
+        self.__returncode = None
+        self.__cancelled = None
+        self.__killAt = None
+        self.__timeout = timeout
+        self.__idleTimeout = idleTimeout
+        self.__active = self.__started
         self.__stdout = []
         self.__stderr = []
-        if isinstance(self.stdindata, str):
-            self.__gps.send(self.stdindata)
-        else:
-            out = ''
-            for i in self.stdindata:
-                out = '%s%s' % (out, i)
-            self.__gps.send(out)
-        self.__gps._close('stdin')
+        self.__outbuf = None
+        self.__gpxp = None
+        self.__parseError = None
+        if self.stdoutbuf and parseOutput:
+            self.__gpxp = makeGpxParser(parser, callback, columnar=columnar, lazy=lazy)
+        elif self.stdoutbuf:
+            self.__outbuf = bytearray()
+        self.__callback = callback
+        self.__parser = parser
+        self.__columnar = columnar
+        self.__lazy = lazy
+        self.__stdin = self.__chunks(self.stdindata)
+        self.__inbuf = ''
         if wait:
-            self.__returncode = None
-            while self.__returncode is None: self.checkCmd()
-            return self.endCmd()
+            result = self.waitCmd()
+            if key is not None: self.cache.put(key, result)
+            return result
     convert=execCmd
     """
     Provide an alias to execCmd
@@ -373,15 +1051,162 @@ class GPSBabel(object):
         if self.__gps is None:
             return None
         self.__returncode = self.__gps.poll()
-        out = self.__gps.recv(65536)
-        if out is not None:
-            self.__stdout.extend(filter(lambda x: len(x.strip()) > 0, out.split("\n")))
-        err = self.__gps.recv_err(65536)
-        if err is not None:
-            self.__stderr.extend(filter(lambda x: len(x.strip()) > 0, err.split("\n")))
+        if self.__returncode is not None: self.__exited()
+        self.__collect(0)
         return self.__returncode
     checkConvert = checkCmd
 
+    def iterCmd(self, cmd=None, debug=False, parser='sax', columnar=False, lazy=False, timeout=None,
+                idleTimeout=None):
+        """
+        Run the command that has been built, generating each GPXWaypoint,
+        GPXRoute and GPXTrack in its output as soon as it has been parsed.
+        Use captureStdOut(inMemory=True) to have them generated while
+        gpsbabel is still running, rather than once it has finished.
+
+        In:
+            cmd, debug, parser, columnar, lazy, timeout, idleTimeout: As
+                for execCmd
+
+        Exceptions:
+            As for execCmd, raised once gpsbabel has finished
+        """
+        #If the caller stops early, gpsbabel may be blocked writing output
+        #which will never be read, so it is stopped, rather than waited
+        #for, before cleaning up.
+        items = []
+        self.execCmd(cmd, True, wait=False, debug=debug, callback=items.append, parser=parser, columnar=columnar,
+                     lazy=lazy, timeout=timeout, idleTimeout=idleTimeout)
+        finished = False
+        try:
+            while self.__collect(None):
+                for item in items:
+                    yield item
+                del items[:]
+            self.__reap()
+            self.endCmd()
+            finished = True
+        finally:
+            if not finished and self.__gps is not None:
+                self.cancel()
+                try:
+                    self.waitCmd()
+                except CancelledException:
+                    pass
+        for item in items:
+            yield item
+    iterConvert = iterCmd
+
+    def waitCmd(self):
+        """
+        Block until the running gpsbabel exits, then finish the run exactly
+        as endCmd does. Unlike calling checkCmd in a loop, this sleeps
+        until gpsbabel produces output or exits, so it uses no CPU while
+        waiting.
+
+        Out:
+            The same (returncode, output) tuple as endCmd
+        """
+        if self.__gps is None:
+            return (None, [])
+        while self.__collect(None): pass
+        self.__reap()
+        return self.endCmd()
+    waitConvert = waitCmd
+
+    def cancel(self):
+        """
+        Stop the running gpsbabel, started with wait=False. It is asked to
+        terminate at once, and killed if it has not exited within
+        KILL_GRACE seconds, the next time checkCmd, waitCmd or endCmd are
+        called, or its GPSBabelLoop runs. This returns without waiting.
+        Finishing the run, with endCmd or waitCmd, then cleans up and
+        raises CancelledException. Does nothing if gpsbabel is not
+        running, or has already been stopped.
+        """
+        if self.__gps is not None and self.__cancelled is None:
+            self.__cancel(CancelledException("gpsbabel was cancelled"))
+
+    def __cancel(self, why):
+        """
+        Ask gpsbabel to terminate, and close the pipes to it, so that the
+        run finishes by raising why once it has exited. See _expire for
+        the kill, if it does not.
+        """
+        self.__cancelled = why
+        self.__killAt = monotonic() + self.KILL_GRACE
+        gps = self.__gps
+        if gps.poll() is None:
+            gps.terminate()
+        for which in ('stdin', 'stdout', 'stderr'):
+            gps._close(which)
+
+    def _timeLeft(self):
+        """
+        Out:
+            The seconds until the running gpsbabel runs out of time, or None
+            if it has no timeout. Once it has been stopped, the seconds
+            until it should be checked on again, until it exits. Used by
+            GPSBabelLoop.
+        """
+        if self.__gps is None:
+            return None
+        if self.__cancelled is not None:
+            return 0.01 if self.__gps.poll() is None else None
+        left = None
+        if self.__timeout is not None:
+            left = self.__started + self.__timeout
+        if self.__idleTimeout is not None:
+            idle = self.__active + self.__idleTimeout
+            if left is None or idle < left: left = idle
+        if left is None:
+            return None
+        return left - monotonic()
+
+    def _expire(self):
+        """
+        Stop the running gpsbabel if it has run out of time, and kill it if
+        it has been stopped, but has not exited within KILL_GRACE seconds.
+        Return True if it has been stopped, for that or any other reason.
+        Used by GPSBabelLoop.
+        """
+        if self.__gps is None:
+            return False
+        if self.__cancelled is None:
+            left = self._timeLeft()
+            if left is None or left > 0:
+                return False
+            if self.__timeout is not None and monotonic() >= self.__started + self.__timeout:
+                why = TimeoutException("gpsbabel did not finish within %s seconds" % self.__timeout)
+            else:
+                why = TimeoutException("gpsbabel did nothing for %s seconds" % self.__idleTimeout)
+            self.__cancel(why)
+        elif self.__killAt is not None and monotonic() >= self.__killAt and self.__gps.poll() is None:
+            self.__gps.kill()
+            self.__killAt = None
+        return True
+
+    def __reap(self):
+        """
+        Wait for gpsbabel to exit, once its pipes have been closed, and
+        keep its exit code.
+        """
+        self.__returncode = self.__gps.wait()
+        self.__exited()
+
+    def __exited(self):
+        """
+        Record what the run of gpsbabel used, the first time it is seen to
+        have exited.
+        """
+        if self.__usage is not None:
+            return
+        now = monotonic()
+        self.__usage = GPSBabelUsage(now - self.__started, getattr(self.__gps, 'usage', None))
+        if self.__timing is not None:
+            self.__timing.stop('gpsbabel', now)
+            self.__timing.usage = self.__usage
+
     def endCmd(self):
         """
         Get the exit code for the running gpsbabel, and the output, and
@@ -391,19 +1216,326 @@ class GPSBabel(object):
             return (None, [])
         if self.checkCmd() is None:
             return (None, [])
+        while self.__collect(None): pass
+        self.usage = self.__usage
+        timing = self.__timing
+        self.__timing = None
+        if timing is not None:
+            timing.returncode = self.__returncode
+            timing.stop('read')
+        try:
+            output = self.__output(timing)
+        except Exception, why:
+            if timing is not None: timing.error = why
+            raise
+        finally:
+            if timing is not None: self.__notify(timing)
+        self.__gps = None
+        return(self.__returncode, output)
+    endConvert = endCmd
+
+    def __output(self, timing):
+        """
+        Collect the output of the finished gpsbabel, and parse it if it is
+        to be parsed. Used by endCmd.
+        """
+        if self.__cancelled is not None:
+            if self.stdoutname is not None and os.path.exists(self.stdoutname):
+                os.unlink(self.stdoutname)
+            self.stdoutname = None
+            if self.autoClear: self.clearChainOpts()
+            self.__gps = None
+            raise self.__cancelled
         if self.stdoutname is not None:
+            if timing is not None: timing.start('read')
             output = open(self.stdoutname).readlines()
             os.unlink(self.stdoutname)
             self.stdoutname = None
+            if timing is not None:
+                timing.stop('read')
+                timing.bytesOut = sum([len(line) for line in output])
+        elif self.__outbuf is not None:
+            output = self.__outbuf
         else:
             output = self.__stdout
         if len(self.__stderr) > 0:
             raise RuntimeError("gpsbabel failure: %s" % "\n".join(self.__stderr))
         if self.autoClear: self.clearChainOpts()
-        if self.__parseOutput: output = gpxParse("\n".join(output))
-        self.__gps = None
-        return(self.__returncode, output)
-    endConvert = endCmd
+        if self.__gpxp is None and self.__parseOutput:
+            #The output was not parsed as it was read, so parse it all now,
+            #in pieces if it is a buffer, so that it is not copied.
+            self.__gpxp = makeGpxParser(self.__parser, self.__callback, columnar=self.__columnar,
+                                        lazy=self.__lazy)
+            if timing is not None: timing.start('parse')
+            try:
+                if self.__outbuf is not None:
+                    for i in xrange(0, len(output), 65536):
+                        self.__gpxp.feed(buffer(output, i, 65536))
+                else:
+                    self.__gpxp.feed("\n".join(output))
+            except Exception, why:
+                self.__parseError = why
+        if self.__gpxp is not None:
+            if timing is not None: timing.start('parse')
+            if self.__parseError is None:
+                try:
+                    self.__gpxp.close()
+                except Exception, why:
+                    self.__parseError = why
+            if timing is not None: timing.stop('parse')
+            if self.__parseError is not None:
+                self.__gps = None
+                raise self.__parseError
+            output = self.__gpxp.gpx
+            if timing is not None: timing.start('finalize')
+            output.finalize()
+            if timing is not None:
+                timing.stop('finalize')
+                timing.count(output)
+        return output
+
+    def __notify(self, timing):
+        """
+        Keep the timing of a finished run, and hand it to the observer.
+        """
+        self.timing = timing
+        if self.observer is not None:
+            self.observer(timing)
+
+    def __cached(self, result, parseOutput, callback, timing=None):
+        """
+        Finish a run whose result was found in the cache, as endCmd would
+        have finished it.
+        """
+        if self.stdoutname is not None and os.path.exists(self.stdoutname):
+            os.unlink(self.stdoutname)
+        self.stdoutname = None
+        if self.autoClear: self.clearChainOpts()
+        if callback is not None and parseOutput:
+            for item in result[1].wpts + result[1].rtes + result[1].trks:
+                callback(item)
+        if timing is not None:
+            timing.cached = True
+            timing.returncode = result[0]
+            if parseOutput: timing.count(result[1])
+            self.__notify(timing)
+        return result
+
+    def __filterInProcess(self):
+        """
+        Run the filters at the start of the chain which can be run
+        in-process on stdindata, and take them off the chain. Return True
+        if any were.
+        """
+        #Filters apply to all of the data read before them, so only those
+        #after stdin, and before any other input, can be run here.
+        reading = done = False
+        i = 0
+        while i < len(self.chain):
+            action, opts = self.chain[i]
+            if action['action'] == 'infile':
+                if reading or action['fname'] != '-' or action['fmtfilter'] != 'gpx' or opts: break
+                reading = True
+            elif action['action'] == 'filter':
+                run = inProcessFilters.get(action['fmtfilter'])
+                output = run(self.stdindata, opts) if run is not None and reading else None
+                if output is None: break
+                self.stdindata = output
+                del self.chain[i]
+                done = True
+                continue
+            elif action['action'] == 'outfile':
+                break
+            i += 1
+        return done
+
+    def __passThrough(self):
+        """
+        Return True if all that is left of the chain is reading stdin as
+        GPX, and capturing it back again as GPX, with no character set
+        other than the UTF-8 setInGpx sets, and no options other than the
+        gpxver captureStdOut sets.
+        """
+        chain = [(action, opts) for action, opts in self.chain
+                 if action['action'] != 'charset' or action['fmtfilter'].upper() != 'UTF-8']
+        actions = [(action['action'], action['fmtfilter'], action['fname']) for action, opts in chain]
+        capture = '-' if self.stdoutbuf else self.stdoutname
+        if actions != [('infile', 'gpx', '-'), ('outfile', 'gpx', capture)] or capture is None or self.shortnames:
+            return False
+        return not chain[0][1] and not [key for key in (chain[1][1] or {}).keys() if key != 'gpxver']
+
+    def __collect(self, timeout):
+        """
+        Wait up to timeout seconds (forever if None) for gpsbabel to write
+        to stdout or stderr, and store whatever it wrote. Return False once
+        both pipes have been closed, True otherwise.
+        """
+        #On POSIX, the pipes were made non-blocking by the executor, so
+        #this is a single select followed by reads of whatever is ready.
+        #Windows has no select on pipes, and other executors may not have
+        #pipes at all, so fall back to polling them, sleeping briefly
+        #rather than spinning when nothing has happened.
+        if self._expire():
+            #Wait for the stopped gpsbabel to exit, checking on it every
+            #so often, as _timeLeft says.
+            left = self._timeLeft()
+            if left is None:
+                return False
+            if timeout != 0:
+                time.sleep(left if timeout is None else min(left, timeout))
+            return True
+        left = self._timeLeft()
+        if left is not None and (timeout is None or left < timeout):
+            timeout = max(left, 0)
+        gps = self.__gps
+        if not gps.selectable:
+            if not self._poll() and timeout != 0 and gps.poll() is None:
+                time.sleep(0.05 if timeout is None else min(timeout, 0.05))
+            return gps.stdin is not None or gps.stdout is not None or gps.stderr is not None
+        conns, wconns = self._pipes()
+        if len(conns) == 0 and len(wconns) == 0:
+            return False
+        try:
+            ready, wready = select.select(conns, wconns, [], timeout)[:2]
+        except select.error, why:
+            if why[0] == errno.EINTR:
+                return True
+            raise
+        return self._service(ready, wready)
+
+    def _pipes(self):
+        """
+        Out:
+            (readable, writable): the lists of pipes to the running gpsbabel
+            which are still open, for use with select. Both are empty when
+            nothing is running, or when its pipes cannot be selected on.
+            Used by GPSBabelLoop.
+        """
+        gps = self.__gps
+        if gps is None or not gps.selectable:
+            return ([], [])
+        return ([c for c in (gps.stdout, gps.stderr) if c is not None],
+                [gps.stdin] if gps.stdin is not None else [])
+
+    def _poll(self):
+        """
+        Feed stdin and read stdout/stderr without waiting, for a process
+        whose pipes cannot be selected on. Return True if any data was
+        sent or received. Used by GPSBabelLoop.
+        """
+        gps = self.__gps
+        fed = gps.stdin is not None and self.__feed()
+        out = gps.recv(65536)
+        err = gps.recv_err(65536)
+        self.__store(out, err)
+        return bool(fed or out or err)
+
+    def _selectable(self):
+        """
+        Return False if gpsbabel is running in a process whose pipes cannot
+        be selected on, so that it has to be polled with checkCmd instead.
+        Used by GPSBabelLoop.
+        """
+        return self.__gps is None or self.__gps.selectable
+
+    def _service(self, ready, wready):
+        """
+        Feed stdin and read stdout/stderr, for whichever of the pipes
+        returned by _pipes select has reported as ready. Return False once
+        all pipes have been closed, True otherwise. Used by GPSBabelLoop.
+        """
+        gps = self.__gps
+        if len(wready) > 0: self.__feed()
+        out = err = None
+        for conn in ready:
+            which = 'stdout' if conn is gps.stdout else 'stderr'
+            try:
+                data = os.read(conn.fileno(), 65536)
+            except OSError, why:
+                if why[0] in (errno.EAGAIN, errno.EINTR):
+                    continue
+                raise
+            if not data:
+                gps._close(which)
+                continue
+            if gps.universal_newlines and (which == 'stderr' or (self.__outbuf is None and self.__gpxp is None)):
+                data = gps._translate_newlines(data)
+            if which == 'stdout':
+                out = data
+            else:
+                err = data
+        self.__store(out, err)
+        return gps.stdin is not None or gps.stdout is not None or gps.stderr is not None
+
+    def __feed(self):
+        """
+        Hand gpsbabel as much of the pending stdin data as it will take
+        without blocking, and close stdin once the payload is exhausted.
+        Return True if any was sent, or stdin was closed.
+        """
+        if len(self.__inbuf) == 0:
+            try:
+                self.__inbuf = self.__stdin.next()
+            except StopIteration:
+                self.__gps._close('stdin')
+                if self.__timing is not None: self.__timing.stop('stdin')
+                return True
+        written = self.__gps.send(self.__inbuf)
+        if written:
+            self.__inbuf = self.__inbuf[written:]
+            if self.__timing is not None: self.__timing.bytesIn += written
+            if self.__idleTimeout is not None: self.__active = monotonic()
+        return bool(written)
+
+    def __chunks(self, data):
+        """
+        Generate the stdin payload in pieces of about CHUNK_SIZE bytes.
+        Iterables (such as GPXData) are consumed as they are written, so
+        only one piece is ever held in memory.
+        """
+        if isinstance(data, basestring):
+            for i in xrange(0, len(data), self.CHUNK_SIZE):
+                chunk = data[i:i + self.CHUNK_SIZE]
+                yield chunk.encode('utf-8') if isinstance(chunk, unicode) else chunk
+            return
+        parts = []
+        size = 0
+        for i in data:
+            if isinstance(i, unicode): i = i.encode('utf-8')
+            parts.append(i)
+            size += len(i)
+            if size >= self.CHUNK_SIZE:
+                yield ''.join(parts)
+                parts = []
+                size = 0
+        if len(parts) > 0:
+            yield ''.join(parts)
+
+    def __store(self, out, err):
+        """
+        Split freshly read stdout/stderr data into non-blank lines and keep
+        them for endCmd. When stdout is being captured in memory, its data
+        is instead fed to the parser, or appended to the capture buffer as
+        is if the output is not being parsed. Parse errors are kept until
+        endCmd, so gpsbabel can still be run to completion.
+        """
+        if (out or err) and self.__idleTimeout is not None:
+            self.__active = monotonic()
+        if out and self.__timing is not None:
+            self.__timing.bytesOut += len(out)
+            if self.__gpxp is not None: self.__timing.start('parse')
+        if out and self.__gpxp is not None:
+            if self.__parseError is None:
+                try:
+                    self.__gpxp.feed(out)
+                except Exception, why:
+                    self.__parseError = why
+        elif out and self.__outbuf is not None:
+            self.__outbuf.extend(out)
+        elif out:
+            self.__stdout.extend(filter(lambda x: len(x.strip()) > 0, out.split("\n")))
+        if err:
+            self.__stderr.extend(filter(lambda x: len(x.strip()) > 0, err.split("\n")))
 
     def addInputFile(self, fname, fmt="gpx", charset="UTF-8"):
         """
@@ -621,10 +1753,23 @@ class GPSBabel(object):
             except TypeError:
                 raise Exception("Unable to set stdin for gpsbabel. Aborting!")
 
-    def captureStdOut(self):
+    def captureStdOut(self, inMemory=False):
         """
         Add the action to the chain of capturing stdout.
+
+        In:
+            inMemory: If False, gpsbabel writes its output to a temporary
+                file, which is read back once it has finished. If True,
+                gpsbabel writes to stdout, which is read as it runs into a
+                single bytearray. That bytearray is then parsed directly,
+                or returned as is if the output is not being parsed. This
+                avoids the disk, and any decoding or splitting into lines.
+                Requires Python 2.6 or later.
         """
+        if inMemory:
+            self.stdoutbuf = True
+            self.addAction('outfile', 'gpx', '-', {'gpxver':'1.0'})
+            return
         (fd, name) = tempfile.mkstemp()
         os.close(fd)
         self.stdoutname = name
@@ -673,6 +1818,17 @@ class GPSBabel(object):
 
         return []
 
+    CHUNK_SIZE = 65536
+    """
+    Number of bytes handed to gpsbabel's stdin per write.
+    """
+
+    KILL_GRACE = 1.0
+    """
+    Seconds to give gpsbabel to exit once asked to terminate, before it is
+    killed. See cancel.
+    """
+
     actions = ['charset', 'infile', 'filter', 'outfile']
     """
     Valid actions which GPSBabel can use.
@@ -750,6 +1906,7 @@ class GPSBabel(object):
         self.smartIcons = True
         self.stdindata  = ""
         self.stdoutname = None
+        self.stdoutbuf  = False
         self.chain      = []
         if not hasattr(self, "autoClear"): self.autoClear = True
     clear = clearChainOpts
@@ -799,65 +1956,2159 @@ class GPSBabel(object):
                 cmd.extend(['-c', '%s%s' % (fmt['fmtfilter'], opts)])
         return cmd
 
-class GPXData(object):
-    """
-    The root container for gpx data objects.
+    def makePlan(self, debug=False):
+        """
+        Turn the chain that has been built into a ConversionPlan, which
+        can be run many times without building or checking it again. File
+        names in the chain may contain placeholders, such as $infile or
+        ${name}.gpx, which are filled in each time the plan is run. The
+        chain is then cleared, if autoClear is set.
 
-    All of these objects function similarly. Define the legal instance
-    members, define a toXml method to convert data to legal gpx format, and
-    a finalize method to allow any postprocessing to occur when loading xml
-    data into them (for instance, this could be used to convert floats from
-    string to decimal).
+        In:
+            debug: As for buildCmd
 
-    The object hierarchy for the GPXData closely mirrors the XML
-    representation of those objects. As such, when looking at the GPXData
-    object, this is the expected representation of a .gpx/.loc file after
-    it has been parsed:
+        Out:
+            A ConversionPlan
+        """
+        plan = ConversionPlan(self, debug)
+        if self.stdoutname is not None and os.path.exists(self.stdoutname):
+            os.unlink(self.stdoutname)
+        self.stdoutname = None
+        if self.autoClear: self.clearChainOpts()
+        return plan
 
-    GPXData
-        wpts: list of GPXWaypoint
-            GPXWaypoint.__slots__ lists legal attributes
-        rtes: list of GPXRoute
-            GPXRoute.__slots__ lists legal attributes
-                rtepts: list of GPXWaypoint
-        trks: list of GPXTrack
-            GPXTrack.__slots__ lists legal attributes
-                trksegs: list of GPXTrackSeg
-                    GPXTrackSeg.__slots__ lists legal attributes
-                        trkpts: list of GPXWaypoint
+class ConversionPlan(object):
+    """
+    A gpsbabel command line which has been built and checked once, and can
+    then be run any number of times, only changing the file names. Make
+    one with GPSBabel.makePlan.
 
-    wpts is a list of GPXWaypoint
-    rtes is a list of GPXRoute
+    File names in the chain may contain placeholders in the form used by
+    string.Template, such as $infile or ${name}.gpx. Each run fills them
+    in from a dictionary of parameters. Use $$ for a $ in a file name.
+
+    A ConversionPlan is never changed once it has been made, and each run
+    uses a fresh GPSBabel, so one plan can be shared by many threads.
+
+    Instance variables:
+        * gpsbabel:  The location of the gpsbabel command
+        * cmd:       The command line, as a tuple, with the placeholders
+                     still in it
+        * stdindata: The data to send to gpsbabel on stdin, unless another
+                     is given for a run
+        * cache:     The ConversionCache used by each run, from the chain's
+                     GPSBabel
+    """
+
+    def __init__(self, gps, debug=False):
+        """
+        Constructor.
+
+        In:
+            gps: The GPSBabel whose chain to use
+            debug: As for GPSBabel.buildCmd
+        """
+        #Only the positions of the arguments which need filling in are
+        #kept, along with their templates, so each run only substitutes
+        #those. When stdout is captured to a temporary file, each run
+        #needs its own, so its position is kept too.
+        cmd = gps.buildCmd(debug)
+        self.gpsbabel = gps.gpsbabel
+        self.cache = gps.cache
+        self.cmd = tuple(cmd)
+        self.stdindata = gps.stdindata
+        self.__templates = tuple([(i, string.Template(cmd[i])) for i in xrange(1, len(cmd))
+                                  if cmd[i - 1] in ('-f', '-F') and '$' in cmd[i]])
+        self.__capture = None
+        if gps.stdoutname is not None:
+            self.__capture = cmd.index(gps.stdoutname)
+        self.__inMemory = gps.stdoutbuf
+
+    def buildCmd(self, params={}):
+        """
+        Out:
+            The command line, as a list, with the placeholders filled in
+            from params
+
+        Exceptions:
+            KeyError if a placeholder is missing from params
+        """
+        cmd = list(self.cmd)
+        for i, template in self.__templates:
+            cmd[i] = template.substitute(params)
+        return cmd
+
+    def setUp(self, gps, params={}, stdindata=None):
+        """
+        Set up a fresh GPSBabel to run this plan once. Use this to run a
+        plan with GPSBabelLoop.start.
+
+        In:
+            gps: The GPSBabel to set up
+            params, stdindata: As for execCmd
+
+        Out:
+            The command line to run
+        """
+        cmd = self.buildCmd(params)
+        gps.stdindata = self.stdindata if stdindata is None else stdindata
+        gps.stdoutbuf = self.__inMemory
+        if self.__capture is not None:
+            (fd, name) = tempfile.mkstemp()
+            os.close(fd)
+            gps.stdoutname = cmd[self.__capture] = name
+        return cmd
+
+    def execCmd(self, params={}, stdindata=None, parseOutput=True, callback=None, parser='sax',
+                columnar=False, lazy=False):
+        """
+        Run the plan once, and wait for it to finish.
+
+        In:
+            params: A dictionary of the values for the placeholders
+            stdindata: The data to send to gpsbabel on stdin. Default: the
+                stdindata of the chain the plan was made from
+            parseOutput, callback, parser, columnar, lazy: As for
+                GPSBabel.execCmd
+
+        Out:
+            As for GPSBabel.execCmd
+        """
+        gps = GPSBabel(self.gpsbabel, self.cache)
+        cmd = self.setUp(gps, params, stdindata)
+        try:
+            return gps.execCmd(cmd, parseOutput, callback=callback, parser=parser, columnar=columnar, lazy=lazy)
+        finally:
+            if gps.stdoutname is not None and os.path.exists(gps.stdoutname):
+                os.unlink(gps.stdoutname)
+    convert = execCmd
+    """
+    Provide an alias to execCmd
+    """
+
+class ConversionCache(object):
+    """
+    Remembers the results of running gpsbabel, so that running the same
+    conversion on the same input again returns the same result without
+    running gpsbabel or parsing its output. Give one to a GPSBabel to use
+    it.
+
+    Results are found by a hash of the command line, the contents of every
+    input file and of the data sent on stdin, the gpsbabel executable (see
+    executableId), and how the output is parsed. Results are kept in
+    memory, pickled, for the most recently used size runs. If directory is
+    set, they are also written there, and the least recently used files
+    are removed once there are more than maxBytes of them.
+
+    Only runs whose input can be hashed are cached: every input file must
+    be a regular file or stdin, stdindata must be a string, bytearray or
+    GPXData, and output must be captured with captureStdOut. Anything else,
+    such as reading from a GPS, or writing to an output file, always runs
+    gpsbabel.
+
+    Instance variables:
+        * size:      The most results to keep in memory
+        * directory: The directory to keep results on disk in, or None
+        * maxBytes:  The most bytes of results to keep on disk
+        * hits:      The number of results found, in memory or on disk
+        * diskHits:  The number of those found on disk
+        * misses:    The number of results not found
+    """
+
+    def __init__(self, size=32, directory=None, maxBytes=64 * 1024 * 1024):
+        """
+        Constructor.
+
+        In:
+            size, directory, maxBytes: See the instance variables
+        """
+        self.size = size
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.hits = 0
+        self.diskHits = 0
+        self.misses = 0
+        self.__memory = {}
+        self.__ages = []
+        self.__tick = 0
+        self.__diskBytes = None
+
+    def makeKey(self, gps, cmd, options=()):
+        """
+        Out:
+            The key for running cmd with gps, or None if the run cannot be
+            cached
+
+        In:
+            gps: The GPSBabel which is to run cmd
+            cmd: The command line
+            options: Anything else which changes the result, such as how
+                the output is parsed
+        """
+        ident = executableId(cmd[0])
+        if ident is None:
+            return None
+        key = sha(ident)
+        key.update(repr(options))
+        for i in xrange(1, len(cmd)):
+            arg = cmd[i]
+            if cmd[i - 1] == '-F':
+                if arg == gps.stdoutname: arg = '<captured>'
+                elif arg != '-': return None
+            key.update('\0%s' % (arg))
+            if cmd[i - 1] == '-f' and arg != '-':
+                if not os.path.isfile(arg):
+                    return None
+                f = open(arg, 'rb')
+                try:
+                    for chunk in iter(lambda: f.read(65536), ''):
+                        key.update(chunk)
+                finally:
+                    f.close()
+        data = gps.stdindata
+        if isinstance(data, GPXData):
+            for piece in data:
+                key.update(piece.encode('utf-8') if isinstance(piece, unicode) else piece)
+        elif isinstance(data, unicode):
+            key.update(data.encode('utf-8'))
+        elif isinstance(data, (str, bytearray)):
+            key.update(data)
+        else:
+            return None
+        return key.hexdigest()
+
+    def get(self, key):
+        """
+        Out:
+            The result stored under key, or None if there is none
+        """
+        entry = self.__memory.get(key)
+        if entry is None and self.directory is not None:
+            name = os.path.join(self.directory, 'result-%s' % (key))
+            try:
+                f = open(name, 'rb')
+                try:
+                    data = f.read()
+                finally:
+                    f.close()
+                os.utime(name, None)
+            except (IOError, OSError):
+                pass
+            else:
+                self.diskHits += 1
+                entry = self.__remember(key, data)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.__touch(key, entry)
+        return pickle.loads(entry[1])
+
+    def put(self, key, result):
+        """
+        Store a result under key.
+        """
+        data = pickle.dumps(result, 2)
+        self.__remember(key, data)
+        if self.directory is None:
+            return
+        #As with the capabilities cache, each file is written under a
+        #temporary name and then renamed, so a partly written result is
+        #never read.
+        try:
+            if not os.path.isdir(self.directory): os.makedirs(self.directory)
+            (fd, name) = tempfile.mkstemp(dir=self.directory)
+            f = os.fdopen(fd, 'wb')
+            try:
+                f.write(data)
+            finally:
+                f.close()
+            cachename = os.path.join(self.directory, 'result-%s' % (key))
+            replaced = 0
+            if os.path.exists(cachename):
+                replaced = os.path.getsize(cachename)
+                if sys.platform == 'win32': os.unlink(cachename)
+            os.rename(name, cachename)
+            #The directory is only listed when it may be over maxBytes: the
+            #first time, and whenever the running total says so. Other
+            #processes sharing it are only noticed then.
+            if self.__diskBytes is not None:
+                self.__diskBytes += len(data) - replaced
+            if self.__diskBytes is None or self.__diskBytes > self.maxBytes:
+                self.__evict()
+        except (IOError, OSError):
+            pass
+
+    def clear(self):
+        """
+        Forget every result, in memory and on disk.
+        """
+        self.__memory.clear()
+        del self.__ages[:]
+        self.__diskBytes = None
+        if self.directory is not None and os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                if name.startswith('result-'): os.unlink(os.path.join(self.directory, name))
+
+    def __remember(self, key, data):
+        """
+        Keep a pickled result in memory, forgetting the least recently
+        used one if there are too many.
+        """
+        #__ages is a heap of (tick, key) for every time a result was used,
+        #so the oldest entries which are still current are those of the
+        #least recently used results.
+        while key not in self.__memory and len(self.__memory) >= self.size > 0:
+            tick, oldest = heapq.heappop(self.__ages)
+            if self.__memory.get(oldest, (None,))[0] == tick:
+                del self.__memory[oldest]
+        entry = [None, data]
+        if self.size > 0:
+            self.__memory[key] = entry
+            self.__touch(key, entry)
+        return entry
+
+    def __touch(self, key, entry):
+        """
+        Mark a result in memory as the most recently used.
+        """
+        self.__tick += 1
+        entry[0] = self.__tick
+        if key not in self.__memory:
+            return
+        heapq.heappush(self.__ages, (self.__tick, key))
+        #Each use leaves a stale entry behind, so the heap is rebuilt from
+        #the current ones once they are outnumbered.
+        if len(self.__ages) > 2 * len(self.__memory) + 16:
+            self.__ages = [(e[0], k) for k, e in self.__memory.iteritems()]
+            heapq.heapify(self.__ages)
+
+    def __evict(self):
+        """
+        Remove the least recently used results from disk until there are
+        no more than maxBytes of them.
+        """
+        files = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if name.startswith('result-'):
+                name = os.path.join(self.directory, name)
+                st = os.stat(name)
+                files.append((st.st_mtime, st.st_size, name))
+                total += st.st_size
+        files.sort()
+        for mtime, size, name in files:
+            if total <= self.maxBytes:
+                break
+            os.unlink(name)
+            total -= size
+        self.__diskBytes = total
+
+class GPSBabelLoop(object):
+    """
+    Drives any number of gpsbabel commands at once from a single thread.
+
+    Commands are started without waiting, and the loop then sleeps in one
+    poll (or select) call across the pipes of every running gpsbabel,
+    feeding and reading whichever are ready. Each started command is
+    represented by a GPSBabelRun, which can be waited on or given
+    callbacks to run when the command completes.
+
+    Instance variables:
+        * runs: The list of GPSBabelRun objects which have not finished
+    """
+
+    def __init__(self):
+        """
+        Constructor.
+        """
+        self.runs = []
+
+    def start(self, gps, cmd=None, parseOutput=True, debug=False, convert=None, timeout=None, idleTimeout=None):
+        """
+        Start a command on a GPSBabel instance, without waiting for it.
+
+        In:
+            gps: The GPSBabel instance to run the command on. It may only
+                run one command at a time.
+            cmd, parseOutput, debug, timeout, idleTimeout: As for
+                GPSBabel.execCmd
+            convert: If given, a function which is passed the
+                (returncode, output) tuple from the command, and whose
+                result becomes the result of the GPSBabelRun
+
+        Out:
+            A GPSBabelRun for the command
+        """
+        for run in self.runs:
+            if run.gps is gps:
+                raise RuntimeError("gpsbabel is already running for this GPSBabel instance")
+        gps.execCmd(cmd, parseOutput, wait=False, debug=debug, timeout=timeout, idleTimeout=idleTimeout)
+        run = GPSBabelRun(gps, self, convert)
+        self.runs.append(run)
+        return run
+
+    def runOnce(self, timeout=None):
+        """
+        Wait up to timeout seconds (forever if None) for any running
+        gpsbabel to become ready, service it, and finish off the runs
+        which have completed.
+
+        Out:
+            True if there are still runs in progress, False otherwise
+        """
+        if len(self.runs) == 0:
+            return False
+        #Runs which have run out of time are stopped, and finished once
+        #they have exited. Until then, they are only checked on. The wait
+        #is cut short at the next time any run needs to be.
+        stopping = []
+        for run in self.runs[:]:
+            if run.gps._expire():
+                if run.gps.checkCmd() is not None:
+                    self.__finish(run)
+                    continue
+                stopping.append(run)
+            left = run.gps._timeLeft()
+            if left is not None and (timeout is None or left < timeout): timeout = max(left, 0)
+        #Runs whose pipes cannot be selected on (all of them on Windows)
+        #are polled instead, and the wait for the others is cut short so
+        #that they are polled again soon, or not at all while they are
+        #still moving data.
+        polled = busy = False
+        for run in self.runs[:]:
+            if run in stopping or run.gps._selectable(): continue
+            polled = True
+            if run.gps._poll(): busy = True
+            if run.gps.checkCmd() is not None: self.__finish(run)
+        if busy: timeout = 0
+        elif polled and (timeout is None or timeout > 0.05): timeout = 0.05
+        rconns = []
+        wconns = []
+        owners = {}
+        for run in self.runs[:]:
+            if run in stopping or not run.gps._selectable(): continue
+            r, w = run.gps._pipes()
+            if len(r) == 0 and len(w) == 0:
+                self.__finish(run)
+                continue
+            rconns.extend(r)
+            wconns.extend(w)
+            for conn in r + w: owners[conn] = run
+        if len(owners) == 0:
+            if (polled or stopping) and len(self.runs) > 0 and timeout != 0: time.sleep(timeout)
+            return len(self.runs) > 0
+        ready, wready = self.__wait(rconns, wconns, timeout)
+        serviced = {}
+        for conn in ready:
+            serviced.setdefault(owners[conn], ([], []))[0].append(conn)
+        for conn in wready:
+            serviced.setdefault(owners[conn], ([], []))[1].append(conn)
+        for run, (r, w) in serviced.items():
+            if not run.gps._service(r, w): self.__finish(run)
+        return len(self.runs) > 0
+
+    def run(self):
+        """
+        Service the running commands until all of them have finished.
+        """
+        while self.runOnce(): pass
+
+    def __wait(self, rconns, wconns, timeout):
+        """
+        Wait for any of the given pipes to become ready, using poll where
+        it is available, so there is no limit on how many pipes are open.
+        """
+        try:
+            if not hasattr(select, 'poll'):
+                return select.select(rconns, wconns, [], timeout)[:2]
+            poller = select.poll()
+            fds = {}
+            for conn in rconns:
+                poller.register(conn, select.POLLIN)
+                fds[conn.fileno()] = conn
+            for conn in wconns:
+                poller.register(conn, select.POLLOUT)
+                fds[conn.fileno()] = conn
+            events = poller.poll(None if timeout is None else int(math.ceil(timeout * 1000)))
+        except select.error, why:
+            if why[0] == errno.EINTR:
+                return ([], [])
+            raise
+        ready = []
+        wready = []
+        for fd, event in events:
+            conn = fds[fd]
+            if conn in wconns: wready.append(conn)
+            else: ready.append(conn)
+        return (ready, wready)
+
+    def __finish(self, run):
+        self.runs.remove(run)
+        run._finish()
+
+class GPSBabelRun(object):
+    """
+    A gpsbabel command started by a GPSBabelLoop, which may or may not
+    have finished yet.
+
+    Instance variables:
+        * gps:        The GPSBabel instance running the command
+        * loop:       The GPSBabelLoop running the command
+        * returncode: The exit code of gpsbabel, once finished
+        * output:     The output of the command as returned by execCmd,
+                      once finished
+        * error:      The exception raised when finishing the command (for
+                      instance, the RuntimeError for output on stderr), or
+                      None
+        * timing:     The GPSBabelTiming of the command, once finished, if
+                      gps timed it
+        * usage:      The GPSBabelUsage of the command, once finished
+    """
+
+    def __init__(self, gps, loop, convert=None):
+        """
+        Constructor. Not normally called directly; see GPSBabelLoop.start
+        """
+        self.gps        = gps
+        self.loop       = loop
+        self.returncode = None
+        self.output     = None
+        self.error      = None
+        self.timing     = None
+        self.usage      = None
+        self.__convert   = convert
+        self.__done      = False
+        self.__callbacks = []
+
+    def done(self):
+        """
+        Out:
+            True if the command has finished, False otherwise
+        """
+        return self.__done
+
+    def addCallback(self, func):
+        """
+        Arrange for func to be called with this GPSBabelRun once the
+        command finishes. If it already has, func is called immediately.
+        """
+        if self.__done:
+            func(self)
+        else:
+            self.__callbacks.append(func)
+
+    def cancel(self):
+        """
+        Stop the command, if it has not finished. See GPSBabel.cancel. It
+        finishes the next time the loop runs, with a CancelledException.
+        """
+        if not self.__done:
+            self.gps.cancel()
+
+    def result(self):
+        """
+        Run the loop until this command has finished, and return its
+        result: what the matching GPSBabel method would have returned.
+
+        Exceptions:
+            Whatever exception finishing the command raised
+        """
+        while not self.__done: self.loop.runOnce()
+        if self.error is not None:
+            raise self.error
+        if self.__convert is not None:
+            return self.__convert((self.returncode, self.output))
+        return (self.returncode, self.output)
+
+    def _finish(self):
+        try:
+            self.returncode, self.output = self.gps.waitCmd()
+        except Exception, why:
+            self.error = why
+        self.timing = self.gps.timing
+        self.usage = self.gps.usage
+        self.__done = True
+        for func in self.__callbacks:
+            func(self)
+
+class AsyncGPSBabel(GPSBabel):
+    """
+    A GPSBabel whose commands run in a GPSBabelLoop rather than blocking
+    the caller. Each of the a* methods sets up the chain just as its
+    blocking counterpart does, starts gpsbabel, and returns a GPSBabelRun
+    whose result() is what the counterpart would have returned.
+
+    Each instance runs one command at a time; use one instance per
+    concurrent command, all sharing the same loop.
+
+    Instance variables:
+        * loop: The GPSBabelLoop to run commands in. Default: defaultLoop
+    """
+
+    def __init__(self, loc="gpsbabel", loop=None, executor=None):
+        """
+        Constructor.
+
+        In:
+            loc, executor: As for GPSBabel
+            loop: The GPSBabelLoop to run commands in. If not given, the
+                module's defaultLoop is used.
+        """
+        GPSBabel.__init__(self, loc, executor=executor)
+        self.loop = loop if loop is not None else defaultLoop
+
+    def aexecCmd(self, cmd=None, parseOutput=True, debug=False, timeout=None, idleTimeout=None):
+        """
+        Start the command that has been built, as execCmd with wait=False
+        does.
+
+        Out:
+            A GPSBabelRun whose result is (returncode, output)
+        """
+        return self.loop.start(self, cmd, parseOutput, debug, timeout=timeout, idleTimeout=idleTimeout)
+    aconvert = aexecCmd
+    """
+    Provide an alias to aexecCmd
+    """
+
+    def agetCurrentGpsLocation(self, port, gpsType):
+        """
+        As getCurrentGpsLocation, but returns a GPSBabelRun whose result is
+        the GPXWaypoint (or None).
+        """
+        self.addAction('infile', gpsType.lower(), port, {'get_posn' : None})
+        self.captureStdOut()
+        return self.loop.start(self, convert=lambda r: r[1].wpts[0] if len(r[1].wpts) > 0 else None)
+
+    def awrite(self, fname, fmt, wpt=False, route=False, track=False, parseOutput=False):
+        """
+        As write, but returns a GPSBabelRun whose result is the output.
+        """
+        self.procWpts   = wpt
+        self.procRoutes = route
+        self.procTrack  = track
+        self.addAction('outfile', fmt, fname, {})
+        return self.loop.start(self, parseOutput = parseOutput, convert=lambda r: r[1])
+
+    def aread(self, fname, fmt, wpt=False, route=False, track=False, parseOutput=True):
+        """
+        As read, but returns a GPSBabelRun whose result is the output.
+        """
+        self.procWpts   = wpt
+        self.procRoutes = route
+        self.procTrack  = track
+        self.addAction('infile', fmt, fname, {})
+        self.captureStdOut()
+        return self.loop.start(self, parseOutput = parseOutput, convert=lambda r: r[1])
+
+class GPSBabelJob(object):
+    """
+    One conversion chain submitted to a GPSBabelPool.
+
+    Instance variables:
+        * index:      The position of the job in its batch
+        * spec:       The chain spec the job was built from
+        * returncode: The exit code of gpsbabel, once finished
+        * output:     The output of the chain as returned by execCmd, once
+                      finished
+        * error:      The exception raised while setting up, running, or
+                      parsing the output of the chain, or None
+        * timing:     The GPSBabelTiming of the chain, once finished, if the
+                      pool has an observer
+        * usage:      The GPSBabelUsage of the chain, once finished, or None
+                      if gpsbabel was not run
+    """
+    __slots__ = ['index', 'spec', 'returncode', 'output', 'error', 'timing', 'usage']
+
+    def __init__(self, index, spec):
+        """
+        Constructor
+        """
+        self.index      = index
+        self.spec       = spec
+        self.returncode = None
+        self.output     = None
+        self.error      = None
+        self.timing     = None
+        self.usage      = None
+
+class GPSBabelPool(object):
+    """
+    Runs batches of conversion chains, with up to a fixed number of
+    gpsbabel processes running at any one time.
+
+    Each chain in a batch is described by a spec, which is either:
+        * a list of tuples, each one naming a GPSBabel chain method
+          followed by its arguments. These are called in order on a fresh
+          GPSBabel. For example:
+              [('addInputFile', 'mydata.kml', 'kml'),
+               ('addFilter', 'simplify', {'count' : 100}),
+               ('captureStdOut',)]
+        * a function, which is passed a fresh GPSBabel to set up.
+        * a tuple of a ConversionPlan and a dictionary of the values for
+          its placeholders. This skips building and checking the chain
+          for every job.
+
+    Every chain becomes a GPSBabelJob. A chain which fails, whether by
+    being set up wrongly, by gpsbabel reporting an error, or by producing
+    output which cannot be parsed, only sets that job's error; the rest of
+    the batch carries on.
+
+    Parsing of the output can be moved into worker processes, so that it
+    is spread across all cores instead of being done by the process
+    driving gpsbabel. This requires the multiprocessing module (Python
+    2.6 and up), and parsing stays in-process without it.
+
+    Instance variables:
+        * size:     The most gpsbabel processes to run at once
+        * gpsbabel: The location of the gpsbabel command
+        * parsers:  The number of worker processes used to parse output
+        * executor: The GPSBabelExecutor which starts gpsbabel, or None to
+                    use the module's defaultExecutor
+        * observer: A function which is called with the GPSBabelTiming of
+                    every job, or None. See GPSBabel.observer.
+        * usage:    A GPSBabelUsage of every gpsbabel run by the pool, for
+                    sizing it. Reset it to GPSBabelUsage(runs=0) to start
+                    again.
+        * timeout, idleTimeout: The timeouts for each job, as for
+                    GPSBabel.execCmd. A job which runs out of time is
+                    stopped, and its error set to a TimeoutException.
+    """
+
+    chainMethods = ['addAction', 'addCharset', 'addFilter', 'addInputFile',
+                    'addInputFiles', 'addOutputFile', 'addOutputFiles',
+                    'captureStdOut', 'setInGpx']
+    """
+    The GPSBabel methods which may be named in a chain spec.
+    """
+
+    def __init__(self, size=4, loc="gpsbabel", parsers=0, executor=None, observer=None, timeout=None,
+                 idleTimeout=None):
+        """
+        Constructor.
+
+        In:
+            size: The most gpsbabel processes to run at once
+            loc, executor: As for GPSBabel
+            observer, timeout, idleTimeout: See the instance variables
+            parsers: The number of worker processes to parse output in. If
+                0, or multiprocessing is not available, output is parsed
+                in this process.
+        """
+        #The worker processes are started here, before any gpsbabel is
+        #running, so that they cannot inherit the pipes to gpsbabel.
+        self.size     = size
+        self.gpsbabel = loc
+        self.parsers  = parsers
+        self.executor = executor
+        self.observer = observer
+        self.usage    = GPSBabelUsage(runs=0)
+        self.timeout  = timeout
+        self.idleTimeout = idleTimeout
+        self.__workers = None
+        if parsers > 0 and multiprocessing is not None:
+            self.__workers = multiprocessing.Pool(parsers)
+
+    def close(self):
+        """
+        Shut down the parsing worker processes, if any.
+        """
+        if self.__workers is not None:
+            self.__workers.close()
+            self.__workers.join()
+            self.__workers = None
+
+    def runBatch(self, specs, parseOutput=True):
+        """
+        Run a batch of chains, and wait for all of them to finish.
+
+        In:
+            specs: An iterable of chain specs
+            parseOutput: If True, parse the output of each chain as a GPX
+                file
+
+        Out:
+            A list of GPSBabelJob, in the same order as specs
+        """
+        return list(self.iterBatch(specs, True, parseOutput))
+
+    def iterBatch(self, specs, ordered=False, parseOutput=True):
+        """
+        Run a batch of chains, generating each GPSBabelJob once it is
+        finished.
+
+        In:
+            specs: An iterable of chain specs. It is consumed only as
+                there is room to start more gpsbabel processes.
+            ordered: If True, jobs are generated in the same order as
+                specs. If False, they are generated as soon as they finish.
+            parseOutput: If True, parse the output of each chain as a GPX
+                file
+
+        Closing the generator before the end stops the jobs which are
+        still running. They, and any jobs which have finished but not been
+        generated yet, are thrown away.
+        """
+        loop = GPSBabelLoop()
+        pending = enumerate(specs)
+        exhausted = False
+        finished = []
+        parsing = []
+        held = {}
+        nextIndex = 0
+        done = False
+        try:
+            while True:
+                while not exhausted and len(loop.runs) < self.size:
+                    try:
+                        index, spec = pending.next()
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    self.__start(loop, GPSBabelJob(index, spec), parseOutput, finished, parsing)
+                for job, result in parsing[:]:
+                    if result.ready():
+                        parsing.remove((job, result))
+                        try:
+                            job.output = result.get()
+                        except Exception, why:
+                            job.error = why
+                        finished.append(job)
+                for job in finished:
+                    if not ordered:
+                        yield job
+                        continue
+                    held[job.index] = job
+                    while nextIndex in held:
+                        yield held.pop(nextIndex)
+                        nextIndex += 1
+                del finished[:]
+                if len(loop.runs) > 0:
+                    loop.runOnce(0.05 if len(parsing) > 0 else None)
+                elif len(parsing) > 0:
+                    parsing[0][1].wait(0.05)
+                elif exhausted:
+                    break
+            done = True
+        finally:
+            #If the generator is closed early, the jobs still running are
+            #stopped and waited for, and their output thrown away.
+            if not done:
+                names = [run.gps.stdoutname for run in loop.runs]
+                for run in loop.runs:
+                    run.cancel()
+                loop.run()
+                for name in names:
+                    if name is not None and os.path.exists(name): os.unlink(name)
+
+    def __start(self, loop, job, parseOutput, finished, parsing):
+        """
+        Set up a job's chain on a fresh GPSBabel and start it in loop.
+        """
+        gps = GPSBabel(self.gpsbabel, executor=self.executor)
+        gps.observer = self.observer
+        inWorker = parseOutput and self.__workers is not None
+        try:
+            cmd = None
+            if callable(job.spec):
+                job.spec(gps)
+            elif isinstance(job.spec, tuple) and isinstance(job.spec[0], ConversionPlan):
+                cmd = job.spec[0].setUp(gps, job.spec[1])
+            else:
+                for step in job.spec:
+                    if step[0] not in self.chainMethods:
+                        raise UnknownActionException("Error: Unknown chain method %s" % step[0])
+                    getattr(gps, step[0])(*step[1:])
+            run = loop.start(gps, cmd, parseOutput = parseOutput and not inWorker, timeout=self.timeout,
+                             idleTimeout=self.idleTimeout)
+        except Exception, why:
+            if gps.stdoutname is not None and os.path.exists(gps.stdoutname):
+                os.unlink(gps.stdoutname)
+            job.error = why
+            finished.append(job)
+            return
+        def ran(run):
+            job.returncode = run.returncode
+            job.output = run.output
+            job.error = run.error
+            job.timing = run.timing
+            job.usage = run.usage
+            if job.usage is not None: self.usage.add(job.usage)
+            if job.error is None and inWorker:
+                output = run.output if isinstance(run.output, bytearray) else "\n".join(run.output)
+                parsing.append((job, self.__workers.apply_async(gpxParse, (output, ))))
+            else:
+                finished.append(job)
+        run.addCallback(ran)
+
+def parseTime(value):
+    """
+    Convert a GPX time to a datetime, in UTC.
+
+    In:
+        value: The time, in ISO 8601 format, such as 2008-08-17T18:39:00Z.
+            Fractional seconds (2008-08-17T18:39:00.250Z) and UTC offsets
+            (2008-08-17T14:39:00-04:00) are also accepted.
+
+    Exceptions:
+        ValueError if value is not a valid time
+    """
+    prefix, seconds, microseconds, offset = _splitTime(value)
+    base = _timePrefix(prefix)[0]
+    if offset or seconds > 59:
+        return base + datetime.timedelta(0, seconds - offset, microseconds)
+    return base.replace(second=seconds, microsecond=microseconds)
+
+def parseEpoch(value):
+    """
+    Convert a GPX time to seconds since the epoch. See parseTime.
+
+    Out:
+        The number of seconds, as an int, or as a float if the time has
+        fractional seconds.
+    """
+    prefix, seconds, microseconds, offset = _splitTime(value)
+    epoch = _timePrefix(prefix)[1] + seconds - offset
+    if microseconds:
+        return epoch + microseconds / 1e6
+    return epoch
+
+#Times are nearly always in the form 2008-08-17T18:39:00Z, which is split
+#by position. Anything else is split by _timeRe, which is slower.
+_timeRe = re.compile(r'\s*(\d{4}-\d\d-\d\d[Tt ]\d\d:\d\d):(\d\d)(?:[.,](\d+))?(?:[Zz]|([+-])(\d\d):?(\d\d)?)?\s*$')
+
+def _splitTime(value):
+    """
+    Split a GPX time into its YYYY-MM-DDTHH:MM prefix, seconds,
+    microseconds, and offset from UTC in seconds.
+    """
+    if len(value) == 20 and value[19] == 'Z' and value[16] == ':':
+        return value[:16], int(value[17:19]), 0, 0
+    match = _timeRe.match(value)
+    if match is None:
+        raise ValueError('Invalid GPX time: %r' % (value))
+    prefix, seconds, fraction, sign, hours, minutes = match.groups()
+    microseconds = int((fraction + '00000')[:6]) if fraction else 0
+    offset = 0
+    if sign:
+        offset = int(hours) * 3600 + int(minutes or 0) * 60
+        if sign == '-': offset = -offset
+    return prefix, int(seconds), microseconds, offset
+
+#Points in a track are usually seconds apart, so consecutive times share
+#their prefix. Each prefix is converted once, and its datetime and epoch
+#seconds kept in _timeCache, which is emptied when it grows too large.
+_timeCache = {}
+
+def _timePrefix(prefix):
+    """
+    Out:
+        (datetime, epoch seconds) for a YYYY-MM-DDTHH:MM prefix
+    """
+    cached = _timeCache.get(prefix)
+    if cached is None:
+        if prefix[4] != '-' or prefix[7] != '-' or prefix[10] not in 'Tt ' or prefix[13] != ':':
+            raise ValueError('Invalid GPX time: %r' % (prefix))
+        base = datetime.datetime(int(prefix[:4]), int(prefix[5:7]), int(prefix[8:10]),
+                                 int(prefix[11:13]), int(prefix[14:16]))
+        if len(_timeCache) >= 4096: _timeCache.clear()
+        cached = _timeCache[prefix] = (base, calendar.timegm(base.utctimetuple()))
+    return cached
+
+def formatTime(value):
+    """
+    Convert a datetime to a GPX time, such as 2008-08-17T18:39:00Z. The
+    reverse of parseTime. A datetime without a time zone is taken to be in
+    UTC already.
+    """
+    if value.tzinfo is not None:
+        value = (value - value.utcoffset()).replace(tzinfo=None)
+    if value.microsecond:
+        return value.isoformat().rstrip('0') + 'Z'
+    return value.isoformat() + 'Z'
+
+def _xmlTags(fields, skip):
+    """
+    Out:
+        A list of (field, start tag, end tag) for each of fields, except
+        those in skip, for use by _xmlElements
+    """
+    return [(i, '<%s>' % (i), '</%s>' % (i)) for i in fields if i not in skip]
+
+def _xmlElements(obj, tags):
+    """
+    Out:
+        The XML elements for each of the fields of obj listed in tags (see
+        _xmlTags) which is not None, as one string
+    """
+    output = []
+    for attr, start, end in tags:
+        value = getattr(obj, attr)
+        if value is not None:
+            output.append(start + _xmlFormats.get(value.__class__, _xmlText)(value) + end)
+    return ''.join(output)
+
+def _xmlText(value):
+    """
+    Out:
+        value as XML text, escaped if it is a string, and in GPX format if
+        it is a time
+    """
+    if isinstance(value, basestring):
+        return xml.sax.saxutils.escape(value)
+    if isinstance(value, datetime.datetime):
+        return formatTime(value)
+    return str(value)
+
+_xmlFormats = {str : xml.sax.saxutils.escape, unicode : xml.sax.saxutils.escape, Decimal : str, int : str,
+               datetime.datetime : formatTime}
+"""
+The function which formats each of the common types as XML text, so that
+_xmlElements does not have to check the type in _xmlText.
+"""
+
+def _xmlAttr(value):
+    """
+    Out:
+        value as the text of an XML attribute, without the quotes
+    """
+    if isinstance(value, basestring):
+        return xml.sax.saxutils.escape(value, {'"' : '&quot;'})
+    return str(value)
+
+class GPXData(object):
+    """
+    The root container for gpx data objects.
+
+    All of these objects function similarly. Define the legal instance
+    members, define a toXml method to convert data to legal gpx format, and
+    a finalize method to allow any postprocessing to occur when loading xml
+    data into them (for instance, this could be used to convert floats from
+    string to decimal).
+
+    The object hierarchy for the GPXData closely mirrors the XML
+    representation of those objects. As such, when looking at the GPXData
+    object, this is the expected representation of a .gpx/.loc file after
+    it has been parsed:
+
+    GPXData
+        wpts: list of GPXWaypoint
+            GPXWaypoint.__slots__ lists legal attributes
+        rtes: list of GPXRoute
+            GPXRoute.__slots__ lists legal attributes
+                rtepts: list of GPXWaypoint
+        trks: list of GPXTrack
+            GPXTrack.__slots__ lists legal attributes
+                trksegs: list of GPXTrackSeg
+                    GPXTrackSeg.__slots__ lists legal attributes
+                        trkpts: list of GPXWaypoint
+
+    wpts is a list of GPXWaypoint
+    rtes is a list of GPXRoute
     trks is a list of GPXTracks
     """
-    __slots__ = ['wpts', 'rtes', 'trks']
+    __slots__ = ['wpts', 'rtes', 'trks']
+
+    def __init__(self):
+        """
+        Constructor
+        """
+        self.wpts = []
+        self.rtes = []
+        self.trks = []
+
+    def __iter__(self):
+        return self.next()
+
+    def next(self):
+        yield '<gpx version="1.1" creator="Python GPSBabel">'
+        for wpt in self.wpts:
+            yield wpt.toXml('wpt')
+        for rte in self.rtes:
+            rte.xmltag = 'rte'
+            for i in rte:
+                yield i
+        for trk in self.trks:
+            trk.xmltag = 'trk'
+            for i in trk:
+                yield i
+        yield '</gpx>'
+
+    def toXml(self):
+        """
+        Return XML representation.
+
+        Out:
+            This object in XML
+        """
+        return ''.join(self)
+
+    def writeTo(self, fileobj):
+        """
+        Write the XML representation to a file, encoded as UTF-8. It is
+        written in pieces of about 64KB, so it never has to be held in
+        memory all at once.
+
+        In:
+            fileobj: The file, or any object with a write method
+        """
+        output = []
+        size = 0
+        for i in self:
+            if isinstance(i, unicode): i = i.encode('utf-8')
+            output.append(i)
+            size += len(i)
+            if size >= 65536:
+                fileobj.write(''.join(output))
+                del output[:]
+                size = 0
+        fileobj.write(''.join(output))
+
+    def finalize(self):
+        """
+        Any post load of XML steps are placed here.
+        """
+        pass
+
+    def makeColumnar(self):
+        """
+        Store the points of every route and track segment in a
+        GPXColumns, rather than a list. See GPXColumns.
+        """
+        for rte in self.rtes:
+            rte.makeColumnar()
+        for trk in self.trks:
+            for trkseg in trk.trksegs:
+                trkseg.makeColumnar()
+
+    def copy(self):
+        """
+        Copy the routes, tracks and track segments, so that points can be
+        added to or removed from the copy without changing this one. The
+        points themselves, and the lists holding them, are shared, so the
+        copy must replace rather than change a list of points.
+
+        Out:
+            The new GPXData
+        """
+        output = GPXData()
+        output.wpts = list(self.wpts)
+        output.rtes = [copy.copy(rte) for rte in self.rtes]
+        for trk in self.trks:
+            trk = copy.copy(trk)
+            trk.trksegs = [copy.copy(trkseg) for trkseg in trk.trksegs]
+            output.trks.append(trk)
+        return output
+
+    def simplify(self, count=None, error=None):
+        """
+        Simplify every route and track segment. See
+        GPXPointMetrics.simplify.
+
+        Out:
+            The number of points removed
+        """
+        removed = 0
+        for rte in self.rtes:
+            removed += rte.simplify(count, error)
+        for trk in self.trks:
+            for trkseg in trk.trksegs:
+                removed += trkseg.simplify(count, error)
+        return removed
+
+class GPXWaypoint(object):
+    """
+    Container for wptType objects
+    """
+    __slots__ = ['lat', 'lon', 'ele', 'time', 'magvar', 'geoidheight', 'name', 'cmt', 'desc',
+                 'src', 'link', 'sym', 'type', 'fix', 'sat', 'hdop', 'vdop', 'pdop',
+                 'ageofdgpsdata', 'dgpsid', 'xmltag', 'speed']
+
+    def __init__(self):
+        """
+        Constructor
+        """
+        #Waypoints are created by the hundred thousand when parsing tracks,
+        #so the slots are assigned directly, rather than in a setattr loop.
+        self.lat = self.lon = self.ele = self.time = self.magvar = self.geoidheight = None
+        self.name = self.cmt = self.desc = self.src = self.link = self.sym = self.type = None
+        self.fix = self.sat = self.hdop = self.vdop = self.pdop = self.ageofdgpsdata = None
+        self.dgpsid = self.xmltag = self.speed = None
+
+    conversions = [(i, Decimal) for i in ['lat', 'lon', 'ele', 'magvar', 'geoidheight', 'hdop', 'vdop', 'pdop',
+                                          'ageofdgpsdata', 'speed']] + \
+                  [('sat', int), ('dgpsid', int), ('time', parseTime)]
+    """
+    The fields which finalize converts from the text in the GPX, and the
+    function which converts each one.
+    """
+    xmlTags = _xmlTags(__slots__, ['lat', 'lon', 'xmltag'])
+
+    def __iter__(self):
+        return self.next()
+
+    def next(self):
+        yield self.toXml(self.xmltag)
+
+    def toXml(self, tag):
+        """
+        Return XML representation.
+
+        In:
+            tag: The XML tag to use around this object's XML representation
+
+        Out:
+            This object in XML
+        """
+        self.xmltag = tag
+        return '<%s lat="%s" lon="%s">%s</%s>' % (tag, _xmlAttr(self.lat), _xmlAttr(self.lon),
+                                                 _xmlElements(self, self.xmlTags), tag)
+
+    def finalize(self):
+        """
+        Any post load of XML steps are placed here.
+        """
+        for attr, convert in self.conversions:
+            value = getattr(self, attr)
+            if value is not None:
+                setattr(self, attr, convert(value))
+
+class GPXColumns(object):
+    """
+    Columnar storage for a list of GPXWaypoints, for use as the trkpts of
+    a GPXTrackSeg or the rtepts of a GPXRoute.
+
+    Rather than one object per point, the lat, lon, ele, time, hdop,
+    speed, and sat of every point are each kept in one array('d'), with
+    NaN where a point has no value. time is stored as seconds since the
+    epoch. Every other field (name, desc, etc.) is rare enough on track
+    and route points that it is kept in a side table, only for the points
+    which have it.
+
+    GPXColumns behaves like a list of GPXWaypoints: points can be
+    appended, counted, indexed, sliced, and iterated over. Points are only
+    created when they are indexed or iterated over, and are copies, so
+    changing them does not change the stored data. Numbers are stored as
+    floats, so a point's Decimals may lose trailing zeros.
+
+    Instance variables:
+        * tag:    The XML tag used for the points (trkpt or rtept)
+        * arrays: A dictionary of the arrays, one per name in columns
+        * extras: A dictionary of point index to a dictionary of that
+                  point's other fields
+    """
+    columns = ['lat', 'lon', 'ele', 'time', 'hdop', 'speed', 'sat']
+    """
+    The fields of GPXWaypoint which are stored in arrays.
+    """
+    extraFields = [i for i in GPXWaypoint.__slots__ if i not in columns and i != 'xmltag']
+    nan = float('nan')
+
+    def __init__(self, pts=[], tag='trkpt'):
+        """
+        Constructor
+
+        In:
+            pts: GPXWaypoints to add, either finalized or straight from
+                the parser
+            tag: The XML tag used for the points
+        """
+        self.tag = tag
+        self.arrays = {}
+        for i in self.columns:
+            self.arrays[i] = array.array('d')
+        self.extras = {}
+        self.extend(pts)
+
+    def __len__(self):
+        return len(self.arrays['lat'])
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in xrange(*index.indices(len(self)))]
+        if index < 0: index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError('GPXColumns index out of range')
+        wpt = GPXWaypoint()
+        for attr, value in self.extras.get(index, {}).items():
+            setattr(wpt, attr, value)
+        wpt.finalize()
+        for attr in self.columns:
+            value = self.arrays[attr][index]
+            if value != value:
+                continue
+            if attr == 'time':
+                value = datetime.datetime(1970, 1, 1) + datetime.timedelta(seconds=value)
+            elif attr == 'sat':
+                value = int(value)
+            else:
+                value = Decimal(repr(value))
+            setattr(wpt, attr, value)
+        wpt.xmltag = self.tag
+        return wpt
+
+    def append(self, wpt):
+        """
+        Add a GPXWaypoint to the end.
+        """
+        nan = self.nan
+        for attr in self.columns:
+            value = getattr(wpt, attr)
+            if value is None:
+                value = nan
+            elif attr == 'time':
+                if isinstance(value, datetime.datetime):
+                    delta = value - datetime.datetime(1970, 1, 1)
+                    value = delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
+                else:
+                    value = parseEpoch(value)
+            self.arrays[attr].append(float(value))
+        extras = None
+        for attr in self.extraFields:
+            value = getattr(wpt, attr)
+            if value is not None:
+                if extras is None: extras = self.extras[len(self) - 1] = {}
+                extras[attr] = value
+
+    def extend(self, pts):
+        """
+        Add each of a sequence of GPXWaypoints to the end.
+        """
+        for wpt in pts:
+            self.append(wpt)
+
+    def take(self, indexes):
+        """
+        Out:
+            A new GPXColumns holding only the points at indexes, in the
+            order given
+        """
+        output = GPXColumns([], self.tag)
+        for attr in self.columns:
+            values = self.arrays[attr]
+            if numpy is not None and len(values):
+                output.arrays[attr].fromstring(_floats(values)[numpy.asarray(indexes, dtype=numpy.intp)].tostring())
+            else:
+                output.arrays[attr] = array.array('d', [values[i] for i in indexes])
+        if self.extras:
+            for i in xrange(len(indexes)):
+                if indexes[i] in self.extras:
+                    output.extras[i] = self.extras[indexes[i]]
+        return output
+
+    def copy(self):
+        """
+        Out:
+            A new GPXColumns holding the same points
+        """
+        output = GPXColumns([], self.tag)
+        for attr in self.columns:
+            output.arrays[attr] = self.arrays[attr][:]
+        output.extras = dict(self.extras)
+        return output
+
+    def extendColumns(self, other):
+        """
+        Add every point of another GPXColumns to the end.
+        """
+        offset = len(self)
+        for attr in self.columns:
+            self.arrays[attr].extend(other.arrays[attr])
+        for i, extras in other.extras.items():
+            self.extras[i + offset] = extras
+
+    def column(self, name):
+        """
+        Out:
+            The array('d') holding one of the columns. See columns.
+        """
+        return self.arrays[name]
+
+    def numpyColumn(self, name):
+        """
+        Out:
+            A NumPy view of the array holding one of the columns, which
+            shares its memory rather than copying it.
+
+        Exceptions:
+            ImportError if NumPy is not installed
+        """
+        if numpy is None:
+            raise ImportError('NumPy is not installed')
+        return numpy.frombuffer(self.arrays[name], dtype=numpy.float64)
+
+    def next(self, tag=None):
+        """
+        Generate the XML for each point, exactly as the equivalent
+        GPXWaypoint would, but without creating any GPXWaypoints.
+        """
+        if tag is None: tag = self.tag
+        arrays = [(attr, start, end, self.arrays.get(attr)) for attr, start, end in GPXWaypoint.xmlTags]
+        lats = self.arrays['lat']
+        lons = self.arrays['lon']
+        extras = self.extras
+        for i in xrange(len(lats)):
+            output = ['<%s lat="%s" lon="%s">' % (tag, _num(lats[i]), _num(lons[i]))]
+            extra = extras.get(i)
+            for attr, start, end, values in arrays:
+                if values is None:
+                    if extra is None or attr not in extra: continue
+                    value = _xmlText(extra[attr])
+                else:
+                    value = values[i]
+                    if value != value: continue
+                    if attr == 'time': value = formatTime(datetime.datetime(1970, 1, 1) + datetime.timedelta(seconds=value))
+                    elif attr == 'sat': value = str(int(value))
+                    else: value = _num(value)
+                output.append(start + value + end)
+            output.append('</%s>' % (tag))
+            yield ''.join(output)
+
+def _num(value):
+    """
+    Format a float as the shortest string which reads back as the same
+    float, dropping any trailing .0
+    """
+    value = repr(value)
+    return value[:-2] if value.endswith('.0') else value
+
+EARTH_RADIUS = 6371008.8
+"""
+The mean radius of the earth, in meters, used for haversine distances.
+"""
+
+def pointColumns(pts):
+    """
+    Get the positions, elevations, and times of a list of points as
+    columns of floats, for use with the geometry functions below.
+
+    In:
+        pts: A list of GPXWaypoints, or a GPXColumns
+
+    Out:
+        (lats, lons, eles, times): lats and lons are in degrees, and times
+        in seconds since the epoch. Missing values are NaN. For a
+        GPXColumns, these are its own arrays, not copies.
+    """
+    if isinstance(pts, GPXColumns):
+        return tuple([pts.arrays[i] for i in ('lat', 'lon', 'ele', 'time')])
+    lats, lons, eles, times = [array.array('d') for i in xrange(4)]
+    nan = GPXColumns.nan
+    for pt in pts:
+        lats.append(float(pt.lat) if pt.lat is not None else nan)
+        lons.append(float(pt.lon) if pt.lon is not None else nan)
+        eles.append(float(pt.ele) if pt.ele is not None else nan)
+        value = pt.time
+        if value is None:
+            value = nan
+        elif isinstance(value, datetime.datetime):
+            value = calendar.timegm(value.utctimetuple()) + value.microsecond / 1e6
+        else:
+            value = parseEpoch(value)
+        times.append(value)
+    return lats, lons, eles, times
+
+#Each of the geometry functions works on whole columns at once. With
+#NumPy, that is done with array operations; without it, with list
+#comprehensions over the columns, which is much slower, but needs nothing
+#outside the standard library. Results are NumPy arrays when NumPy is
+#installed, and array('d') otherwise.
+
+def _floats(values):
+    """
+    Out:
+        values as a NumPy array of floats, sharing memory with values if it
+        is an array('d')
+    """
+    if isinstance(values, array.array) and values.typecode == 'd':
+        if len(values) == 0: return numpy.zeros(0)
+        return numpy.frombuffer(values, dtype=numpy.float64)
+    return numpy.asarray(values, dtype=numpy.float64)
+
+def segmentLengths(lats, lons, method='haversine'):
+    """
+    Find the distance between each pair of consecutive points.
+
+    In:
+        lats, lons: The position of each point, in degrees
+        method: 'haversine', which treats the earth as a sphere, or
+            'vincenty', which uses the WGS-84 ellipsoid and is accurate to
+            within a millimeter, but several times slower
+
+    Out:
+        The distances, in meters, one fewer than there are points
+
+    Exceptions:
+        UnknownMethodException if method is not one of the above
+    """
+    if method not in ('haversine', 'vincenty'):
+        raise UnknownMethodException('Error: Unknown distance method %s' % method)
+    if numpy is not None:
+        lat = numpy.radians(_floats(lats))
+        lon = numpy.radians(_floats(lons))
+        if method == 'vincenty':
+            return _vincentyArrays(lat[:-1], lon[:-1], lat[1:], lon[1:])
+        h = numpy.sin((lat[1:] - lat[:-1]) * 0.5) ** 2 + \
+            numpy.cos(lat[:-1]) * numpy.cos(lat[1:]) * numpy.sin((lon[1:] - lon[:-1]) * 0.5) ** 2
+        return 2 * EARTH_RADIUS * numpy.arcsin(numpy.sqrt(numpy.minimum(h, 1.0)))
+    lat = map(math.radians, lats)
+    lon = map(math.radians, lons)
+    pairs = itertools.izip(lat, itertools.islice(lat, 1, None), lon, itertools.islice(lon, 1, None))
+    if method == 'vincenty':
+        return array.array('d', [_vincenty(a, c, b, d) for a, b, c, d in pairs])
+    sin, cos, asin, sqrt, r = math.sin, math.cos, math.asin, math.sqrt, 2 * EARTH_RADIUS
+    return array.array('d', [r * asin(sqrt(min(1.0, sin((b - a) * 0.5) ** 2 + cos(a) * cos(b) * sin((d - c) * 0.5) ** 2)))
+                             for a, b, c, d in pairs])
+
+def cumulativeDistance(lats, lons, method='haversine'):
+    """
+    Out:
+        The distance, in meters, from the first point to each point along
+        the way, starting with 0. See segmentLengths.
+    """
+    lengths = segmentLengths(lats, lons, method)
+    if numpy is not None:
+        if len(lats) == 0: return numpy.zeros(0)
+        return numpy.concatenate(([0.0], numpy.cumsum(lengths)))
+    total = 0.0
+    output = array.array('d', [0.0])
+    for length in lengths:
+        total += length
+        output.append(total)
+    return output[:len(lats)]
+
+def bearings(lats, lons):
+    """
+    Out:
+        The initial bearing from each point to the next, in degrees
+        clockwise from north, one fewer than there are points
+    """
+    if numpy is not None:
+        lat = numpy.radians(_floats(lats))
+        lon = numpy.radians(_floats(lons))
+        dlon = lon[1:] - lon[:-1]
+        y = numpy.sin(dlon) * numpy.cos(lat[1:])
+        x = numpy.cos(lat[:-1]) * numpy.sin(lat[1:]) - numpy.sin(lat[:-1]) * numpy.cos(lat[1:]) * numpy.cos(dlon)
+        return numpy.degrees(numpy.arctan2(y, x)) % 360
+    lat = map(math.radians, lats)
+    lon = map(math.radians, lons)
+    sin, cos, atan2, degrees = math.sin, math.cos, math.atan2, math.degrees
+    return array.array('d', [degrees(atan2(sin(d - c) * cos(b), cos(a) * sin(b) - sin(a) * cos(b) * cos(d - c))) % 360
+                             for a, b, c, d in itertools.izip(lat, itertools.islice(lat, 1, None),
+                                                              lon, itertools.islice(lon, 1, None))])
+
+def distancesFrom(lats, lons, lat, lon):
+    """
+    Out:
+        The haversine distance in meters from one position to each point,
+        NaN for points with no position
+    """
+    lat, lon = math.radians(lat), math.radians(lon)
+    if numpy is not None:
+        lat2 = numpy.radians(_floats(lats))
+        lon2 = numpy.radians(_floats(lons))
+        h = numpy.sin((lat2 - lat) * 0.5) ** 2 + math.cos(lat) * numpy.cos(lat2) * numpy.sin((lon2 - lon) * 0.5) ** 2
+        return 2 * EARTH_RADIUS * numpy.arcsin(numpy.sqrt(numpy.minimum(h, 1.0)))
+    sin, cos, asin, sqrt, r, cos1 = math.sin, math.cos, math.asin, math.sqrt, 2 * EARTH_RADIUS, math.cos(lat)
+    return array.array('d', [r * asin(sqrt(min(1.0, sin((b - lat) * 0.5) ** 2 + cos1 * cos(b) * sin((d - lon) * 0.5) ** 2)))
+                             for b, d in itertools.izip(map(math.radians, lats), map(math.radians, lons))])
+
+def speeds(lats, lons, times, method='haversine'):
+    """
+    Out:
+        The average speed between each point and the next, in meters per
+        second, one fewer than there are points. The speed is NaN where
+        either time is missing, or they are not increasing.
+    """
+    lengths = segmentLengths(lats, lons, method)
+    if numpy is not None:
+        t = _floats(times)
+        dt = t[1:] - t[:-1]
+        moving = dt > 0
+        return numpy.where(moving, lengths / numpy.where(moving, dt, 1.0), numpy.nan)
+    nan = GPXColumns.nan
+    return array.array('d', [length / (b - a) if b - a > 0 else nan
+                             for length, a, b in itertools.izip(lengths, times, itertools.islice(times, 1, None))])
+
+def boundingBox(lats, lons):
+    """
+    Out:
+        (minlat, minlon, maxlat, maxlon) of the points which have a
+        position, or None if none do
+    """
+    if numpy is not None:
+        lat = _floats(lats)
+        lon = _floats(lons)
+        valid = ~(numpy.isnan(lat) | numpy.isnan(lon))
+        if not valid.any(): return None
+        lat = lat[valid]
+        lon = lon[valid]
+        return (float(lat.min()), float(lon.min()), float(lat.max()), float(lon.max()))
+    valid = [(a, b) for a, b in itertools.izip(lats, lons) if a == a and b == b]
+    if not valid: return None
+    lat = [a for a, b in valid]
+    lon = [b for a, b in valid]
+    return (min(lat), min(lon), max(lat), max(lon))
+
+def elevationChange(eles):
+    """
+    Out:
+        (gain, loss): The total of every climb, and of every descent, in
+        meters, between the points which have an elevation. Both are
+        positive.
+    """
+    if numpy is not None:
+        ele = _floats(eles)
+        change = numpy.diff(ele[~numpy.isnan(ele)])
+        return (float(change[change > 0].sum()), float(-change[change < 0].sum()))
+    ele = [i for i in eles if i == i]
+    gain = loss = 0.0
+    for a, b in itertools.izip(ele, itertools.islice(ele, 1, None)):
+        if b > a: gain += b - a
+        else: loss += a - b
+    return (gain, loss)
+
+def duration(times):
+    """
+    Out:
+        The seconds from the first time to the last, ignoring missing
+        times, or None if there are fewer than two times
+    """
+    if numpy is not None:
+        valid = _floats(times)
+        valid = valid[~numpy.isnan(valid)]
+    else:
+        valid = [i for i in times if i == i]
+    if len(valid) < 2: return None
+    return float(valid[-1] - valid[0])
+
+def _vincenty(lat1, lon1, lat2, lon2):
+    """
+    Out:
+        The distance in meters between two points, given in radians, on
+        the WGS-84 ellipsoid, by Vincenty's inverse formula
+    """
+    a, f = 6378137.0, 1 / 298.257223563
+    b = a * (1 - f)
+    sin, cos = math.sin, math.cos
+    L = lon2 - lon1
+    U1 = math.atan((1 - f) * math.tan(lat1))
+    U2 = math.atan((1 - f) * math.tan(lat2))
+    sinU1, cosU1, sinU2, cosU2 = sin(U1), cos(U1), sin(U2), cos(U2)
+    lam = L
+    for i in xrange(200):
+        sinLam, cosLam = sin(lam), cos(lam)
+        sinSigma = math.sqrt((cosU2 * sinLam) ** 2 + (cosU1 * sinU2 - sinU1 * cosU2 * cosLam) ** 2)
+        if sinSigma == 0:
+            return 0.0
+        cosSigma = sinU1 * sinU2 + cosU1 * cosU2 * cosLam
+        sigma = math.atan2(sinSigma, cosSigma)
+        sinAlpha = cosU1 * cosU2 * sinLam / sinSigma
+        cos2Alpha = 1 - sinAlpha ** 2
+        cos2SigmaM = cosSigma - 2 * sinU1 * sinU2 / cos2Alpha if cos2Alpha else 0.0
+        C = f / 16 * cos2Alpha * (4 + f * (4 - 3 * cos2Alpha))
+        previous = lam
+        lam = L + (1 - C) * f * sinAlpha * (sigma + C * sinSigma * (cos2SigmaM + C * cosSigma * (-1 + 2 * cos2SigmaM ** 2)))
+        if abs(lam - previous) < 1e-12:
+            break
+    uSq = cos2Alpha * (a * a - b * b) / (b * b)
+    A = 1 + uSq / 16384 * (4096 + uSq * (-768 + uSq * (320 - 175 * uSq)))
+    B = uSq / 1024 * (256 + uSq * (-128 + uSq * (74 - 47 * uSq)))
+    deltaSigma = B * sinSigma * (cos2SigmaM + B / 4 * (cosSigma * (-1 + 2 * cos2SigmaM ** 2) -
+                                                       B / 6 * cos2SigmaM * (-3 + 4 * sinSigma ** 2) * (-3 + 4 * cos2SigmaM ** 2)))
+    return b * A * (sigma - deltaSigma)
+
+def _vincentyArrays(lat1, lon1, lat2, lon2):
+    """
+    _vincenty, over NumPy arrays of points. Every pair is iterated until
+    the slowest has converged.
+    """
+    a, f = 6378137.0, 1 / 298.257223563
+    b = a * (1 - f)
+    sin, cos = numpy.sin, numpy.cos
+    L = lon2 - lon1
+    U1 = numpy.arctan((1 - f) * numpy.tan(lat1))
+    U2 = numpy.arctan((1 - f) * numpy.tan(lat2))
+    sinU1, cosU1, sinU2, cosU2 = sin(U1), cos(U1), sin(U2), cos(U2)
+    lam = L
+    for i in xrange(200):
+        sinLam, cosLam = sin(lam), cos(lam)
+        sinSigma = numpy.sqrt((cosU2 * sinLam) ** 2 + (cosU1 * sinU2 - sinU1 * cosU2 * cosLam) ** 2)
+        same = sinSigma == 0
+        sinSigma = numpy.where(same, 1.0, sinSigma)
+        cosSigma = sinU1 * sinU2 + cosU1 * cosU2 * cosLam
+        sigma = numpy.arctan2(sinSigma, cosSigma)
+        sinAlpha = cosU1 * cosU2 * sinLam / sinSigma
+        cos2Alpha = 1 - sinAlpha ** 2
+        equatorial = cos2Alpha == 0
+        cos2SigmaM = numpy.where(equatorial, 0.0, cosSigma - 2 * sinU1 * sinU2 / numpy.where(equatorial, 1.0, cos2Alpha))
+        C = f / 16 * cos2Alpha * (4 + f * (4 - 3 * cos2Alpha))
+        previous = lam
+        lam = L + (1 - C) * f * sinAlpha * (sigma + C * sinSigma * (cos2SigmaM + C * cosSigma * (-1 + 2 * cos2SigmaM ** 2)))
+        if not (numpy.abs(lam - previous) >= 1e-12).any():
+            break
+    uSq = cos2Alpha * (a * a - b * b) / (b * b)
+    A = 1 + uSq / 16384 * (4096 + uSq * (-768 + uSq * (320 - 175 * uSq)))
+    B = uSq / 1024 * (256 + uSq * (-128 + uSq * (74 - 47 * uSq)))
+    deltaSigma = B * sinSigma * (cos2SigmaM + B / 4 * (cosSigma * (-1 + 2 * cos2SigmaM ** 2) -
+                                                       B / 6 * cos2SigmaM * (-3 + 4 * sinSigma ** 2) * (-3 + 4 * cos2SigmaM ** 2)))
+    return numpy.where(same, 0.0, b * A * (sigma - deltaSigma))
+
+def simplifyIndices(lats, lons, count=None, error=None):
+    """
+    Choose which points to keep when simplifying a line, by the
+    Douglas-Peucker algorithm: the points furthest from the line through
+    the points kept so far are kept first. Distance from the line is
+    crosstrack error, the distance to the nearest point on the great
+    circle arc between the two kept points either side. The first and last
+    points are always kept, and points with no position never are.
+
+    In:
+        lats, lons: The position of each point, in degrees
+        count: Keep this many points, or all of them if there are fewer
+        error: Keep every point further than this many meters from the
+            simplified line
+
+        Exactly one of count and error must be given.
+
+    Out:
+        The indexes of the points to keep, in order
+    """
+    if (count is None) == (error is None):
+        raise ValueError('Exactly one of count and error must be given')
+    if numpy is not None:
+        lat = numpy.radians(_floats(lats))
+        lon = numpy.radians(_floats(lons))
+        valid = numpy.flatnonzero((lat == lat) & (lon == lon))
+        lat, lon = lat[valid], lon[valid]
+        vectors = numpy.column_stack((numpy.cos(lat) * numpy.cos(lon), numpy.cos(lat) * numpy.sin(lon), numpy.sin(lat)))
+    else:
+        valid = [i for i in xrange(len(lats)) if lats[i] == lats[i] and lons[i] == lons[i]]
+        vectors = [(math.cos(a) * math.cos(b), math.cos(a) * math.sin(b), math.sin(a))
+                   for a, b in [(math.radians(lats[i]), math.radians(lons[i])) for i in valid]]
+    n = len(valid)
+    if n <= 2 or (count is not None and count >= n):
+        return [int(i) for i in valid]
+    keep = [0, n - 1]
+    if count is not None:
+        #Split the range with the worst point first, until enough points
+        #have been kept.
+        heap = [_worstPoint(vectors, 0, n - 1)]
+        while heap and len(keep) < count:
+            worst, start, end, index = heapq.heappop(heap)
+            keep.append(index)
+            for start, end in ((start, index), (index, end)):
+                if end - start > 1:
+                    heapq.heappush(heap, _worstPoint(vectors, start, end))
+    else:
+        #Split each range at its worst point, until none is in error.
+        angle = error / EARTH_RADIUS
+        ranges = [(0, n - 1)]
+        while ranges:
+            start, end = ranges.pop()
+            worst, start, end, index = _worstPoint(vectors, start, end)
+            if -worst > angle:
+                keep.append(index)
+                for start, end in ((start, index), (index, end)):
+                    if end - start > 1:
+                        ranges.append((start, end))
+    keep.sort()
+    return [int(valid[i]) for i in keep]
+
+def _cross(a, b):
+    return (a[1] * b[2] - a[2] * b[1], a[2] * b[0] - a[0] * b[2], a[0] * b[1] - a[1] * b[0])
+
+def _chord(p, q):
+    """
+    Out:
+        The angle between two unit vectors, from the length of the chord
+        between them, which unlike the dot product is accurate for small
+        angles
+    """
+    return 2 * math.asin(min(1.0, math.sqrt((p[0] - q[0]) ** 2 + (p[1] - q[1]) ** 2 + (p[2] - q[2]) ** 2) * 0.5))
+
+def _worstPoint(vectors, start, end):
+    """
+    Find the point between start and end which is furthest from the arc
+    between them.
+
+    In:
+        vectors: The unit vector of each point, as rows of a NumPy array,
+            or a list of tuples
+        start, end: The indexes of the ends of the arc
+
+    Out:
+        (-angle, start, end, index): The angle is the crosstrack error,
+        in radians. It is negated so that the worst point comes first in a
+        heap.
+    """
+    #A point is beside the arc if it is on the b side of the plane through
+    #a perpendicular to it, and on the a side of the one through b. Its
+    #error is then its angle from the plane of the arc, whose sine is its
+    #dot product with the plane's normal. Otherwise, its error is its
+    #angle from the nearer end.
+    a, b = tuple(vectors[start]), tuple(vectors[end])
+    n = _cross(a, b)
+    size = math.sqrt(n[0] ** 2 + n[1] ** 2 + n[2] ** 2)
+    if size < 1e-15:
+        n = na = bn = (0.0, 0.0, 0.0)
+    else:
+        n = (n[0] / size, n[1] / size, n[2] / size)
+        na, bn = _cross(n, a), _cross(b, n)
+    if numpy is not None:
+        p = vectors[start + 1:end]
+        dots = p.dot(numpy.array([n, na, bn]).T)
+        angles = numpy.arcsin(numpy.minimum(numpy.abs(dots[:, 0]), 1.0))
+        outside = numpy.flatnonzero((dots[:, 1] < 0) | (dots[:, 2] < 0)) if size >= 1e-15 else numpy.arange(len(p))
+        if len(outside):
+            q = p[outside]
+            toA = 2 * numpy.arcsin(numpy.minimum(numpy.sqrt(((q - a) ** 2).sum(1)) * 0.5, 1.0))
+            toB = 2 * numpy.arcsin(numpy.minimum(numpy.sqrt(((q - b) ** 2).sum(1)) * 0.5, 1.0))
+            angles[outside] = numpy.minimum(toA, toB)
+        index = int(angles.argmax())
+        return (-float(angles[index]), start, end, start + 1 + index)
+    worst = (-1.0, start + 1)
+    for index in xrange(start + 1, end):
+        p = vectors[index]
+        if size >= 1e-15 and p[0] * na[0] + p[1] * na[1] + p[2] * na[2] >= 0 and \
+           p[0] * bn[0] + p[1] * bn[1] + p[2] * bn[2] >= 0:
+            angle = math.asin(min(1.0, abs(p[0] * n[0] + p[1] * n[1] + p[2] * n[2])))
+        else:
+            angle = min(_chord(p, a), _chord(p, b))
+        if angle > worst[0]:
+            worst = (angle, index)
+    return (-worst[0], start, end, worst[1])
+
+def _slicePoints(pts, start, end):
+    """
+    Out:
+        The points from start up to end, as a new list or GPXColumns
+    """
+    if isinstance(pts, GPXColumns):
+        return pts.take(numpy.arange(start, end) if numpy is not None else xrange(start, end))
+    return pts[start:end]
+
+def _takePoints(pts, indexes):
+    """
+    Out:
+        The points at indexes, as a new list or GPXColumns
+    """
+    if isinstance(pts, GPXColumns):
+        return pts.take(indexes)
+    return [pts[i] for i in indexes]
+
+def _joinPoints(parts, tag='trkpt'):
+    """
+    Out:
+        The points of each of parts, one after another, as a GPXColumns if
+        every part is one, and as a list otherwise
+    """
+    if parts and all([isinstance(pts, GPXColumns) for pts in parts]):
+        output = GPXColumns([], tag)
+        for pts in parts:
+            output.extendColumns(pts)
+        return output
+    output = []
+    for pts in parts:
+        output.extend(pts)
+    return output
+
+def _timeBreaks(times, interval=None):
+    """
+    Find where a list of points should be split.
+
+    In:
+        times: The time of each point, in seconds since the epoch
+        interval: Split where more than this many seconds pass between
+            two points, or, if None, where the UTC date changes
+
+    Out:
+        The index of the first point of each piece but the first
+    """
+    if numpy is not None:
+        times = _floats(times)
+        if interval is None: times = numpy.floor(times / 86400)
+        gaps = times[1:] - times[:-1]
+        return [int(i) + 1 for i in numpy.flatnonzero(gaps > interval if interval is not None else gaps != 0)
+                if gaps[i] == gaps[i]]
+    if interval is None:
+        times = [math.floor(t / 86400) for t in times]
+        return [i for i in xrange(1, len(times)) if times[i] != times[i - 1] and times[i] == times[i] and
+                times[i - 1] == times[i - 1]]
+    return [i for i in xrange(1, len(times)) if times[i] - times[i - 1] > interval]
+
+def _timesWithin(times, start=None, stop=None):
+    """
+    Out:
+        The indexes of the times from start up to, but not including,
+        stop. Either may be None, for no limit. Points with no time are
+        never included.
+    """
+    if numpy is not None:
+        times = _floats(times)
+        keep = times == times
+        if start is not None: keep &= times >= start
+        if stop is not None: keep &= times < stop
+        return numpy.flatnonzero(keep)
+    return [i for i in xrange(len(times)) if times[i] == times[i] and (start is None or times[i] >= start) and
+            (stop is None or times[i] < stop)]
+
+class GPXPointMetrics(object):
+    """
+    Geometry of a list of points, shared by GPXRoute and GPXTrackSeg. Each
+    method works on all of the points at once; see segmentLengths and the
+    other geometry functions for details.
+    """
+    __slots__ = []
+
+    def points(self):
+        """
+        Out:
+            The list of points: rtepts or trkpts
+        """
+        raise NotImplementedError
+
+    def setPoints(self, pts):
+        """
+        Replace the list of points.
+        """
+        raise NotImplementedError
+
+    def columns(self):
+        """
+        Out:
+            The points as (lats, lons, eles, times). See pointColumns.
+        """
+        return pointColumns(self.points())
+
+    def segmentLengths(self, method='haversine'):
+        """
+        See segmentLengths
+        """
+        lats, lons, eles, times = self.columns()
+        return segmentLengths(lats, lons, method)
+
+    def cumulativeDistance(self, method='haversine'):
+        """
+        See cumulativeDistance
+        """
+        lats, lons, eles, times = self.columns()
+        return cumulativeDistance(lats, lons, method)
+
+    def distance(self, method='haversine'):
+        """
+        Out:
+            The total length, in meters
+        """
+        lengths = self.segmentLengths(method)
+        return float(lengths.sum() if numpy is not None else sum(lengths))
+
+    def speeds(self, method='haversine'):
+        """
+        See speeds
+        """
+        lats, lons, eles, times = self.columns()
+        return speeds(lats, lons, times, method)
+
+    def bearings(self):
+        """
+        See bearings
+        """
+        lats, lons, eles, times = self.columns()
+        return bearings(lats, lons)
+
+    def boundingBox(self):
+        """
+        See boundingBox
+        """
+        lats, lons, eles, times = self.columns()
+        return boundingBox(lats, lons)
+
+    def elevationChange(self):
+        """
+        See elevationChange
+        """
+        return elevationChange(self.columns()[2])
+
+    def duration(self):
+        """
+        See duration
+        """
+        return duration(self.columns()[3])
+
+    def simplify(self, count=None, error=None):
+        """
+        Remove points, keeping those which best preserve the shape of the
+        line. The points are replaced by a new list or GPXColumns, so any
+        other reference to the old one is left as it was. See
+        simplifyIndices.
+
+        In:
+            count, error: As for simplifyIndices
+
+        Out:
+            The number of points removed
+        """
+        pts = self.points()
+        lats, lons, eles, times = self.columns()
+        keep = simplifyIndices(lats, lons, count, error)
+        if len(keep) == len(pts):
+            return 0
+        if isinstance(pts, GPXColumns):
+            self.setPoints(pts.take(keep))
+        else:
+            self.setPoints([pts[i] for i in keep])
+        return len(pts) - len(keep)
+
+    def shiftTime(self, seconds):
+        """
+        Add to the time of every point. The points are replaced by
+        copies, as for simplify.
+
+        In:
+            seconds: The seconds to add, which may be negative
+        """
+        pts = self.points()
+        if isinstance(pts, GPXColumns):
+            pts = pts.copy()
+            times = pts.arrays['time']
+            if numpy is not None and len(times):
+                numpy.frombuffer(times, dtype=numpy.float64)[:] += seconds
+            else:
+                for i in xrange(len(times)):
+                    times[i] += seconds
+        else:
+            delta = datetime.timedelta(seconds=seconds)
+            shifted = []
+            for wpt in pts:
+                if wpt.time is not None:
+                    wpt = copy.copy(wpt)
+                    wpt.time = wpt.time + delta
+                shifted.append(wpt)
+            pts = shifted
+        self.setPoints(pts)
+
+    def timeRange(self, start=None, stop=None):
+        """
+        Remove every point from before start, or from stop on, as for
+        simplify. Points with no time are always removed.
+
+        In:
+            start, stop: Times in seconds since the epoch, or None for no
+                limit
+
+        Out:
+            The number of points removed
+        """
+        pts = self.points()
+        keep = _timesWithin(self.columns()[3], start, stop)
+        if len(keep) == len(pts):
+            return 0
+        self.setPoints(_takePoints(pts, keep))
+        return len(pts) - len(keep)
+
+class GPXRoute(GPXPointMetrics):
+    """
+    Container for rteType objects.
+
+    Note: rtepts is a list of GPXWaypoint objects, or a GPXColumns
+    """
+    __slots__ = ['name', 'cmt', 'desc', 'src', 'link', 'number', 'type', 'rtepts', 'xmltag']
 
     def __init__(self):
         """
         Constructor
         """
-        self.wpts = []
-        self.rtes = []
-        self.trks = []
+        for i in self.__slots__:
+            setattr(self, i, None)
+        self.rtepts = []
+
+    conversions = [('number', int)]
+    """
+    As for GPXWaypoint.conversions
+    """
+    xmlTags = _xmlTags(__slots__, ['rtepts', 'trksegs', 'xmltag'])
 
     def __iter__(self):
         return self.next()
 
     def next(self):
-        yield '<gpx version="1.1" creator="Python GPSBabel">'
-        for wpt in self.wpts:
-            wpt.xmltag = 'wpt'
-            for i in wpt:
-                yield i
-        for rte in self.rtes:
-            rte.xmltag = 'rte'
-            for i in rte:
+        yield '<%s>%s' % (self.xmltag, _xmlElements(self, self.xmlTags))
+        if isinstance(self.rtepts, GPXColumns):
+            for i in self.rtepts.next('rtept'):
                 yield i
-        for trk in self.trks:
-            trk.xmltag = 'trk'
-            for i in trk:
+        else:
+            for rte in self.rtepts:
+                yield rte.toXml('rtept')
+        yield '</%s>' % (self.xmltag)
+
+    def toXml(self, tag):
+        """
+        Return XML representation.
+
+        In:
+            tag: The XML tag to use around this object's XML representation
+
+        Out:
+            This object in XML
+        """
+        self.xmltag = tag
+        return ''.join(self)
+
+    def finalize(self):
+        """
+        Any post load of XML steps are placed here.
+        """
+        for attr, convert in self.conversions:
+            value = getattr(self, attr)
+            if value is not None:
+                setattr(self, attr, convert(value))
+
+    def makeColumnar(self):
+        """
+        Store rtepts in a GPXColumns, rather than a list.
+        """
+        if not isinstance(self.rtepts, GPXColumns):
+            self.rtepts = GPXColumns(self.rtepts, 'rtept')
+
+    def points(self):
+        return self.rtepts
+
+    def setPoints(self, pts):
+        self.rtepts = pts
+
+
+class GPXTrackSeg(GPXPointMetrics):
+    """
+    Track segment objects.
+
+    trkpts is a list of GPXWaypoints, or a GPXColumns
+    """
+    __slots__ = ['trkpts']
+
+    def __init__(self):
+        """
+        Constructor
+        """
+        self.trkpts = []
+
+    def __iter__(self):
+        return self.next()
+
+    def next(self):
+        yield "<trkseg>"
+        if isinstance(self.trkpts, GPXColumns):
+            for i in self.trkpts.next('trkpt'):
                 yield i
-        yield '</gpx>'
+        else:
+            for trkpt in self.trkpts:
+                yield trkpt.toXml("trkpt")
+        yield "</trkseg>"
 
     def toXml(self):
         """
@@ -866,10 +4117,7 @@ class GPXData(object):
         Out:
             This object in XML
         """
-        output = ""
-        for i in self:
-            output = "%s%s" % (output, i)
-        return output
+        return ''.join(self)
 
     def finalize(self):
         """
@@ -877,204 +4125,911 @@ class GPXData(object):
         """
         pass
 
-class GPXWaypoint(object):
+    def makeColumnar(self):
+        """
+        Store trkpts in a GPXColumns, rather than a list.
+        """
+        if not isinstance(self.trkpts, GPXColumns):
+            self.trkpts = GPXColumns(self.trkpts, 'trkpt')
+
+    def points(self):
+        return self.trkpts
+
+    def setPoints(self, pts):
+        self.trkpts = pts
+
+class GPXTrack(object):
     """
-    Container for wptType objects
+    Track objects
+
+    trksegs is a list of GPXTrackSeg objects
     """
-    __slots__ = ['lat', 'lon', 'ele', 'time', 'magvar', 'geoidheight', 'name', 'cmt', 'desc',
-                 'src', 'link', 'sym', 'type', 'fix', 'sat', 'hdop', 'vdop', 'pdop',
-                 'ageofdgpsdata', 'dgpsid', 'xmltag', 'speed']
+    __slots__ = ['name', 'cmt', 'desc', 'src', 'link', 'number', 'type', 'trksegs', 'xmltag']
 
     def __init__(self):
         """
         Constructor
         """
-        for i in self.__slots__:
-            setattr(self, i, None)
+        for i in self.__slots__:
+            setattr(self, i, None)
+        self.trksegs = []
+
+    conversions = [('number', int)]
+    """
+    As for GPXWaypoint.conversions
+    """
+    xmlTags = _xmlTags(__slots__, ['rtepts', 'trksegs', 'xmltag'])
+
+    def __iter__(self):
+        return self.next()
+
+    def next(self):
+        yield '<%s>%s' % (self.xmltag, _xmlElements(self, self.xmlTags))
+        for trkseg in self.trksegs:
+            for i in trkseg:
+                yield i
+        yield '</%s>' % (self.xmltag)
+
+    def toXml(self, tag):
+        """
+        Return XML representation.
+
+        In:
+            tag: The XML tag to use around this object's XML representation
+
+        Out:
+            This object in XML
+        """
+        self.xmltag = tag
+        return ''.join(self)
+
+    def finalize(self):
+        """
+        Any post load of XML steps are placed here.
+        """
+        for attr, convert in self.conversions:
+            value = getattr(self, attr)
+            if value is not None:
+                setattr(self, attr, convert(value))
+
+    def distance(self, method='haversine'):
+        """
+        Out:
+            The total length of all of the segments, in meters. The gaps
+            between segments are not counted. See segmentLengths.
+        """
+        return sum([trkseg.distance(method) for trkseg in self.trksegs])
+
+    def boundingBox(self):
+        """
+        Out:
+            (minlat, minlon, maxlat, maxlon) of every segment, or None if
+            there are no points. See boundingBox.
+        """
+        boxes = [box for box in [trkseg.boundingBox() for trkseg in self.trksegs] if box is not None]
+        if not boxes: return None
+        return (min([box[0] for box in boxes]), min([box[1] for box in boxes]),
+                max([box[2] for box in boxes]), max([box[3] for box in boxes]))
+
+    def elevationChange(self):
+        """
+        Out:
+            (gain, loss) over every segment. See elevationChange.
+        """
+        changes = [trkseg.elevationChange() for trkseg in self.trksegs]
+        return (sum([change[0] for change in changes]), sum([change[1] for change in changes]))
+
+    def duration(self):
+        """
+        Out:
+            The seconds from the first time in the first segment to the
+            last time in the last one. See duration.
+        """
+        return duration(self.times())
+
+    def times(self):
+        """
+        Out:
+            The time of every point of every segment, in seconds since the
+            epoch. See pointColumns.
+        """
+        times = [trkseg.columns()[3] for trkseg in self.trksegs]
+        if numpy is not None:
+            return numpy.concatenate([_floats(i) for i in times] or [numpy.zeros(0)])
+        return list(itertools.chain(*times))
+
+    def shiftTime(self, seconds):
+        """
+        Add to the time of every point. See GPXPointMetrics.shiftTime.
+        """
+        for trkseg in self.trksegs:
+            trkseg.shiftTime(seconds)
+
+    def timeRange(self, start=None, stop=None):
+        """
+        Remove every point outside a range of times, and any segments
+        left empty. See GPXPointMetrics.timeRange.
+
+        Out:
+            The number of points removed
+        """
+        removed = 0
+        for trkseg in self.trksegs:
+            removed += trkseg.timeRange(start, stop)
+        self.trksegs = [trkseg for trkseg in self.trksegs if len(trkseg.trkpts) > 0]
+        return removed
+
+    def split(self, interval=None):
+        """
+        Split the track into pieces, between segments as well as within
+        them.
+
+        In:
+            interval: As for the track filter's split option. Split where
+                more than this many seconds pass between two points, or,
+                if None, where the UTC date changes
+
+        Out:
+            A list of new GPXTracks, each with this track's name and other
+            fields. Unlike gpsbabel's split, the pieces are not renamed.
+        """
+        breaks = _timeBreaks(self.times(), interval)
+        output = []
+        offset = 0
+        for trkseg in self.trksegs:
+            n = len(trkseg.trkpts)
+            cuts = [i - offset for i in breaks[bisect.bisect_left(breaks, offset):bisect.bisect_left(breaks, offset + n)]]
+            #A break at the first point of a segment starts a new track
+            #with that segment.
+            starts = [0] + [i for i in cuts if i > 0]
+            bounds = starts + [n]
+            for i in xrange(len(starts)):
+                if i > 0 or not output or (cuts and cuts[0] == 0):
+                    trk = copy.copy(self)
+                    trk.trksegs = []
+                    output.append(trk)
+                piece = GPXTrackSeg()
+                piece.trkpts = _slicePoints(trkseg.trkpts, bounds[i], bounds[i + 1])
+                output[-1].trksegs.append(piece)
+            offset += n
+        return output
+
+def _lazyField(slot, convert):
+    """
+    Make a property which stores a field in slot, but which converts it
+    with convert the first time it is read, if it is still the text from
+    the GPX, and stores the converted value in its place.
+    """
+    get = slot.__get__
+    set = slot.__set__
+    def fget(self):
+        value = get(self)
+        if isinstance(value, basestring):
+            value = convert(value)
+            set(self, value)
+        return value
+    return property(fget, set)
+
+class GPXLazyWaypoint(GPXWaypoint):
+    """
+    A GPXWaypoint whose fields are converted from text when they are first
+    read, rather than all at once when it is finalized. Reading a large
+    track this way only pays for the fields which are actually used. Pass
+    lazy=True when parsing to use it.
+    """
+    __slots__ = []
+
+    def finalize(self):
+        """
+        Nothing is converted until it is used.
+        """
+        pass
+
+class GPXLazyRoute(GPXRoute):
+    """
+    A GPXRoute whose fields are converted when they are first read. See
+    GPXLazyWaypoint.
+    """
+    __slots__ = []
+
+    def finalize(self):
+        """
+        Nothing is converted until it is used.
+        """
+        pass
+
+class GPXLazyTrack(GPXTrack):
+    """
+    A GPXTrack whose fields are converted when they are first read. See
+    GPXLazyWaypoint.
+    """
+    __slots__ = []
+
+    def finalize(self):
+        """
+        Nothing is converted until it is used.
+        """
+        pass
+
+#The lazy classes add no slots of their own, but the base classes iterate
+#over self.__slots__ to initialize and output their fields, so once the
+#classes exist, __slots__ is set to list the fields they inherit.
+for cls in (GPXLazyWaypoint, GPXLazyRoute, GPXLazyTrack):
+    cls.__slots__ = cls.__base__.__slots__
+    for attr, convert in cls.conversions:
+        setattr(cls, attr, _lazyField(cls.__base__.__dict__[attr], convert))
+del cls, attr, convert
+
+class GPXIndex(object):
+    """
+    A spatial index of points, for finding those within a bounding box or
+    a distance of somewhere, or nearest to it, without looking at every
+    point.
+
+    Points are kept in a grid of cells cellSize degrees square, so a
+    query only looks at the points in the cells it overlaps. Each point is
+    kept as an item, which is usually the GPXWaypoint itself; points of a
+    GPXColumns are kept as (GPXColumns, index) tuples, so that no
+    GPXWaypoint has to be made for them.
+
+    An index can be saved alongside the GPXData it was made from, and
+    loaded back against that GPXData once it has been parsed again. See
+    save and loadIndex.
+
+    Instance variables:
+        * cellSize: The size of each cell, in degrees. Pick it so that a
+                    typical query covers a few cells.
+        * cells:    A dictionary of (row, column) to the list of
+                    (lat, lon, item) in that cell
+    """
+
+    def __init__(self, cellSize=0.1):
+        """
+        Constructor.
+
+        In:
+            cellSize: See the instance variables
+        """
+        self.cellSize = cellSize
+        self.cells = {}
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __cell(self, lat, lon):
+        return (int(math.floor(lat / self.cellSize)), int(math.floor(lon / self.cellSize)))
+
+    def insert(self, item, lat=None, lon=None):
+        """
+        Add a point to the index. Points without a position are ignored.
+
+        In:
+            item: The point, usually a GPXWaypoint
+            lat, lon: The position of the point. Default: item.lat and
+                item.lon
+        """
+        if lat is None: lat = item.lat
+        if lon is None: lon = item.lon
+        if lat is None or lon is None:
+            return
+        lat = float(lat)
+        lon = float(lon)
+        self.cells.setdefault(self.__cell(lat, lon), []).append((lat, lon, item))
+        self.count += 1
+
+    def remove(self, item, lat=None, lon=None):
+        """
+        Remove a point from the index.
+
+        In:
+            item, lat, lon: As for insert. The position must be the one
+                the point was inserted with.
+
+        Exceptions:
+            ValueError if the point is not in the index
+        """
+        if lat is None: lat = item.lat
+        if lon is None: lon = item.lon
+        if lat is not None and lon is not None:
+            key = self.__cell(float(lat), float(lon))
+            entries = self.cells.get(key, [])
+            for i in xrange(len(entries)):
+                if entries[i][2] == item:
+                    del entries[i]
+                    if not entries: del self.cells[key]
+                    self.count -= 1
+                    return
+        raise ValueError('Point is not in the index')
+
+    def addGpx(self, gpx, wpts=True, rtepts=False, trkpts=False):
+        """
+        Add the points of a GPXData to the index.
+
+        In:
+            gpx: The GPXData
+            wpts, rtepts, trkpts: Which of its points to add
+        """
+        for kind, pts in self.__lists(gpx, wpts, rtepts, trkpts):
+            if isinstance(pts, GPXColumns):
+                lats, lons = pts.arrays['lat'], pts.arrays['lon']
+                for i in xrange(len(pts)):
+                    if lats[i] == lats[i] and lons[i] == lons[i]:
+                        self.insert((pts, i), lats[i], lons[i])
+            else:
+                for pt in pts:
+                    self.insert(pt)
 
-    def __iter__(self):
-        return self.next()
+    def boundingBox(self, minlat, minlon, maxlat, maxlon):
+        """
+        Find the points within a bounding box. If minlon is greater than
+        maxlon, the box crosses the 180th meridian.
 
-    def next(self):
-        yield '<%s lat="%s" lon="%s">' % (self.xmltag, str(self.lat), str(self.lon))
-        for attr in filter(lambda x: x not in ['lat', 'lon', 'xmltag'] and getattr(self, x) != None, self.__slots__):
-            yield '<%s>%s</%s>' % (attr, getattr(self, attr), attr)
-        yield '</%s>' % (self.xmltag)
+        Out:
+            A list of items
+        """
+        output = []
+        for entries in self.__cellsWithin(minlat, minlon, maxlat, maxlon):
+            for lat, lon, item in entries:
+                if minlat <= lat <= maxlat and \
+                   (minlon <= lon <= maxlon if minlon <= maxlon else (lon >= minlon or lon <= maxlon)):
+                    output.append(item)
+        return output
 
-    def toXml(self, tag):
+    def radius(self, lat, lon, distance):
         """
-        Return XML representation.
+        Find the points within a distance of somewhere.
 
         In:
-            tag: The XML tag to use around this object's XML representation
+            lat, lon: Where to measure from, in degrees
+            distance: The greatest distance, in meters, measured as for
+                segmentLengths with the haversine method
 
         Out:
-            This object in XML
+            A list of (distance, item), nearest first
         """
-        self.xmltag = tag
-        output = ""
-        for i in self:
-            output = "%s%s" % (output, i)
+        lat = float(lat)
+        lon = float(lon)
+        dlat = math.degrees(distance / EARTH_RADIUS)
+        if dlat >= 180 or abs(lat) + dlat >= 90:
+            candidates = self.cells.itervalues()
+        else:
+            dlon = dlat / math.cos(math.radians(abs(lat) + dlat))
+            if dlon >= 180:
+                candidates = self.__cellsWithin(lat - dlat, -180, lat + dlat, 180)
+            else:
+                candidates = self.__cellsWithin(lat - dlat, _wrap(lon - dlon), lat + dlat, _wrap(lon + dlon))
+        sin, cos, asin, sqrt, r = math.sin, math.cos, math.asin, math.sqrt, 2 * EARTH_RADIUS
+        lat1, lon1, cos1 = math.radians(lat), math.radians(lon), math.cos(math.radians(lat))
+        output = []
+        for entries in candidates:
+            for lat2, lon2, item in entries:
+                lat2 = math.radians(lat2)
+                h = sin((lat2 - lat1) * 0.5) ** 2 + cos1 * cos(lat2) * sin((math.radians(lon2) - lon1) * 0.5) ** 2
+                d = r * asin(sqrt(min(1.0, h)))
+                if d <= distance:
+                    output.append((d, item))
+        output.sort(key=lambda x: x[0])
         return output
 
-    def finalize(self):
+    def nearest(self, lat, lon, k=1):
         """
-        Any post load of XML steps are placed here.
+        Find the points nearest to somewhere.
+
+        In:
+            lat, lon: Where to measure from, in degrees
+            k: How many points to find
+
+        Out:
+            A list of up to k (distance, item), nearest first. See radius.
+        """
+        #Search within a growing radius, doubling it until it holds at
+        #least k points. The k nearest within it are then the k nearest
+        #overall, since every other point is further away than the radius.
+        distance = self.cellSize * math.radians(EARTH_RADIUS)
+        while True:
+            output = self.radius(lat, lon, distance)
+            if len(output) >= k or len(output) == self.count or distance > math.pi * EARTH_RADIUS:
+                return output[:k]
+            distance *= 2
+
+    def save(self, fileobj, gpx):
         """
-        for i in ['lat', 'lon', 'ele', 'magvar', 'geoidheight', 'hdop', 'vdop', 'pdop', 'ageofdgpsdata', 'speed']:
-            if getattr(self, i) is not None:
-                setattr(self, i, Decimal(getattr(self, i)))
-        for i in ['sat', 'dgpsid']:
-            if getattr(self, i) is not None:
-                setattr(self, i, int(getattr(self, i)))
-        for i in ['time']:
-            if getattr(self, i) is not None:
-                setattr(self, i, datetime.datetime(*time.strptime(getattr(self, i), '%Y-%m-%dT%H:%M:%SZ')[:6]))
+        Write the index to a file. Rather than the points themselves, it
+        records where each one is in gpx, so it is small, and can be
+        loaded back against the same GPX after it has been parsed again.
+
+        In:
+            fileobj: The file to write to
+            gpx: The GPXData the points of the index came from
 
-class GPXRoute(object):
+        Exceptions:
+            ValueError if a point of the index is not in gpx
+        """
+        paths = {}
+        for kind, pts in self.__lists(gpx, True, True, True):
+            if isinstance(pts, GPXColumns):
+                paths[id(pts)] = kind
+            else:
+                for i in xrange(len(pts)):
+                    paths[id(pts[i])] = kind + (i, )
+        points = []
+        for entries in self.cells.itervalues():
+            for lat, lon, item in entries:
+                if isinstance(item, tuple):
+                    path = paths.get(id(item[0]))
+                    if path is not None: path = path + (item[1], )
+                else:
+                    path = paths.get(id(item))
+                if path is None:
+                    raise ValueError('Point is not in the GPX data')
+                points.append((path, lat, lon))
+        pickle.dump({'cellSize' : self.cellSize, 'points' : points}, fileobj, 2)
+
+    def __lists(self, gpx, wpts, rtepts, trkpts):
+        """
+        Generate (path, list of points) for each list of points in gpx,
+        where path gives the position of the list.
+        """
+        if wpts:
+            yield ('wpt', ), gpx.wpts
+        if rtepts:
+            for r in xrange(len(gpx.rtes)):
+                yield ('rtept', r), gpx.rtes[r].rtepts
+        if trkpts:
+            for t in xrange(len(gpx.trks)):
+                for s in xrange(len(gpx.trks[t].trksegs)):
+                    yield ('trkpt', t, s), gpx.trks[t].trksegs[s].trkpts
+
+    def __cellsWithin(self, minlat, minlon, maxlat, maxlon):
+        """
+        Generate the list of entries of each cell which overlaps a
+        bounding box.
+        """
+        if minlon > maxlon:
+            ranges = [(minlon, 180.0), (-180.0, maxlon)]
+        else:
+            ranges = [(minlon, maxlon)]
+        top, bottom = self.__cell(minlat, 0)[0], self.__cell(maxlat, 0)[0]
+        for minlon, maxlon in ranges:
+            left, right = self.__cell(0, minlon)[1], self.__cell(0, maxlon)[1]
+            #When the box covers more cells than are in use, it is quicker
+            #to check the cells in use.
+            if (bottom - top + 1) * (right - left + 1) > len(self.cells):
+                for (row, column), entries in self.cells.items():
+                    if top <= row <= bottom and left <= column <= right:
+                        yield entries
+                continue
+            for row in xrange(top, bottom + 1):
+                for column in xrange(left, right + 1):
+                    entries = self.cells.get((row, column))
+                    if entries is not None:
+                        yield entries
+
+def _wrap(lon):
     """
-    Container for rteType objects.
+    Out:
+        lon moved into -180 to 180
+    """
+    return (lon + 180.0) % 360.0 - 180.0
 
-    Note: rtepts is a list of GPXWaypoint objects
+def loadIndex(fileobj, gpx):
     """
-    __slots__ = ['name', 'cmt', 'desc', 'src', 'link', 'number', 'type', 'rtepts', 'xmltag']
+    Read an index written by GPXIndex.save.
 
-    def __init__(self):
-        """
-        Constructor
-        """
-        for i in self.__slots__:
-            setattr(self, i, None)
-        self.rtepts = []
+    In:
+        fileobj: The file to read from
+        gpx: The GPXData the index was made from, as it was when saved
 
-    def __iter__(self):
-        return self.next()
+    Out:
+        A GPXIndex
+    """
+    saved = pickle.load(fileobj)
+    index = GPXIndex(saved['cellSize'])
+    for path, lat, lon in saved['points']:
+        if path[0] == 'wpt':
+            item = gpx.wpts[path[1]]
+        else:
+            if path[0] == 'rtept':
+                pts = gpx.rtes[path[1]].rtepts
+            else:
+                pts = gpx.trks[path[1]].trksegs[path[2]].trkpts
+            item = (pts, path[-1]) if isinstance(pts, GPXColumns) else pts[path[-1]]
+        index.insert(item, lat, lon)
+    return index
 
-    def next(self):
-        yield '<%s>' % (self.xmltag)
-        for attr in filter(lambda x: x not in ['rtepts', 'xmltag'] and getattr(self, x) != None, self.__slots__):
-            yield '<%s>%s</%s>' % (attr, getattr(self, attr), attr)
-        for rte in self.rtepts:
-            rte.xmltag = 'rtept'
-            for i in rte:
-                yield i
-        yield '</%s>' % (self.xmltag)
+def mergeTracks(trks, title=None):
+    """
+    Merge tracks into one, as the track filter's merge option does: the
+    points of every segment of every track are put into one segment, in
+    order of time, keeping only the first of any points with the same
+    time.
 
-    def toXml(self, tag):
-        """
-        Return XML representation.
+    In:
+        trks: The GPXTracks to merge, which are left as they were
+        title: The name of the new track. Default: the name of the first
 
-        In:
-            tag: The XML tag to use around this object's XML representation
+    Out:
+        The new GPXTrack, or None if there are no tracks
 
-        Out:
-            This object in XML
-        """
-        self.xmltag = tag
-        output = ""
-        for i in self:
-            output = "%s%s" % (output, i)
-        return output
+    Exceptions:
+        TrackFilterException if a point has no time
+    """
+    if not trks:
+        return None
+    pts = _joinPoints([trkseg.trkpts for trk in trks for trkseg in trk.trksegs])
+    times = pointColumns(pts)[3]
+    if numpy is not None:
+        times = _floats(times)
+        if numpy.isnan(times).any():
+            raise TrackFilterException('Error: Every point must have a time to merge tracks')
+        order = numpy.argsort(times, kind='mergesort')
+        if len(order):
+            times = times[order]
+            order = order[numpy.concatenate(([True], times[1:] != times[:-1]))]
+    else:
+        if [t for t in times if t != t]:
+            raise TrackFilterException('Error: Every point must have a time to merge tracks')
+        order = sorted(xrange(len(times)), key=times.__getitem__)
+        order = [order[i] for i in xrange(len(order)) if i == 0 or times[order[i]] != times[order[i - 1]]]
+    trk = copy.copy(trks[0])
+    trkseg = GPXTrackSeg()
+    trkseg.trkpts = _takePoints(pts, order)
+    trk.trksegs = [trkseg]
+    if title is not None: trk.name = title
+    return trk
+
+def packTracks(trks, title=None):
+    """
+    Pack tracks into one, as the track filter's pack option does: the
+    segments of every track are put into one track, in order of time.
 
-    def finalize(self):
-        """
-        Any post load of XML steps are placed here.
-        """
-        self.number = int(self.number) if self.number is not None else None
+    In:
+        trks: The GPXTracks to pack, which are left as they were
+        title: The name of the new track. Default: the name of the first
+            in time
 
+    Out:
+        The new GPXTrack, or None if there are no tracks
 
-class GPXTrackSeg(object):
+    Exceptions:
+        TrackFilterException if the tracks overlap in time, or a track
+        has no times
     """
-    Track segment objects.
-
-    trkpts is a list of GPXWaypoints
+    if not trks:
+        return None
+    ranges = []
+    for trk in trks:
+        times = [t for t in trk.times() if t == t]
+        if not times:
+            raise TrackFilterException('Error: Every track must have times to pack tracks')
+        ranges.append((min(times), max(times), trk))
+    ranges.sort(key=lambda x: x[0])
+    for i in xrange(1, len(ranges)):
+        if ranges[i][0] < ranges[i - 1][1]:
+            raise TrackFilterException('Error: Tracks overlap in time, so can only be merged, not packed')
+    trk = copy.copy(ranges[0][2])
+    trk.trksegs = [trkseg for start, stop, i in ranges for trkseg in i.trksegs]
+    if title is not None: trk.name = title
+    return trk
+
+def parseTimeDelta(value):
     """
-    __slots__ = ['trkpts']
+    Read a length of time in the style of the track filter's move and
+    split options, such as +1h30m or -2d.
 
-    def __init__(self):
-        """
-        Constructor
-        """
-        self.trkpts = []
+    In:
+        value: A sign, then numbers each followed by d, h, m or s. A
+            number with no unit is in seconds.
 
-    def __iter__(self):
-        return self.next()
+    Out:
+        The length of time in seconds
 
-    def next(self):
-        yield "<trkseg>"
-        for trkpt in self.trkpts:
-            trkpt.xmltag = "trkpt"
-            for i in trkpt:
-                yield i
-        yield "</trkseg>"
+    Exceptions:
+        ValueError if value is not a length of time
+    """
+    value = value.strip()
+    sign = -1 if value.startswith('-') else 1
+    value = value.lstrip('+-')
+    parts = re.findall(r'([0-9]+(?:\.[0-9]*)?)([dhms]?)', value.lower())
+    if not parts or ''.join([number + unit for number, unit in parts]) != value.lower():
+        raise ValueError('Not a length of time: %s' % value)
+    units = {'d' : 86400, 'h' : 3600, 'm' : 60, 's' : 1, '' : 1}
+    return sign * sum([float(number) * units[unit] for number, unit in parts])
+
+def parseTimeLimit(value, end=False):
+    """
+    Read a time in the style of the track filter's start and stop options:
+    YYYYMMDDHHMMSS, or any shorter prefix of it down to the year, in UTC.
 
-    def toXml(self):
-        """
-        Return XML representation.
+    In:
+        value: The time
+        end: If True, return the end of the period given, rather than the
+            start. 20080817 ends at the start of 20080818, for example.
 
-        Out:
-            This object in XML
-        """
-        output = ""
-        for i in self:
-            output = "%s%s" % (output, i)
-        return output
+    Out:
+        The time in seconds since the epoch
 
-    def finalize(self):
-        """
-        Any post load of XML steps are placed here.
-        """
-        pass
+    Exceptions:
+        ValueError if value is not a time
+    """
+    value = value.strip()
+    if not re.match(r'^[0-9]{4}([0-9]{2}){0,5}$', value):
+        raise ValueError('Not a time: %s' % value)
+    fields = [int(value[i:i + 2]) for i in xrange(4, len(value), 2)]
+    when = datetime.datetime(*([int(value[:4])] + fields + [1, 1][len(fields):]))
+    if end:
+        if len(fields) == 0:
+            when = when.replace(year=when.year + 1)
+        elif len(fields) == 1:
+            when = when.replace(year=when.year + when.month // 12, month=when.month % 12 + 1)
+        else:
+            when += datetime.timedelta(seconds=[86400, 3600, 60, 1][len(fields) - 2])
+    return calendar.timegm(when.timetuple())
 
-class GPXTrack(object):
+def trackFilter(gpx, opts):
     """
-    Track objects
+    The track filter of gpsbabel, run in-process. See inProcessFilters.
+
+    In:
+        gpx: The GPXData to filter, which is left as it was
+        opts: The options of the filter. move, pack, merge, name, start,
+            stop and title are supported, with the same meanings as for
+            gpsbabel. Times are in UTC. split is left to gpsbabel, which
+            names the pieces from the local time of their first points.
+
+    Out:
+        The filtered GPXData, or None if opts asks for something which can
+        only be done by gpsbabel
+    """
+    if [key for key in opts.keys() if key not in ('move', 'pack', 'merge', 'name', 'start', 'stop', 'title')] or \
+       ('pack' in opts and 'merge' in opts):
+        return None
+    try:
+        move = parseTimeDelta(str(opts['move'])) if opts.get('move') else None
+        start = parseTimeLimit(str(opts['start'])) if opts.get('start') else None
+        stop = parseTimeLimit(str(opts['stop']), True) if opts.get('stop') else None
+    except ValueError:
+        return None
+    title = opts.get('title')
+    output = gpx.copy()
+    trks = output.trks
+    if opts.get('name'):
+        pattern = str(opts['name']).lower()
+        trks = [trk for trk in trks if fnmatch.fnmatchcase((trk.name or '').lower(), pattern)]
+    if move:
+        for trk in trks:
+            trk.shiftTime(move)
+    if start is not None or stop is not None:
+        for trk in trks:
+            trk.timeRange(start, stop)
+        trks = [trk for trk in trks if trk.trksegs]
+    try:
+        if 'merge' in opts and trks:
+            trks = [mergeTracks(trks, title)]
+        elif 'pack' in opts and trks:
+            trks = [packTracks(trks, title)]
+    except TrackFilterException:
+        return None
+    output.trks = trks
+    return output
+
+def removeDuplicates(wpts, shortname=False, location=False, all=False, correct=False, tolerance=0.0001):
+    """
+    Remove duplicate waypoints, as the duplicate filter does. Waypoints
+    are duplicates if they have the same name, the same position, or both,
+    and only the first of each set of duplicates is kept. Positions are
+    compared by putting them in a grid with cells tolerance degrees
+    square, so the time taken grows with the number of waypoints, rather
+    than its square.
+
+    In:
+        wpts: A list of GPXWaypoints, which is left as it was
+        shortname: Compare names. Waypoints with no name are never
+            duplicates.
+        location: Compare positions. The default tolerance compares them
+            to four decimal places, as gpsbabel does. Waypoints with no
+            position are never duplicates.
+        all: Remove every one of a set of duplicates, not just the later
+            ones
+        correct: Give the waypoint which is kept the position of the last
+            of its duplicates. It is then a copy.
+        tolerance: The size of the grid cells, in degrees
+
+    Out:
+        A new list of the waypoints which are kept, in their original
+        order
+    """
+    if not shortname and not location:
+        return list(wpts)
+    if location:
+        lats, lons = pointColumns(wpts)[:2]
+        if numpy is not None:
+            rows = numpy.floor(_floats(lats) / tolerance + 0.5).tolist()
+            columns = numpy.floor(_floats(lons) / tolerance + 0.5).tolist()
+        else:
+            rows = [math.floor(i / tolerance + 0.5) for i in lats]
+            columns = [math.floor(i / tolerance + 0.5) for i in lons]
+    keys = []
+    for i in xrange(len(wpts)):
+        key = ()
+        if shortname:
+            key += (wpts[i].name, )
+            if wpts[i].name is None: key = None
+        if location and key is not None:
+            key += (rows[i], columns[i])
+            if rows[i] != rows[i] or columns[i] != columns[i]: key = None
+        keys.append(key)
+    groups = {}
+    for i in xrange(len(keys)):
+        if keys[i] is not None:
+            groups.setdefault(keys[i], []).append(i)
+    output = []
+    for i in xrange(len(keys)):
+        group = groups.get(keys[i]) if keys[i] is not None else [i]
+        if group[0] != i or (all and len(group) > 1):
+            continue
+        wpt = wpts[i]
+        if correct and len(group) > 1:
+            wpt = copy.copy(wpt)
+            wpt.lat, wpt.lon = wpts[group[-1]].lat, wpts[group[-1]].lon
+        output.append(wpt)
+    return output
+
+def pointsWithin(wpts, lat, lon, distance, exclude=False, sort=True, maxcount=None):
+    """
+    Find the waypoints within a distance of a position, as the radius
+    filter does.
+
+    In:
+        wpts: A list of GPXWaypoints, which is left as it was
+        lat, lon: The position, in degrees
+        distance: The distance, in meters. See distancesFrom.
+        exclude: Find the waypoints further away instead
+        sort: Sort the waypoints found nearest first, rather than keeping
+            them in their original order
+        maxcount: Find no more than this many waypoints
+
+    Out:
+        A new list of the waypoints found. Waypoints with no position are
+        never found.
+    """
+    lats, lons = pointColumns(wpts)[:2]
+    distances = distancesFrom(lats, lons, lat, lon) if wpts else []
+    if numpy is not None and len(distances):
+        found = numpy.flatnonzero(distances > distance if exclude else distances <= distance)
+        if sort: found = found[numpy.argsort(distances[found], kind='mergesort')]
+        found = found.tolist()
+    else:
+        found = [i for i in xrange(len(distances)) if (distances[i] > distance if exclude else distances[i] <= distance)]
+        if sort: found.sort(key=distances.__getitem__)
+    if maxcount is not None:
+        found = found[:maxcount]
+    return [wpts[i] for i in found]
 
-    trksegs is a list of GPXTrackSeg objects
+def duplicateFilter(gpx, opts):
     """
-    __slots__ = ['name', 'cmt', 'desc', 'src', 'link', 'number', 'type', 'trksegs', 'xmltag']
+    The duplicate filter of gpsbabel, run in-process. See inProcessFilters
+    and removeDuplicates.
 
-    def __init__(self):
-        """
-        Constructor
-        """
-        for i in self.__slots__:
-            setattr(self, i, None)
-        self.trksegs = []
+    In:
+        gpx: The GPXData to filter, which is left as it was
+        opts: The options of the filter: shortname, location, all and
+            correct, with the same meanings as for gpsbabel
 
-    def __iter__(self):
-        return self.next()
+    Out:
+        The filtered GPXData, or None if opts asks for something which can
+        only be done by gpsbabel
+    """
+    if [key for key in opts.keys() if key not in ('shortname', 'location', 'all', 'correct')] or \
+       ('shortname' not in opts and 'location' not in opts):
+        return None
+    output = gpx.copy()
+    output.wpts = removeDuplicates(gpx.wpts, 'shortname' in opts, 'location' in opts, 'all' in opts, 'correct' in opts)
+    return output
+
+def radiusFilter(gpx, opts):
+    """
+    The radius filter of gpsbabel, run in-process. See inProcessFilters
+    and pointsWithin.
+
+    In:
+        gpx: The GPXData to filter, which is left as it was
+        opts: The options of the filter: lat, lon, distance, exclude,
+            nosort, maxcount and asroute, with the same meanings as for
+            gpsbabel. distance is in miles unless it ends with one of the
+            units in distanceUnits.
+
+    Out:
+        The filtered GPXData, or None if opts asks for something which can
+        only be done by gpsbabel
+    """
+    if [key for key in opts.keys() if key not in ('lat', 'lon', 'distance', 'exclude', 'nosort', 'maxcount', 'asroute')] or \
+       not opts.get('distance') or not opts.get('lat') or not opts.get('lon'):
+        return None
+    try:
+        lat = float(opts['lat'])
+        lon = float(opts['lon'])
+        distance = parseDistance(str(opts['distance']), 'mi')
+        maxcount = int(opts['maxcount']) if opts.get('maxcount') else None
+    except ValueError:
+        return None
+    output = gpx.copy()
+    output.wpts = pointsWithin(gpx.wpts, lat, lon, distance, 'exclude' in opts, 'nosort' not in opts, maxcount)
+    if opts.get('asroute'):
+        rte = GPXRoute()
+        rte.name = opts['asroute']
+        rte.rtepts = output.wpts
+        output.rtes.append(rte)
+        output.wpts = []
+    return output
+
+def simplifyFilter(gpx, opts):
+    """
+    The simplify filter of gpsbabel, run in-process. See inProcessFilters.
+
+    In:
+        gpx: The GPXData to filter, which is left as it was
+        opts: The options of the filter. count, error and crosstrack are
+            supported, with the same meanings as for gpsbabel; error is in
+            miles unless it ends with one of the units in distanceUnits.
+
+    The points are chosen with Douglas-Peucker, from the top down, rather
+    than by gpsbabel's removal of the point with the least crosstrack
+    error, one at a time, so they can differ from gpsbabel's. This is why
+    GPSBabel.inProcess is off unless it is turned on.
+
+    Out:
+        The filtered GPXData, or None if opts asks for something which can
+        only be done by gpsbabel
+    """
+    if 'length' in opts or 'relative' in opts or ('count' in opts) == ('error' in opts):
+        return None
+    try:
+        if 'count' in opts:
+            count, error = int(opts['count']), None
+        else:
+            count, error = None, parseDistance(str(opts['error']), 'mi')
+    except ValueError:
+        return None
+    output = gpx.copy()
+    output.simplify(count, error)
+    return output
+
+distanceUnits = {'m' : 1.0, 'km' : 1000.0, 'k' : 1000.0, 'ft' : 0.3048, 'nm' : 1852.0, 'mi' : 1609.344}
+"""
+The units parseDistance understands, and the meters in each.
+"""
 
-    def next(self):
-        yield '<%s>' % (self.xmltag)
-        for attr in filter(lambda x: x not in ['trksegs', 'xmltag'] and getattr(self, x) != None, self.__slots__):
-            yield '<%s>%s</%s>' % (attr, getattr(self, attr), attr)
-        for trkseg in self.trksegs:
-            for i in trkseg:
-                yield i
-        yield '</%s>' % (self.xmltag)
+def parseDistance(value, unit='m'):
+    """
+    Read a distance, such as 0.5km or 100ft, in the style of gpsbabel's
+    filter options.
 
-    def toXml(self, tag):
-        """
-        Return XML representation.
+    In:
+        value: The distance, optionally followed by one of distanceUnits
+        unit: The unit to use if value has none
 
-        In:
-            tag: The XML tag to use around this object's XML representation
+    Out:
+        The distance in meters
 
-        Out:
-            This object in XML
-        """
-        self.xmltag = tag
-        output = ""
-        for i in self:
-            output = "%s%s" % (output, i)
-        return output
+    Exceptions:
+        ValueError if value is not a distance
+    """
+    match = re.match(r'^\s*([-+]?[0-9.]+(?:[eE][-+]?[0-9]+)?)\s*([a-zA-Z]*)\s*$', value)
+    if match is None or (match.group(2) and match.group(2).lower() not in distanceUnits):
+        raise ValueError('Not a distance: %s' % value)
+    return float(match.group(1)) * distanceUnits[match.group(2).lower() or unit]
 
-    def finalize(self):
-        """
-        Any post load of XML steps are placed here.
-        """
-        self.number = int(self.number) if self.number is not None else None
+inProcessFilters = {'simplify' : simplifyFilter, 'track' : trackFilter, 'duplicate' : duplicateFilter,
+                    'radius' : radiusFilter}
+"""
+The filters which GPSBabel.execCmd can run in-process, rather than in
+gpsbabel, when its input is a GPXData. Each is a function which takes the
+GPXData and the dictionary of filter options, and returns the filtered
+data as a new GPXData, without changing the one it was given, or None to
+leave the filter to gpsbabel.
+"""
 
 class UnknownActionException(Exception):
     pass
@@ -1088,17 +5043,92 @@ class InvalidOptionException(Exception):
     pass
 class UnknownCharsetException(Exception):
     pass
+class UnknownParserException(Exception):
+    pass
+class UnknownMethodException(Exception):
+    pass
+
+class TrackFilterException(Exception):
+    pass
+class CancelledException(Exception):
+    pass
+class TimeoutException(CancelledException):
+    pass
 
-def gpxParse(instr):
+def gpxParse(instr, callback=None, parser='sax', columnar=False, lazy=False):
     """
     Utility function to parse a GPX string
 
+    In:
+        instr: The GPX, as a string, or as a bytearray or other buffer
+            (such as is captured by captureStdOut(inMemory=True)). Buffers
+            are fed to the parser a slice at a time, without copying them.
+        callback: If given, a function which is called with each
+            GPXWaypoint, GPXRoute and GPXTrack as soon as it is parsed
+        parser: The name of the GPX parser to use. See gpxParsers.
+        columnar: If True, store the points of each track segment and
+            route in a GPXColumns. See GPXColumns.
+        lazy: If True, only convert each field from text when it is first
+            read. See GPXLazyWaypoint.
+
     Returns the GPXData object that contains everything from the string
     """
-    gpxp = GPXParser()
-    xml.sax.parseString(instr, gpxp)
-    gpxp.gpx.finalize()
-    return gpxp.gpx
+    if isinstance(instr, basestring):
+        chunks = [instr]
+    else:
+        chunks = (buffer(instr, i, 65536) for i in xrange(0, len(instr), 65536))
+    gpx = GPXData()
+    for item in iterGpx(chunks, False, parser, columnar, lazy):
+        if isinstance(item, GPXWaypoint): gpx.wpts.append(item)
+        elif isinstance(item, GPXRoute): gpx.rtes.append(item)
+        else: gpx.trks.append(item)
+        if callback is not None: callback(item)
+    gpx.finalize()
+    return gpx
+
+def iterGpx(source, points=False, parser='sax', columnar=False, lazy=False):
+    """
+    Utility function to parse GPX a piece at a time, generating each
+    top level item as soon as it has been read. Only the item currently
+    being read is held in memory, so files of any size can be processed.
+
+    In:
+        source: Where to read the GPX from. Either the name of a file, a
+            file object, or an iterable producing strings or buffers of
+            GPX data.
+        points: If False, generate each GPXWaypoint, GPXRoute and GPXTrack
+            whole. If True, tracks are not generated whole; instead, each
+            track point is generated as a tuple of (GPXTrack, GPXTrackSeg,
+            GPXWaypoint), giving the track and segment it belongs to. The
+            track has its name and other details, but has not yet been
+            finalized, and neither it nor the segment holds any points.
+        parser: The name of the GPX parser to use. See gpxParsers.
+        columnar: If True, store the points of each track segment and
+            route in a GPXColumns. See GPXColumns.
+        lazy: If True, only convert each field from text when it is first
+            read. See GPXLazyWaypoint.
+    """
+    if isinstance(source, basestring):
+        f = open(source, 'rb')
+        try:
+            for item in iterGpx(f, points, parser, columnar, lazy):
+                yield item
+        finally:
+            f.close()
+        return
+    if hasattr(source, 'read'):
+        read = source.read
+        source = iter(lambda: read(65536), '')
+    items = []
+    gpxp = makeGpxParser(parser, items.append, False, points, columnar, lazy)
+    for chunk in source:
+        gpxp.feed(chunk)
+        for item in items:
+            yield item
+        del items[:]
+    gpxp.close()
+    for item in items:
+        yield item
 
 class GPXParser(xml.sax.handler.ContentHandler):
     """
@@ -1118,18 +5148,61 @@ class GPXParser(xml.sax.handler.ContentHandler):
     #    nothing - route - waypoint - route - nothing
     #    nothing - track - trackseg - waypoint - trackseg - track - nothing
     #States: 0=nothing, 1=wpt, 2=rte, 3=rte/wpt, 4=trk, 5=trkseg, 6=trkseg/wpt
-    def __init__(self):
+    def __init__(self, callback=None, keep=True, points=False, columnar=False, lazy=False):
         """
         Constructor. Clear out the character data buffer, set initial read
         state to nothing, create initial gpx object, and set the object
         stack to that GPXData object.
+
+        In:
+            callback: If given, a function which is called with each
+                GPXWaypoint, GPXRoute and GPXTrack as soon as its closing
+                tag has been read
+            keep: If False, parsed items are only passed to the callback,
+                and are not added to the gpx object.
+            points: If True, the callback is not called with whole
+                tracks, but with a (GPXTrack, GPXTrackSeg, GPXWaypoint)
+                tuple for each track point, which is not added to the
+                segment. See iterGpx.
+            columnar: If True, the points of each track segment and
+                route are stored in a GPXColumns, rather than a list.
+                They are added to it straight from the parser, so no
+                GPXWaypoint is kept for them.
+            lazy: If True, create a GPXLazyWaypoint, GPXLazyRoute, or
+                GPXLazyTrack for each item, which only converts its fields
+                from text when they are first read.
         """
         xml.sax.ContentHandler.__init__(self)
+        self.callback = callback
+        self.keep = keep
+        self.points = points
+        self.columnar = columnar
+        if lazy:
+            self.wptClass, self.rteClass, self.trkClass = GPXLazyWaypoint, GPXLazyRoute, GPXLazyTrack
+        else:
+            self.wptClass, self.rteClass, self.trkClass = GPXWaypoint, GPXRoute, GPXTrack
+        self.reader = None
         self.chdata = ""
         self.read = 0
         self.gpx = GPXData()
         self.objstack = [self.gpx]
 
+    def feed(self, data):
+        """
+        Parse the next piece of a GPX document.
+        """
+        if self.reader is None:
+            self.reader = xml.sax.make_parser()
+            self.reader.setContentHandler(self)
+        self.reader.feed(data)
+
+    def close(self):
+        """
+        Finish parsing a GPX document which was passed in using feed.
+        """
+        if self.reader is None: self.feed('')
+        self.reader.close()
+
     def startElement(self, name, attrs):
         """
         Handle the start of a new element.
@@ -1147,19 +5220,20 @@ class GPXParser(xml.sax.handler.ContentHandler):
         if self.read == 0:
             if name == "wpt":
                 self.read = 1
-                cur = GPXWaypoint()
+                cur = self.wptClass()
                 self.objstack.append(cur)
                 for i in attrs.keys():
                     setattr(cur, i, attrs[i])
             elif name == "rte":
                 self.read = 2
-                cur = GPXRoute()
+                cur = self.rteClass()
+                if self.columnar: cur.makeColumnar()
                 self.objstack.append(cur)
                 for i in attrs.keys():
                     setattr(cur, i, attrs[i])
             elif name == "trk":
                 self.read = 4
-                cur = GPXTrack()
+                cur = self.trkClass()
                 self.objstack.append(cur)
                 for i in attrs.keys():
                     setattr(cur, i, attrs[i])
@@ -1169,7 +5243,7 @@ class GPXParser(xml.sax.handler.ContentHandler):
         elif self.read == 2: # Routes
             if name == "rtept":
                 self.read = 3
-                cur = GPXWaypoint()
+                cur = self.wptClass()
                 self.objstack.append(cur)
             for i in attrs.keys():
                 setattr(self.objstack[-1], i, attrs[i])
@@ -1180,13 +5254,14 @@ class GPXParser(xml.sax.handler.ContentHandler):
             if name == "trkseg":
                 self.read = 5
                 cur = GPXTrackSeg()
+                if self.columnar: cur.makeColumnar()
                 self.objstack.append(cur)
             for i in attrs.keys():
                 setattr(self.objstack[-1], i, attrs[i])
         elif self.read == 5: # Track Seg
             if name == "trkpt":
                 self.read = 6
-                cur = GPXWaypoint()
+                cur = self.wptClass()
                 self.objstack.append(cur)
             for i in attrs.keys():
                 setattr(self.objstack[-1], i, attrs[i])
@@ -1219,7 +5294,8 @@ class GPXParser(xml.sax.handler.ContentHandler):
             if name == "wpt":
                 obj = self.objstack.pop()
                 obj.finalize()
-                self.gpx.wpts.append(obj)
+                if self.keep: self.gpx.wpts.append(obj)
+                if self.callback is not None: self.callback(obj)
                 self.read = 0
             else:
                 if self.chdata.strip() != "": setattr(self.objstack[-1], name, self.chdata)
@@ -1228,7 +5304,8 @@ class GPXParser(xml.sax.handler.ContentHandler):
             if name == "rte":
                 obj = self.objstack.pop()
                 obj.finalize()
-                self.gpx.rtes.append(obj)
+                if self.keep: self.gpx.rtes.append(obj)
+                if self.callback is not None: self.callback(obj)
                 self.read = 0
             else:
                 if self.chdata.strip() != "": setattr(self.objstack[-1], name, self.chdata)
@@ -1236,7 +5313,7 @@ class GPXParser(xml.sax.handler.ContentHandler):
         elif self.read == 3: # Route Waypoints
             if name == "rtept":
                 obj = self.objstack.pop()
-                obj.finalize()
+                if not self.columnar: obj.finalize()
                 self.objstack[-1].rtepts.append(obj)
                 self.read = 2
             else:
@@ -1246,7 +5323,8 @@ class GPXParser(xml.sax.handler.ContentHandler):
             if name == "trk":
                 obj = self.objstack.pop()
                 obj.finalize()
-                self.gpx.trks.append(obj)
+                if self.keep: self.gpx.trks.append(obj)
+                if self.callback is not None and not self.points: self.callback(obj)
                 self.read = 0
             else:
                 if self.chdata.strip() != "": setattr(self.objstack[-1], name, self.chdata)
@@ -1263,18 +5341,302 @@ class GPXParser(xml.sax.handler.ContentHandler):
         elif self.read == 6: # Track Segment Waypoints
             if name == "trkpt":
                 obj = self.objstack.pop()
-                obj.finalize()
-                self.objstack[-1].trkpts.append(obj)
+                if self.points:
+                    obj.finalize()
+                    if self.callback is not None: self.callback((self.objstack[-2], self.objstack[-1], obj))
+                else:
+                    if not self.columnar: obj.finalize()
+                    self.objstack[-1].trkpts.append(obj)
                 self.read = 5
             else:
                 if self.chdata.strip() != "": setattr(self.objstack[-1], name, self.chdata)
                 self.chdata = ""
 
+class GPXExpatParser(object):
+    """
+    This is a GPX parser built directly on pyexpat. It produces the same
+    objects as GPXParser, and takes the same arguments, but avoids the
+    overhead of xml.sax. Select it by passing parser='expat' to gpxParse,
+    iterGpx, or GPSBabel.execCmd.
+
+    How much faster it is depends on the options. Most of the time taken
+    to read a GPXWaypoint is in creating and finalizing it, which is the
+    same for both parsers, so the gain is small unless lazy or, above
+    all, columnar is set: the points of a columnar route or track segment
+    are read straight into its GPXColumns. GPSBabelBench measures it.
+    """
+    #This uses the same states as GPXParser. Instead of testing the state
+    #and element name in turn, each state has three tables, which are
+    #swapped in whenever the state changes: starts maps an element name to
+    #the class of object to create and the new state, ends maps it to the
+    #method which finishes the current object, and fields lists the
+    #elements whose character data becomes an attribute of the current
+    #object. Elements which are not in any table are ignored. The tables
+    #for each state are kept together in the states list.
+    #
+    #buffer_text means character data arrives in as few pieces as
+    #possible, and it is simply appended to a list, without calling back
+    #into Python. ordered_attributes passes attributes as a flat
+    #[name, value, ...] list rather than building a dictionary.
+    def __init__(self, callback=None, keep=True, points=False, columnar=False, lazy=False):
+        """
+        Constructor. See GPXParser.
+        """
+        self.callback = callback
+        self.keep = keep
+        self.points = points
+        self.columnar = columnar
+        if lazy: self.states = self.lazyStates
+        self.chdata = []
+        self.gpx = GPXData()
+        self.objstack = [self.gpx]
+        self.read, self.stateStarts, self.stateEnds, self.stateFields = self.states[0]
+        self.parser = xml.parsers.expat.ParserCreate()
+        self.parser.buffer_text = True
+        self.parser.ordered_attributes = True
+        self.parser.StartElementHandler = self.startElement
+        self.parser.EndElementHandler = self.endElement
+        self.parser.CharacterDataHandler = self.chdata.append
+
+    def feed(self, data):
+        """
+        Parse the next piece of a GPX document.
+        """
+        self.parser.Parse(data, False)
+
+    def close(self):
+        """
+        Finish parsing a GPX document which was passed in using feed.
+        """
+        self.parser.Parse('', True)
+
+    def startElement(self, name, attrs):
+        """
+        Handle the start of a new element.
+        """
+        del self.chdata[:]
+        start = self.stateStarts.get(name)
+        if start is not None:
+            obj = start[0]()
+            if self.columnar and isinstance(obj, (GPXRoute, GPXTrackSeg)):
+                obj.makeColumnar()
+                if isinstance(obj, GPXRoute) or not self.points: self._readColumns(obj.points())
+            self.objstack.append(obj)
+            self.read, self.stateStarts, self.stateEnds, self.stateFields = start[1]
+        elif attrs and self.read:
+            obj = self.objstack[-1]
+        else:
+            return
+        if len(attrs) == 4 and attrs[0] == 'lat' and attrs[2] == 'lon':
+            obj.lat = attrs[1]
+            obj.lon = attrs[3]
+        elif attrs:
+            for i in xrange(0, len(attrs), 2):
+                if attrs[i] in self.stateFields: setattr(obj, attrs[i], attrs[i + 1])
+
+    def endElement(self, name):
+        """
+        Conclude a given element.
+        """
+        if name not in self.stateFields:
+            end = self.stateEnds.get(name)
+            if end is not None:
+                end(self)
+                return
+            if name.islower():
+                return
+            name = name.lower()
+            end = self.stateEnds.get(name)
+            if end is not None:
+                end(self)
+                return
+            if name not in self.stateFields:
+                return
+        chdata = self.chdata
+        if chdata:
+            text = chdata[0] if len(chdata) == 1 else u"".join(chdata)
+            if not text.isspace(): setattr(self.objstack[-1], name, text)
+            del chdata[:]
+
+    def _readColumns(self, columns):
+        """
+        Read the points of a columnar route or track segment straight into
+        its GPXColumns, without creating a GPXWaypoint for each one.
+        """
+        #The parser's handlers are replaced by these until the route or
+        #segment ends. Each point adds a row of NaN to the arrays when it
+        #starts, and its fields are then written into that row as they
+        #are read, or into extras, giving the same result as
+        #GPXColumns.append of a GPXWaypoint straight from the parser.
+        #Everything outside a point is passed on to the usual handlers.
+        #They are closures, so that every name they use is local, and the
+        #usual form of time is converted here, as parseEpoch would.
+        tag = columns.tag
+        fields = self.states[6][3]
+        arrays = columns.arrays
+        appends = [values.append for values in arrays.values()]
+        timeCache = _timeCache
+        lats = arrays['lat']
+        lons = arrays['lon']
+        extras = columns.extras
+        nan = GPXColumns.nan
+        chdata = self.chdata
+        startElement = self.startElement
+        endElement = self.endElement
+        current = [None]
+
+        def store(name, text):
+            values = arrays.get(name)
+            if values is None: extras.setdefault(current[0], {})[name] = text
+            elif name == 'time': values[-1] = parseEpoch(text)
+            else: values[-1] = float(text)
+
+        def start(name, attrs):
+            del chdata[:]
+            if current[0] is None:
+                if name != tag:
+                    startElement(name, attrs)
+                    return
+                for append in appends:
+                    append(nan)
+                current[0] = len(lats) - 1
+            if len(attrs) == 4 and attrs[0] == 'lat' and attrs[2] == 'lon':
+                lats[-1] = float(attrs[1])
+                lons[-1] = float(attrs[3])
+            elif attrs:
+                for i in xrange(0, len(attrs), 2):
+                    if attrs[i] in fields: store(attrs[i], attrs[i + 1])
+
+        def end(name):
+            if current[0] is None:
+                endElement(name)
+                return
+            if name not in fields:
+                if name != tag:
+                    if name.islower():
+                        return
+                    name = name.lower()
+                if name == tag:
+                    current[0] = None
+                    return
+                if name not in fields:
+                    return
+            if chdata:
+                text = chdata[0] if len(chdata) == 1 else u"".join(chdata)
+                if not text.isspace():
+                    values = arrays.get(name)
+                    if values is None:
+                        extras.setdefault(current[0], {})[name] = text
+                    elif name != 'time':
+                        values[-1] = float(text)
+                    else:
+                        cached = None
+                        if len(text) == 20 and text[19] == 'Z' and text[16] == ':': cached = timeCache.get(text[:16])
+                        values[-1] = parseEpoch(text) if cached is None else cached[1] + int(text[17:19])
+                del chdata[:]
+
+        self.parser.StartElementHandler = start
+        self.parser.EndElementHandler = end
+
+    def _endColumns(self):
+        """
+        Go back to the usual handlers at the end of a columnar route or
+        track segment. See _readColumns.
+        """
+        self.parser.StartElementHandler = self.startElement
+        self.parser.EndElementHandler = self.endElement
+
+    def _endWpt(self):
+        obj = self.objstack.pop()
+        obj.finalize()
+        if self.keep: self.gpx.wpts.append(obj)
+        if self.callback is not None: self.callback(obj)
+        self.read, self.stateStarts, self.stateEnds, self.stateFields = self.states[0]
+
+    def _endRte(self):
+        if self.columnar: self._endColumns()
+        obj = self.objstack.pop()
+        obj.finalize()
+        if self.keep: self.gpx.rtes.append(obj)
+        if self.callback is not None: self.callback(obj)
+        self.read, self.stateStarts, self.stateEnds, self.stateFields = self.states[0]
+
+    def _endRtept(self):
+        obj = self.objstack.pop()
+        if not self.columnar: obj.finalize()
+        self.objstack[-1].rtepts.append(obj)
+        self.read, self.stateStarts, self.stateEnds, self.stateFields = self.states[2]
+
+    def _endTrk(self):
+        obj = self.objstack.pop()
+        obj.finalize()
+        if self.keep: self.gpx.trks.append(obj)
+        if self.callback is not None and not self.points: self.callback(obj)
+        self.read, self.stateStarts, self.stateEnds, self.stateFields = self.states[0]
+
+    def _endTrkseg(self):
+        if self.columnar: self._endColumns()
+        obj = self.objstack.pop()
+        obj.finalize()
+        self.objstack[-1].trksegs.append(obj)
+        self.read, self.stateStarts, self.stateEnds, self.stateFields = self.states[4]
+
+    def _endTrkpt(self):
+        obj = self.objstack.pop()
+        if self.points:
+            obj.finalize()
+            if self.callback is not None: self.callback((self.objstack[-2], self.objstack[-1], obj))
+        else:
+            if not self.columnar: obj.finalize()
+            self.objstack[-1].trkpts.append(obj)
+        self.read, self.stateStarts, self.stateEnds, self.stateFields = self.states[5]
+
+    #lazyStates is the same as states, but creates the GPXLazy* classes.
+    states = []
+    lazyStates = []
+    for table, wpt, rte, trk in ((states, GPXWaypoint, GPXRoute, GPXTrack),
+                                 (lazyStates, GPXLazyWaypoint, GPXLazyRoute, GPXLazyTrack)):
+        for read, starts, ends, cls in (
+                (0, {'wpt' : wpt, 'rte' : rte, 'trk' : trk}, {}, None),
+                (1, {}, {'wpt' : _endWpt}, GPXWaypoint),
+                (2, {'rtept' : wpt}, {'rte' : _endRte}, GPXRoute),
+                (3, {}, {'rtept' : _endRtept}, GPXWaypoint),
+                (4, {'trkseg' : GPXTrackSeg}, {'trk' : _endTrk}, GPXTrack),
+                (5, {'trkpt' : wpt}, {'trkseg' : _endTrkseg}, GPXTrackSeg),
+                (6, {}, {'trkpt' : _endTrkpt}, GPXWaypoint)):
+            fields = frozenset([i for i in getattr(cls, '__slots__', []) if i not in ('xmltag', 'rtepts', 'trksegs', 'trkpts')])
+            table.append((read, starts, ends, fields))
+        for read, name, new in ((0, 'wpt', 1), (0, 'rte', 2), (2, 'rtept', 3), (0, 'trk', 4), (4, 'trkseg', 5), (5, 'trkpt', 6)):
+            table[read][1][name] = (table[read][1][name], table[new])
+    del table, wpt, rte, trk, read, starts, ends, cls, fields, name, new
+
+gpxParsers = {'sax' : GPXParser, 'expat' : GPXExpatParser}
+"""
+The GPX parsers that can be selected by name, when calling gpxParse,
+iterGpx, or GPSBabel.execCmd.
+"""
+
+def makeGpxParser(parser='sax', callback=None, keep=True, points=False, columnar=False, lazy=False):
+    """
+    Create a GPX parser, ready to be fed data.
+
+    In:
+        parser: The name of the parser, as listed in gpxParsers
+        callback, keep, points, columnar, lazy: As for GPXParser
+
+    Out:
+        A GPXParser or GPXExpatParser
+    """
+    if parser not in gpxParsers:
+        raise UnknownParserException('Error: Unknown GPX parser %s' % parser)
+    return gpxParsers[parser](callback, keep, points, columnar, lazy)
+
 def validateVersion(gps):
     """
     Find the version of GPSBabel in the system path and make sure it's
     supported. Raise an exception if not.
     """
+    global version, banner
     ret, gpsver = gps.execCmd([gps.gpsbabel, "-V"], parseOutput = False)
     versionstr = ""
     for line in gpsver:
@@ -1292,10 +5654,19 @@ check_exe = validateVersion
 Provide an alias to validateVersion
 """
 
-def readOpts(gpso):
+def readOpts(gpso, output=None):
     """
     Read the supported formats/filters/character sets from the
     installed gpsbabel.
+
+    In:
+        gpso: The GPSBabel instance to query
+        output: A tuple of the (ftypes, filters, charsets) dictionaries to
+            fill in. If not given, the module's are replaced once all
+            three have been read.
+
+    Out:
+        The (ftypes, filters, charsets) dictionaries
     """
     #Run gpsbabel with the -h parameter, and parse the three sections:
     #0: general help, which this method ignores
@@ -1305,6 +5676,11 @@ def readOpts(gpso):
     #Run gpsbabel with the -l parmater, and parse the output. Character
     #set names are on lines starting with "*", and aliases are on
     #subsequent lines and the lines start with the tab character ("\t")
+    if output is None:
+        found = readOpts(gpso, ({}, {}, {}))
+        _publish(found)
+        return found
+    ftypes, filters, charsets = output
     ftype = ''
     ret, gps = gpso.execCmd([gpso.gpsbabel, "-h"], parseOutput = False)
     mode = 0 # 0 == do nothing, 1 == file type, 2 === filter
@@ -1343,16 +5719,180 @@ def readOpts(gpso):
             charsets[charset] = []
         if line.startswith('\t'):
             charsets[charset].extend(filter(lambda x: len(x) > 0, map(lambda x: x.strip(), line.strip().split(','))))
+    return output
+
+class CapabilityDict(dict):
+    """
+    A dictionary of what the installed gpsbabel supports (ftypes, filters
+    or charsets). It starts out empty, and is filled in by
+    loadCapabilities the first time anything reads from it.
+    """
+    loaded = False
+
+_capabilityLock = threading.RLock()
+
+def _loadOnce():
+    """
+    Load the capabilities, unless another thread did so while this one
+    was waiting for the lock.
+    """
+    _capabilityLock.acquire()
+    try:
+        if not (ftypes.loaded and filters.loaded and charsets.loaded): loadCapabilities()
+    finally:
+        _capabilityLock.release()
+
+def _publish(found):
+    """
+    Replace the contents of ftypes, filters and charsets with the complete
+    dictionaries in found, and mark them loaded.
+    """
+    #New keys are added before stale ones are removed, so that a thread
+    #reading meanwhile never misses a key which is in both.
+    for d, new in zip((ftypes, filters, charsets), found):
+        dict.update(d, new)
+        for key in [key for key in dict.keys(d) if key not in new]:
+            dict.__delitem__(d, key)
+        d.loaded = True
+
+def _loadFirst(name):
+    method = getattr(dict, name)
+    def wrapper(self, *args, **kwargs):
+        if not self.loaded: _loadOnce()
+        return method(self, *args, **kwargs)
+    wrapper.__name__ = name
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+for name in ['__contains__', '__eq__', '__getitem__', '__iter__', '__len__', '__ne__', '__repr__',
+             'copy', 'get', 'has_key', 'items', 'iteritems', 'iterkeys', 'itervalues', 'keys', 'values']:
+    setattr(CapabilityDict, name, _loadFirst(name))
+del name
+
+def capabilityCacheFile(loc):
+    """
+    Find the file that capabilities of the gpsbabel at loc are cached in.
+    The name depends on the resolved location, size, and modification
+    time of the gpsbabel executable, so that upgrading or replacing
+    gpsbabel automatically stops the old cache from being used.
+
+    Out:
+        The name of the cache file, or None if caching is disabled or
+        gpsbabel cannot be found.
+    """
+    if cacheDir is None:
+        return None
+    ident = executableId(loc)
+    if ident is None:
+        return None
+    return os.path.join(cacheDir, "capabilities-%s" % md5(ident).hexdigest())
+
+def executableId(loc):
+    """
+    Out:
+        A string identifying the gpsbabel at loc, made from its resolved
+        location, size, and modification time, which changes whenever
+        gpsbabel is upgraded or replaced. None if it cannot be found.
+    """
+    if loc is None:
+        return None
+    path = loc if os.path.dirname(loc) else which(loc)
+    if path is None:
+        return None
+    path = os.path.realpath(path)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return "%s\0%d\0%d" % (path, st.st_size, int(st.st_mtime))
+
+def loadCapabilities(gpso=None, refresh=False):
+    """
+    Fill in version, banner, ftypes, filters and charsets.
 
+    This happens automatically the first time ftypes, filters or charsets
+    are read, so it rarely needs to be called directly. The results are
+    cached on disk (see cacheDir), and are read back from there rather
+    than running gpsbabel again whenever possible.
+
+    In:
+        gpso: The GPSBabel instance to query. Default: gps
+        refresh: If True, ignore any cached results and run gpsbabel
+
+    It is safe to call from several threads at once. The dictionaries are
+    filled in privately, and only replace the module's once complete, so
+    other threads never see them part way through.
+    """
+    global version, banner
+    if gpso is None: gpso = gps
+    _capabilityLock.acquire()
+    try:
+        try:
+            cachename = capabilityCacheFile(gpso.gpsbabel)
+            if not refresh and cachename is not None and os.path.exists(cachename):
+                try:
+                    f = open(cachename, 'rb')
+                    try:
+                        cached = pickle.load(f)
+                    finally:
+                        f.close()
+                    found = (cached['ftypes'], cached['filters'], cached['charsets'])
+                    version, banner = cached['version'], cached['banner']
+                    _publish(found)
+                    return
+                except Exception:
+                    pass
+            validateVersion(gpso)
+            found = readOpts(gpso, ({}, {}, {}))
+        except:
+            for d in (ftypes, filters, charsets): d.loaded = False
+            raise
+        _publish(found)
+    finally:
+        _capabilityLock.release()
+    if cachename is not None:
+        cached = {'version' : version, 'banner' : banner, 'ftypes' : found[0],
+                  'filters' : found[1], 'charsets' : found[2]}
+        try:
+            if not os.path.isdir(cacheDir): os.makedirs(cacheDir)
+            (fd, name) = tempfile.mkstemp(dir=cacheDir)
+            f = os.fdopen(fd, 'wb')
+            try:
+                pickle.dump(cached, f, 2)
+            finally:
+                f.close()
+            if os.path.exists(cachename) and sys.platform == 'win32': os.unlink(cachename)
+            os.rename(name, cachename)
+        except (IOError, OSError):
+            pass
+
+def refreshCapabilities(gpso=None):
+    """
+    Re-read version, banner, ftypes, filters and charsets from gpsbabel,
+    ignoring and replacing any cached results.
+
+    In:
+        gpso: The GPSBabel instance to query. Default: gps
+    """
+    loadCapabilities(gpso, True)
+
+def getVersion():
+    """
+    Out:
+        The version of gpsbabel, as found in the version property, after
+        loading capabilities if that has not yet been done.
+    """
+    if not ftypes.loaded: _loadOnce()
+    return version
 
 version = None
 banner = None
-ftypes = {}
-filters = {}
-charsets = {}
-gps = GPSBabel(which('gpsbabel'))
-if len(sys.argv) > 0 and sys.argv[0].lower().endswith('setup.py'):
-    pass
+ftypes = CapabilityDict()
+filters = CapabilityDict()
+charsets = CapabilityDict()
+if sys.platform == 'win32':
+    cacheDir = os.path.join(os.environ.get('APPDATA', os.path.expanduser('~')), 'python-gpsbabel')
 else:
-    validateVersion(gps)
-    readOpts(gps)
+    cacheDir = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'python-gpsbabel')
+defaultExecutor = SubprocessExecutor()
+gps = GPSBabel(which('gpsbabel'))
+defaultLoop = GPSBabelLoop()